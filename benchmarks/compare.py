@@ -0,0 +1,31 @@
+#!/usr/bin/env python3
+"""Compare the best times of two benchmark result files."""
+
+import argparse
+import json
+from pathlib import Path
+
+
+def load(path: Path) -> tuple[str, dict]:
+    report = json.loads(path.read_text())
+    # Dict: { (stage, transactions): best seconds }
+    results = {(r["stage"], r["transactions"]): r["best"] for r in report["results"]}
+    return (report.get("commit") or str(path))[:10], results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('baseline', type=Path)
+    parser.add_argument('contender', type=Path)
+    args = parser.parse_args()
+    base_name, base = load(args.baseline)
+    new_name, new = load(args.contender)
+    print(f"{'stage':<28} {'txns':>9} {base_name:>12} {new_name:>12} {'ratio':>7}")
+    for key in sorted(base.keys() & new.keys(), key=lambda k: (k[1], k[0])):
+        stage, transactions = key
+        ratio = new[key] / base[key] if base[key] else float("nan")
+        print(f"{stage:<28} {transactions:>9} {base[key]:>11.4f}s {new[key]:>11.4f}s {ratio:>6.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+"""Generate synthetic multi-file Beancount ledgers and replay databases."""
+
+from __future__ import annotations
+
+import json
+import math
+import random
+from datetime import date, timedelta
+from pathlib import Path
+
+import yaml
+
+# (payee, expense account, typical amounts)
+PAYEES = [
+    ("Coffee Shop", "Expenses:Food:Coffee", (3, 4, 5)),
+    ("Grocer", "Expenses:Food:Groceries", (12, 25, 60)),
+    ("Bakery", "Expenses:Food:Groceries", (4, 7)),
+    ("Landlord", "Expenses:Home:Rent", (800,)),
+    ("Power Co", "Expenses:Home:Utilities", (45, 60)),
+    ("Gym", "Expenses:Sport", (30,)),
+    ("Bookstore", "Expenses:Books", (15, 25)),
+    ("Train", "Expenses:Transport:Train", (9, 40)),
+    ("Taxi", "Expenses:Transport:Taxi", (18, 32)),
+    ("Cinema", "Expenses:Leisure", (12,)),
+]
+SOURCE_ACCOUNTS = ["Assets:Bank:Checking", "Liabilities:CreditCard"]
+TAGS = ["trip", "work", "gift"]
+
+# Kinds of replays generate_replays can make, see _replay()
+REPLAY_KINDS = ("account", "payee", "narration", "time", "regex", "tag")
+
+
+def generate_ledger(
+        directory: Path,
+        transactions: int,
+        files: int = 4,
+        seed: int = 0,
+    ) -> Path:
+    """
+    Write a ledger of about 20 transactions a day, split into files included
+    from main.beancount, and return the path of main.beancount.
+    """
+    rng = random.Random(seed)
+    directory = Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+    start = date(2000, 1, 1)
+    days = max(transactions // 20, 1)
+    per_file = math.ceil(transactions / files)
+
+    main = directory / "main.beancount"
+    with main.open("w", encoding="utf-8") as f:
+        f.write('option "operating_currency" "EUR"\n')
+        f.write('1999-01-01 custom "fava-option" "indent" "2"\n\n')
+        accounts = sorted({account for _, account, _ in PAYEES} | set(SOURCE_ACCOUNTS))
+        for account in accounts:
+            f.write(f"1999-01-01 open {account} EUR\n")
+        f.write("\n")
+        for i in range(files):
+            f.write(f'include "part{i:03}.beancount"\n')
+
+    for i in range(files):
+        lines = []
+        for n in range(i * per_file, min(transactions, (i + 1) * per_file)):
+            txn_date = start + timedelta(days=n * days // transactions)
+            payee, account, amounts = rng.choice(PAYEES)
+            tags = f" #{rng.choice(TAGS)}" if rng.random() < 0.1 else ""
+            lines.append(f'{txn_date} * "{payee}" "item {n}"{tags}\n')
+            if rng.random() < 0.2:
+                lines.append(f'  receipt: "R{n}"\n')
+            amount = rng.choice(amounts)
+            lines.append(f"  {account}  {amount}.00 EUR\n")
+            lines.append(f"  {rng.choice(SOURCE_ACCOUNTS)}\n\n")
+        (directory / f"part{i:03}.beancount").write_text("".join(lines), encoding="utf-8")
+    return main
+
+
+def _replay(kind: str, rng: random.Random, years: list[int]) -> dict:
+    """Return a replay of the given kind, as stored in the YAML database."""
+    payee, account, _ = rng.choice(PAYEES)
+    replay = {"time_filter": "", "account_filter": "", "advanced_filter": ""}
+    if kind == "account":
+        replay["account_filter"] = account.rsplit(":", 1)[0] if rng.random() < 0.5 else account
+    elif kind == "payee":
+        replay["advanced_filter"] = f"payee:'{payee}'"
+    elif kind == "narration":
+        replay["advanced_filter"] = f"narration:'item {rng.randrange(1000)}'"
+    elif kind == "time":
+        replay["time_filter"] = str(rng.choice(years))
+        replay["account_filter"] = account
+    elif kind == "regex":
+        replay["advanced_filter"] = f"narration:'^item [0-9]*{rng.randrange(10)}$'"
+    elif kind == "tag":
+        replay["advanced_filter"] = f"#{rng.choice(TAGS)}"
+    else:
+        raise ValueError(f"Unknown kind of replay: {kind}")
+
+    delta = rng.choice([
+        {"values_changed": {"root.narration": {"new_value": f"{payee} purchase"}}},
+        {"values_changed": {"root.flag": {"new_value": "!"}}},
+        {"set_item_added": {"root.tags": [f"{kind}-replay"]}},
+        {"dictionary_item_added": {"root.meta['category']": kind}},
+        {"values_changed": {"root.postings[0].account": {"new_value": account}}},
+    ])
+    replay["diff"] = json.dumps(delta)
+    return replay
+
+
+def generate_replays(
+        path: Path,
+        count: int,
+        kinds: tuple[str, ...] = REPLAY_KINDS,
+        transactions: int = 10_000,
+        seed: int = 0,
+    ) -> Path:
+    """
+    Write a YAML replays database of count replays, cycling through the given
+    kinds, for a ledger generated with the same number of transactions.
+    """
+    rng = random.Random(seed)
+    last = date(2000, 1, 1) + timedelta(days=max(transactions // 20, 1))
+    years = list(range(2000, last.year + 1))
+    replays = [_replay(kinds[i % len(kinds)], rng, years) for i in range(count)]
+    path = Path(path)
+    with path.open("w", encoding="utf-8") as f:
+        yaml.safe_dump(replays, f, allow_unicode=True, sort_keys=True)
+    return path
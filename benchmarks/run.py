@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+"""Time the stages of the replay pipeline on synthetic ledgers."""
+
+from __future__ import annotations
+
+import argparse
+import json
+import platform
+import shutil
+import subprocess
+import tempfile
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+from statistics import mean
+from typing import Any, Callable
+
+from beancount import loader
+from beancount.core.data import Custom, Transaction
+from fava.core.fava_options import parse_options
+from fava.beans.str import to_string
+
+from fava_edit_replay import EditReplay, columns
+from fava_edit_replay.diff import diff_sources
+from fava_edit_replay.diff2text import format_diff
+from fava_edit_replay.helpers import (
+    apply_replays,
+    compile_replays,
+    transaction_matches_replay,
+    txn_apply_delta,
+)
+from fava_edit_replay.replay import load_replays_from_file
+
+from generate import REPLAY_KINDS, generate_ledger, generate_replays
+
+# Number of transactions the per-transaction stages run on
+SAMPLE_SIZE = 2000
+
+
+def measure(func: Callable[[], Any], repeat: int, setup: Callable[[], Any] | None = None) -> list[float]:
+    """Return the durations of repeat calls of func, setup runs untimed before each."""
+    durations = []
+    for _ in range(repeat):
+        if setup:
+            setup()
+        start = time.perf_counter()
+        func()
+        durations.append(time.perf_counter() - start)
+    return durations
+
+
+def git_commit() -> str | None:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True,
+            cwd=Path(__file__).parent,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def bench_size(args: argparse.Namespace, size: int, workdir: Path) -> list[dict]:
+    """Run all the stages on a ledger of size transactions."""
+    pristine = workdir / f"ledger-{size}"
+    ledger = workdir / f"work-{size}"
+    print(f"Generating {size} transactions in {args.files} files...")
+    generate_ledger(pristine, size, files=args.files, seed=args.seed)
+    replays_path = generate_replays(
+        workdir / f"replays-{size}.yaml", args.replays, tuple(args.kinds),
+        transactions=size, seed=args.seed,
+    )
+
+    def restore():
+        shutil.rmtree(ledger, ignore_errors=True)
+        shutil.copytree(pristine, ledger)
+
+    restore()
+    start = time.perf_counter()
+    entries, _, options_map = loader.load_file(str(ledger / "main.beancount"))
+    load_seconds = time.perf_counter() - start
+    fava_options, _ = parse_options([e for e in entries if isinstance(e, Custom)])
+    txns = [e for e in entries if isinstance(e, Transaction)]
+    sample = txns[:SAMPLE_SIZE]
+
+    replays = load_replays_from_file(replays_path)
+    compiled = compile_replays(replays, options_map, fava_options)
+    deltas = [replay.delta for replay in compiled]
+    before_after = [
+        (to_string(txn), to_string(txn_apply_delta(txn, delta)))
+        for txn, delta in zip(sample, deltas * (len(sample) // len(deltas) + 1))
+    ]
+    extension = EditReplay.__new__(EditReplay)
+
+    def match_sample():
+        for txn in sample:
+            for replay in compiled:
+                if transaction_matches_replay(txn, replay):
+                    break
+
+    def apply_deltas():
+        for txn in sample:
+            for delta in deltas:
+                txn_apply_delta(txn, delta)
+
+    def apply_patches():
+        for txn in sample:
+            for replay in compiled:
+                replay.patch.apply(txn)
+
+    def compute_diffs():
+        for before, after in before_after:
+            extension._compute_diff(before, after)
+
+    stages = [
+        # (stage, operations per call, func, setup)
+        ("load_replays_from_file", len(replays), lambda: load_replays_from_file(replays_path), None),
+        ("format_diff", len(deltas), lambda: [format_diff(delta) for delta in deltas], None),
+        ("transaction_matches_replay", len(sample) * len(compiled), match_sample, None),
+        ("txn_apply_delta", len(sample) * len(deltas), apply_deltas, None),
+        ("DeltaPatch.apply", len(sample) * len(compiled), apply_patches, None),
+        ("_compute_diff", len(before_after), compute_diffs, None),
+        ("diff_sources", len(before_after), lambda: diff_sources(before_after), None),
+        (
+            "apply_replays", len(txns),
+            lambda: apply_replays(replays, entries, options_map, fava_options, jobs=args.jobs),
+            restore,
+        ),
+    ]
+    if columns.available():
+        stages.append((
+            "apply_replays_columnar", len(txns),
+            lambda: apply_replays(
+                replays, entries, options_map, fava_options, jobs=args.jobs, columnar=True,
+            ),
+            restore,
+        ))
+    results = [{
+        "stage": "load_ledger", "transactions": size, "operations": len(txns),
+        "seconds": [load_seconds], "best": load_seconds, "mean": load_seconds,
+    }]
+    for stage, operations, func, setup in stages:
+        if args.stages and stage not in args.stages:
+            continue
+        print(f"  {stage}...", end="", flush=True)
+        durations = measure(func, args.repeat, setup)
+        print(f" best {min(durations):.4f}s")
+        results.append({
+            "stage": stage,
+            "transactions": size,
+            "operations": operations,
+            "seconds": durations,
+            "best": min(durations),
+            "mean": mean(durations),
+        })
+    shutil.rmtree(ledger, ignore_errors=True)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10_000],
+                        help='Numbers of transactions of the generated ledgers '
+                             '(default: 10000, e.g. --sizes 10000 100000 1000000)')
+    parser.add_argument('--files', type=int, default=8, help='Number of ledger files')
+    parser.add_argument('--replays', type=int, default=50, help='Number of replays')
+    parser.add_argument('--kinds', nargs='+', choices=REPLAY_KINDS, default=list(REPLAY_KINDS),
+                        help='Kinds of replays, used in turn')
+    parser.add_argument('--stages', nargs='+', help='Only run these stages')
+    parser.add_argument('--repeat', type=int, default=3, help='Timed runs of each stage')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='Worker processes of apply_replays')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workdir', type=Path, help='Keep the generated ledgers in this directory')
+    parser.add_argument('-o', '--output', type=Path, default=Path('benchmark-results.json'),
+                        help='JSON file to write the results to')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix="edit-replay-bench-") as tmp:
+        workdir = args.workdir or Path(tmp)
+        workdir.mkdir(parents=True, exist_ok=True)
+        results = []
+        for size in args.sizes:
+            results.extend(bench_size(args, size, workdir))
+
+    report = {
+        "commit": git_commit(),
+        "date": datetime.now(timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "parameters": {
+            key: value for key, value in vars(args).items()
+            if key not in ("output", "workdir")
+        },
+        "results": results,
+    }
+    args.output.write_text(json.dumps(report, indent=2))
+    print(f"Wrote {args.output}")
+
+
+if __name__ == "__main__":
+    main()
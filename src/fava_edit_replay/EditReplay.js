@@ -78,6 +78,29 @@ function applyFilterSuggestion(btn) {
   window.location.search = params.toString();
 }
 
+// Show on each filter pill how many transactions the filters would match
+// once it is applied.
+async function loadFilterCounts() {
+  const pills = document.querySelectorAll('.filter-pill');
+  if (!pills.length) return;
+  try {
+    const params = new URLSearchParams(window.location.search);
+    const response = await fetch(`filter_counts?${params.toString()}`);
+    const result = await response.json();
+    pills.forEach((pill, i) => {
+      const count = result.suggestions[i];
+      if (count === null || count === undefined) return;
+      const badge = document.createElement('span');
+      badge.className = 'filter-pill-count';
+      badge.textContent = count;
+      pill.prepend(badge);
+      pill.title = `${pill.title}\n${count} transactions`;
+    });
+  } catch (error) {
+    console.error('Error loading filter counts:', error);
+  }
+}
+
 function loadReplay(btn) {
   const time = btn.getAttribute('data-time');
   const account = btn.getAttribute('data-account');
@@ -116,6 +139,21 @@ async function deleteReplay(btn) {
   }
 }
 
+// Id of the running apply all job
+let applyAllJobId = null;
+
+function formatApplyAllProgress(state) {
+  const parts = [];
+  if (state.replays !== undefined) {
+    parts.push(`${state.replays} replays, ${state.matched} transactions matched`);
+  }
+  if (state.files_total) {
+    parts.push(`${state.modified} modified, ${state.files_rewritten}/${state.files_total} files`);
+  }
+  parts.push(`${state.elapsed.toFixed(1)}s`);
+  return parts.join(' · ');
+}
+
 async function applyAllReplays() {
   if (!confirm('This will apply all replays to all the transactions in the ledger, are you sure?')) {
     return;
@@ -124,23 +162,154 @@ async function applyAllReplays() {
   const button = document.getElementById('apply-all-replays-btn');
   const buttonText = button.querySelector('span');
   const originalText = buttonText.textContent;
-  
+  const progress = document.getElementById('apply-all-progress');
+  const cancelBtn = document.getElementById('cancel-apply-all-btn');
+
+  const reset = () => {
+    buttonText.textContent = originalText;
+    button.disabled = false;
+    cancelBtn.hidden = true;
+    cancelBtn.disabled = false;
+    progress.hidden = true;
+    applyAllJobId = null;
+  };
+
   buttonText.textContent = 'Applying...';
   button.disabled = true;
   
   try {
     const params = new URLSearchParams(window.location.search);
-    const url = `apply_all_replays?${params.toString()}`;
-    const response = await fetch(url);
-    const result = await response.text();
-    alert(result);
-    // Reload the page to refresh the replay list
-    window.location.reload();
+    const response = await fetch(`apply_all_replays?${params.toString()}`);
+    const result = await response.json();
+    if (result.error) {
+      alert(result.error);
+      reset();
+      return;
+    }
+    applyAllJobId = result.job_id;
+    params.set('job', applyAllJobId);
+    cancelBtn.hidden = false;
+    progress.hidden = false;
+    const events = new EventSource(`apply_all_progress?${params.toString()}`);
+    events.onmessage = (message) => {
+      const state = JSON.parse(message.data);
+      progress.textContent = formatApplyAllProgress(state);
+      if (state.status === 'running') return;
+      events.close();
+      alert(state.message);
+      if (state.status === 'done') {
+        // Reload the page to refresh the replay list
+        window.location.reload();
+      } else {
+        reset();
+      }
+    };
   } catch (error) {
     console.error('Error applying all replays:', error);
     alert('Failed to apply all replays.');
-    buttonText.textContent = originalText;
-    button.disabled = false;
+    reset();
+  }
+}
+
+async function cancelApplyAll() {
+  if (!applyAllJobId) return;
+  const params = new URLSearchParams(window.location.search);
+  params.set('job', applyAllJobId);
+  try {
+    await fetch(`cancel_apply_all?${params.toString()}`);
+    document.getElementById('cancel-apply-all-btn').disabled = true;
+  } catch (error) {
+    console.error('Error cancelling apply all:', error);
+  }
+}
+
+// Fetch the next window of matching transactions when the end of the list
+// scrolls into view.
+let loadingTransactions = false;
+
+async function loadMoreTransactions(observer) {
+  const more = document.getElementById('editreplay-transactions-more');
+  if (!more || loadingTransactions) return;
+  loadingTransactions = true;
+  try {
+    const params = new URLSearchParams(window.location.search);
+    params.set('offset', more.dataset.nextOffset);
+    const response = await fetch(`transactions?${params.toString()}`);
+    const result = await response.json();
+    if (result.error) {
+      more.textContent = result.error;
+      observer.disconnect();
+      return;
+    }
+    const list = document.querySelector('.editreplay-transactions-container ol.journal');
+    list.insertAdjacentHTML('beforeend', result.html);
+    if (result.next_offset === null) {
+      observer.disconnect();
+      more.remove();
+    } else {
+      more.dataset.nextOffset = result.next_offset;
+      // Observe again, to load another window if the end is still visible
+      observer.unobserve(more);
+      observer.observe(more);
+    }
+  } catch (error) {
+    console.error('Error loading transactions:', error);
+    more.textContent = 'Failed to load more transactions.';
+    observer.disconnect();
+  } finally {
+    loadingTransactions = false;
+  }
+}
+
+// Query parameters and offset of the next page of the current preview
+let previewParams = null;
+let previewOffset = null;
+
+async function loadPreviewPage() {
+  const container = document.getElementById('editreplay-preview');
+  const list = document.getElementById('editreplay-preview-list');
+  const moreBtn = document.getElementById('preview-more-btn');
+  previewParams.set('offset', previewOffset);
+  const response = await fetch(`dry_run?${previewParams.toString()}`);
+  const result = await response.json();
+  if (result.error) {
+    alert(result.error);
+    return;
+  }
+  result.previews.forEach(preview => {
+    const item = document.createElement('pre');
+    item.className = 'editreplay-preview-diff';
+    item.textContent = preview.diff;
+    list.appendChild(item);
+  });
+  if (!list.children.length) {
+    list.textContent = 'No transaction would be modified.';
+  }
+  previewOffset = result.next_offset;
+  moreBtn.hidden = previewOffset === null;
+  container.hidden = false;
+}
+
+async function previewReplays(all) {
+  previewParams = new URLSearchParams(window.location.search);
+  if (all) {
+    previewParams.set('all', '1');
+    previewParams.delete('diff');
+  } else {
+    const diff = window.lastDiffJson;
+    if (!diff) {
+      alert('No diff to preview.');
+      return;
+    }
+    previewParams.set('diff', diff);
+  }
+  previewOffset = 0;
+  document.getElementById('editreplay-preview-list').textContent = '';
+  try {
+    await loadPreviewPage();
+  } catch (error) {
+    console.error('Error previewing replays:', error);
+    alert('Failed to preview replays.');
   }
 }
 
@@ -162,6 +331,7 @@ export default {
         applyFilterSuggestion(this);
       });
     });
+    loadFilterCounts();
     // Attach click listeners to all load-replay buttons
     document.querySelectorAll('.load-replay-btn').forEach(btn => {
       btn.addEventListener('click', function() {
@@ -202,5 +372,39 @@ export default {
     if (applyAllReplaysBtn) {
       applyAllReplaysBtn.addEventListener('click', applyAllReplays);
     }
+    const cancelApplyAllBtn = document.getElementById('cancel-apply-all-btn');
+    if (cancelApplyAllBtn) {
+      cancelApplyAllBtn.addEventListener('click', cancelApplyAll);
+    }
+    // Load the rest of the matching transactions while scrolling
+    const moreTransactions = document.getElementById('editreplay-transactions-more');
+    if (moreTransactions) {
+      const observer = new IntersectionObserver(entries => {
+        if (entries.some(entry => entry.isIntersecting)) {
+          loadMoreTransactions(observer);
+        }
+      });
+      observer.observe(moreTransactions);
+    }
+    // Attach click listeners to the preview buttons
+    const previewDiffBtn = document.getElementById('preview-diff-btn');
+    if (previewDiffBtn) {
+      previewDiffBtn.addEventListener('click', () => previewReplays(false));
+    }
+    const previewAllReplaysBtn = document.getElementById('preview-all-replays-btn');
+    if (previewAllReplaysBtn) {
+      previewAllReplaysBtn.addEventListener('click', () => previewReplays(true));
+    }
+    const previewMoreBtn = document.getElementById('preview-more-btn');
+    if (previewMoreBtn) {
+      previewMoreBtn.addEventListener('click', async () => {
+        try {
+          await loadPreviewPage();
+        } catch (error) {
+          console.error('Error previewing replays:', error);
+          alert('Failed to preview replays.');
+        }
+      });
+    }
   }
 }
\ No newline at end of file
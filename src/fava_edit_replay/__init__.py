@@ -3,27 +3,27 @@
 
 from __future__ import annotations
 
-import datetime
 import json
-from decimal import Decimal
-from functools import partial
+import threading
 
-from deepdiff import DeepDiff
-from deepdiff import Delta
-from deepdiff.serialization import json_dumps
-from flask import request
+from flask import Response, request
 
 from beancount.core.data import Transaction
-from beancount.parser import parser
 
 from fava.context import g
 from fava.core.file import get_entry_slice
+from fava.core.filters import FilterError
 from fava.ext import FavaExtensionBase
 from fava.ext import extension_endpoint
 
-from fava_edit_replay.helpers import apply_replays, make_filter_suggestions
+from fava_edit_replay.helpers import CompiledReplay, DryRun, ReplayResult, apply_replays, make_filter_suggestions
+from fava_edit_replay.diff import diff_sources
 from fava_edit_replay.diff2text import format_diff
-from fava_edit_replay.replay import Replay, save_replay_to_file, load_replays_from_file, delete_replay_by_lineno
+from fava_edit_replay.jobs import ReplayJob
+from fava_edit_replay.refresh import refresh_ledger
+from fava_edit_replay.replay import JsonlReplayStore, Replay, ReplayStore, open_replay_store
+from fava_edit_replay.rewrite import ChangedFileError, file_stamps, journal_path_for, recover_journal
+from fava_edit_replay.suggest import SuggestionIndex, apply_suggestion
 
 import logging
 logger = logging.getLogger("edit_replay")
@@ -37,19 +37,135 @@ class EditReplay(FavaExtensionBase):  # pragma: no cover
 
     before_slice: str | None = None
     after_slice: str | None = None
+    # Number of transactions rendered with the page, and fetched by each
+    # request of the transactions endpoint.
+    transactions_page_size = 100
+    _replay_store: ReplayStore | JsonlReplayStore | None = None
+    # Dict: { job id: ReplayJob }, the latest apply all jobs
+    _jobs: dict[str, ReplayJob] | None = None
+    max_jobs = 10
+    # The entries and file stamps the last apply all job read, and its
+    # ReplayResult, until the next request refreshes the ledger with it
+    _pending_refresh: tuple[list, dict, ReplayResult] | None = None
+    # Dict: { ledger file: (mtime_ns, size) when the ledger was loaded }, the
+    # files that changed since can't be replaced
+    _loaded_stamps: dict | None = None
+    # ReplayStats.as_dict() of the last apply
+    last_stats: dict | None = None
+    _suggestion_index: SuggestionIndex | None = None
+
+    def __init__(self, ledger, config=None):
+        super().__init__(ledger, config)
+        self._refresh_lock = threading.Lock()
+        # The last dry run, with the replays, mtime and entries it is for
+        self._dry_run: tuple[tuple, int, list, DryRun] | None = None
+        self._dry_run_lock = threading.Lock()
 
     def database_path(self):
         return self.ledger.join_path(self.config.get("db", "replays.yaml"))
 
+    def replay_store(self) -> ReplayStore | JsonlReplayStore:
+        """The cached replays of the database file."""
+        path = self.database_path()
+        if self._replay_store is None or self._replay_store.path != path:
+            self._replay_store = open_replay_store(path)
+        return self._replay_store
+
+    def suggestion_index(self) -> SuggestionIndex:
+        """The index of the transactions of the ledger, updated when it changed."""
+        if self._suggestion_index is None:
+            self._suggestion_index = SuggestionIndex()
+        self._suggestion_index.update(self.ledger.all_entries, self.ledger.mtime)
+        return self._suggestion_index
+
+    def _count(self, filters: dict[str, str]) -> int | None:
+        """
+        Return the number of transactions of the ledger matching the filters,
+        from the index when possible. None if the filters are invalid.
+        """
+        count = self.suggestion_index().count_filters(
+            filters, self.ledger.options, self.ledger.fava_options
+        )
+        if count is not None:
+            return count
+        try:
+            replay = CompiledReplay(
+                Replay(0, filters["time"], filters["account"], filters["filter"], "{}", None),
+                self.ledger.options,
+                self.ledger.fava_options,
+            )
+        except FilterError:
+            return None
+        return len(replay.filter([
+            entry for entry in self.ledger.all_entries
+            if isinstance(entry, Transaction) and entry.flag != 'S'
+        ]))
+
+    def after_load_file(self):
+        # The files modified after the latest change Fava saw before loading
+        # them may have been read before the modification: they get no stamp
+        # until the next load. Unknown for the first load (mtime 0).
+        self._loaded_stamps = file_stamps(self.ledger.options["include"], self.ledger.mtime or None)
+
+    def running_job(self) -> ReplayJob | None:
+        """The apply all job still running, if any."""
+        return next((job for job in (self._jobs or {}).values() if not job.done), None)
+
+    def refresh_pending(self):
+        """
+        Refresh the ledger with the result of the last apply all job, on the
+        request thread, unless Fava already reloaded it since the job read
+        its entries.
+        """
+        with self._refresh_lock:
+            pending, self._pending_refresh = self._pending_refresh, None
+            if pending is not None and self.ledger.all_entries is pending[0]:
+                refresh_ledger(self.ledger, pending[2], pending[1])
+
+    def recover_interrupted_run(self):
+        """Finish an interrupted run, if any, and reload the ledger."""
+        journal_path = journal_path_for(self.ledger.beancount_file_path)
+        if recover_journal(journal_path):
+            self.ledger.load_file()
+
     def get_transactions(self, ledger):
         return [
             entry for entry in ledger.entries
             if isinstance(entry, Transaction) and entry.flag != 'S'
         ]
 
+    def _limits(self, default_limit: int) -> tuple[int, int]:
+        """Return the offset and limit request parameters, raise ValueError if invalid."""
+        offset = int(request.args.get("offset", 0))
+        limit = int(request.args.get("limit", default_limit))
+        if offset < 0 or limit < 0:
+            raise ValueError
+        return offset, limit
+
+    @extension_endpoint
+    def transactions(self):
+        """
+        Render a window of the filtered transactions, so that the list is
+        loaded incrementally while scrolling.
+        """
+        try:
+            offset, limit = self._limits(self.transactions_page_size)
+        except ValueError:
+            return {"error": "Invalid offset or limit."}
+        txns = self.get_transactions(g.filtered)
+        template = self.jinja_env.get_template("transaction-rows.html")
+        end = offset + limit
+        return {
+            "html": template.render(transactions=txns[offset:end]),
+            "next_offset": end if end < len(txns) else None,
+            "total": len(txns),
+        }
+
     @extension_endpoint
     def apply_diff(self):
         """Apply a diff to all filtered transactions."""
+        if self.running_job():
+            return "Replays are being applied, try again once they are done."
         # Get diff from query string parameter
         diff_json = request.args.get("diff", "")
         if not diff_json:
@@ -68,25 +184,38 @@ class EditReplay(FavaExtensionBase):  # pragma: no cover
                 "to prevent bulk changes to all transactions."
             )
 
+        self.recover_interrupted_run()
         filtered_ledger = self.ledger.get_filtered(
             account=account,
             filter=filter_str,
             time=time,
         )
 
-        replay = Replay(0, time, account, filter_str, diff_json, None)
-        modified_count = apply_replays(
-            [replay], 
-            filtered_ledger.entries, 
+        replay = CompiledReplay(
+            Replay(0, time, account, filter_str, diff_json, None),
             filtered_ledger.ledger.options,
-            self.ledger.fava_options
+            self.ledger.fava_options,
         )
-        self.ledger.load_file()
-        return f"Applied diff to {modified_count} transactions."
+        stamps = self._loaded_stamps
+        try:
+            result = apply_replays(
+                [replay], 
+                filtered_ledger.entries, 
+                filtered_ledger.ledger.options,
+                self.ledger.fava_options,
+                stamps=stamps,
+            )
+        except ChangedFileError as e:
+            return f"{e}, reload the page and try again."
+        self.last_stats = result.stats.as_dict()
+        refresh_ledger(self.ledger, result, stamps)
+        return f"Applied diff to {result.modified_count} transactions."
 
     @extension_endpoint
     def save_replay(self):
-        """Save the current diff and filters as a replay to a YAML file."""
+        """Save the current diff and filters as a replay to the database file."""
+        if self.running_job():
+            return "Replays are being applied, try again once they are done."
         replay = Replay(
             lineno=-1,
             time_filter=request.args.get("time", ""),
@@ -95,19 +224,19 @@ class EditReplay(FavaExtensionBase):  # pragma: no cover
             diff=request.args.get("diff", ""),
             diff_readable=None,
         )
-        save_replay_to_file(replay, self.database_path())
+        self.replay_store().save(replay)
         return "Replay saved."
 
     @extension_endpoint
     def delete_replay(self):
-        """Delete a replay by line number from the YAML file."""
+        """Delete a replay by line number (or id in JSONL files) from the database."""
         lineno = request.args.get("lineno")
         if not lineno:
             return "No line number provided."
         
         try:
             lineno = int(lineno)
-            delete_replay_by_lineno(lineno, self.database_path())
+            self.replay_store().delete(lineno)
             return "Replay deleted."
         except ValueError:
             return "Invalid line number provided."
@@ -117,21 +246,162 @@ class EditReplay(FavaExtensionBase):  # pragma: no cover
 
     @extension_endpoint
     def apply_all_replays(self):
-        """Apply all saved replays to the entire ledger."""
-        replays = load_replays_from_file(self.database_path())
+        """
+        Start applying all saved replays to the entire ledger in the
+        background, and return the id of the job, see apply_all_progress.
+        """
+        if self._jobs is None:
+            self._jobs = {}
+        running = self.running_job()
+        if running:
+            return {"job_id": running.id}
+
+        replays = self.replay_store().replays()
         if not replays:
-            return "No replays to apply."
-        
-        modified_count = apply_replays(
-            replays,
-            self.ledger.all_entries,
-            self.ledger.options,
-            self.ledger.fava_options
+            return {"error": "No replays to apply."}
+
+        self.recover_interrupted_run()
+        # Read on the request thread, the job doesn't touch the FavaLedger:
+        # the next request refreshes it, see refresh_pending().
+        entries = self.ledger.all_entries
+        options = self.ledger.options
+        fava_options = self.ledger.fava_options
+        stamps = self._loaded_stamps
+        compose = bool(self.config.get("compose"))
+
+        def run(progress):
+            result = apply_replays(
+                replays, entries, options, fava_options,
+                progress=progress, compose=compose, stamps=stamps,
+            )
+            self.last_stats = result.stats.as_dict()
+            with self._refresh_lock:
+                self._pending_refresh = (entries, stamps, result)
+            return {
+                "files_written": len(result.files),
+                "message": f"Applied {len(replays)} replays to {result.modified_count} transactions.",
+            }
+
+        job = ReplayJob(run).start()
+        self._jobs[job.id] = job
+        for job_id in list(self._jobs)[:-self.max_jobs]:
+            if self._jobs[job_id].done:
+                del self._jobs[job_id]
+        return {"job_id": job.id}
+
+    def _job(self) -> ReplayJob | None:
+        return (self._jobs or {}).get(request.args.get("job", ""))
+
+    @extension_endpoint
+    def apply_all_progress(self):
+        """
+        Stream the progress of an apply all job as Server-Sent Events: the
+        replays, matched and modified transactions, files rewritten and written,
+        elapsed seconds and status ("running", "done", "cancelled" or "error").
+        """
+        job = self._job()
+        if job is None:
+            return {"error": "Unknown job."}
+        try:
+            start = int(request.headers.get("Last-Event-ID", -1)) + 1
+        except ValueError:
+            start = 0
+        return Response(
+            job.sse(start),
+            mimetype="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
         )
-        self.ledger.load_file()
-        return f"Applied {len(replays)} replays to {modified_count} transactions."
+
+    @extension_endpoint
+    def cancel_apply_all(self):
+        """Cancel an apply all job, before it starts replacing files."""
+        job = self._job()
+        if job is None:
+            return {"error": "Unknown job."}
+        job.cancel()
+        return {"job_id": job.id}
+
+    @extension_endpoint
+    def stats(self):
+        """
+        Return the timers and counters of the last apply: seconds per stage,
+        and counters per replay and per file, see ReplayStats.
+        """
+        return {"stats": self.last_stats}
+
+    @extension_endpoint
+    def filter_counts(self):
+        """
+        Return the number of transactions of the ledger matching the account,
+        filter and time filters, and for each filter suggestion of the last
+        edit, the number matching them once the suggestion is applied.
+        """
+        filters = {key: request.args.get(key, "") for key in ("account", "filter", "time")}
+        suggestions = make_filter_suggestions(self.before_slice or "")
+        return {
+            "count": self._count(filters),
+            "suggestions": [
+                self._count(apply_suggestion(filters, suggestion))
+                for suggestion in suggestions
+            ],
+        }
+
+    @extension_endpoint
+    def dry_run(self):
+        """
+        Preview the changes of the diff on the filtered transactions, or of
+        all saved replays on the entire ledger with all=1, one page at a time.
+        """
+        try:
+            offset, limit = self._limits(20)
+        except ValueError:
+            return {"error": "Invalid offset or limit."}
+
+        if request.args.get("all"):
+            replays = self.replay_store().replays()
+            entries = self.ledger.all_entries
+        else:
+            diff_json = request.args.get("diff", "")
+            if not diff_json:
+                return {"error": "No diff provided."}
+            account = request.args.get("account", "")
+            filter_str = request.args.get("filter", "")
+            time = request.args.get("time", "")
+            if not account and not filter_str and not time:
+                return {
+                    "error": "At least one filter (account, filter, or time) "
+                    "must be specified."
+                }
+            replays = [Replay(0, time, account, filter_str, diff_json, None)]
+            entries = self.ledger.get_filtered(
+                account=account,
+                filter=filter_str,
+                time=time,
+            ).entries
+
+        with self._dry_run_lock:
+            cached = self._dry_run
+            if (
+                cached is None
+                or cached[:2] != (tuple(replays), self.ledger.mtime)
+                or cached[2] is not self.ledger.all_entries
+            ):
+                dry_run = DryRun(replays, entries, self.ledger.options, self.ledger.fava_options)
+                cached = self._dry_run = (
+                    tuple(replays), self.ledger.mtime, self.ledger.all_entries, dry_run
+                )
+            # Only compute one more preview than needed, to know if there are more
+            page = cached[3].page(offset, limit + 1)
+        return {
+            "previews": [
+                {**preview._asdict(), "replay": preview.replay._asdict()}
+                for preview in page[:limit]
+            ],
+            "next_offset": offset + limit if len(page) > limit else None,
+        }
 
     def before_request(self):
+        self.refresh_pending()
         if request.path.endswith("/api/source_slice") and request.method == "PUT":
             data = request.get_json(force=True, silent=True)
             if data:
@@ -155,44 +425,15 @@ class EditReplay(FavaExtensionBase):  # pragma: no cover
             logger.error("No transaction diff available: before or after is empty.")
             return None
         try:
-            original_entries, o_errors, _ = parser.parse_string(before)
-            modified_entries, m_errors, _ = parser.parse_string(after)
-            if o_errors or m_errors:
-                logger.error(f"Parse error: {o_errors} {m_errors}")
-                return None
-            if not original_entries or not modified_entries:
+            delta = diff_sources([(before, after)])[0]
+            if delta is None:
                 logger.error("Invalid transaction slices provided.")
                 return None
-            diff = DeepDiff(
-                original_entries[0],
-                modified_entries[0],
-            )
-            custom_json_dumps = partial(
-                json_dumps, default_mapping={datetime.date: str, Decimal: str}
-            )
-            delta = Delta(diff, serializer=custom_json_dumps)
-            self._remove_lineno_changed(delta.diff)
-            return delta.dumps()
+            return json.dumps(delta, separators=(",", ":"))
         except Exception as e:
             logger.error(f"Error computing diff: {e}")
             return None
 
-    def _remove_lineno_changed(self, diff_dict):
-        """
-        Remove line diffs like below, they happen when inserting meta for
-        example, which ends up changing the line number of the posting.
-          "values_changed": {
-              "root.postings[0].meta['lineno']": { "new_value": "2.51" }
-          },
-        """
-        for key, value in diff_dict.items():
-            if key == "values_changed":
-                # Collect keys to delete first
-                keys_to_delete = [k for k in value if "lineno" in k]
-                for k in keys_to_delete:
-                    del diff_dict[key][k]
-        return diff_dict
-
     def get_data(self):
         txns = self.get_transactions(g.filtered)
         lastdiff_readable = []
@@ -212,9 +453,12 @@ class EditReplay(FavaExtensionBase):  # pragma: no cover
                 lastdiff_readable = format_diff(diff_dict)
             filter_suggestions = make_filter_suggestions(self.before_slice)
 
-        replays = load_replays_from_file(self.database_path())
+        replays = self.replay_store().replays()
+        page_size = self.transactions_page_size
         return {
-            "transactions": txns,
+            "transactions": txns[:page_size],
+            "transactions_total": len(txns),
+            "transactions_next_offset": page_size if len(txns) > page_size else None,
             "lastdiff_readable": lastdiff_readable,
             "lastdiff_json": lastdiff_json,
             "filter_suggestions": filter_suggestions,
@@ -0,0 +1,208 @@
+"""On-disk cache of the ledger loaded by the command line tool."""
+
+from __future__ import annotations
+
+import gc
+import os
+import pickle
+import sys
+from pathlib import Path
+from typing import Any, NamedTuple
+
+import beancount
+import fava
+from beancount.core import data
+from beancount.parser import parser
+
+from fava_edit_replay.helpers import ReplayResult
+from fava_edit_replay.load import expand_include, read_includes
+from fava_edit_replay.refresh import has_errors_in, refreshed_entries
+from fava_edit_replay.rewrite import file_stamp
+
+import logging
+logger = logging.getLogger("edit_replay.cache")
+
+# Bumped whenever the layout of the cache changes
+CACHE_VERSION = 2
+
+
+def cache_path_for(ledger_file: str) -> str:
+    """Return the path of the cache of a ledger file, hidden next to it."""
+    path = Path(ledger_file)
+    return str(path.with_name(f".{path.name}.edit-replay.pickle"))
+
+
+def _environment() -> tuple:
+    """What the cached entries also depend on, besides the ledger files."""
+    return (CACHE_VERSION, sys.version_info[:2], beancount.__version__, fava.__version__)
+
+
+def _included_files(filename: str, includes: dict[str, list[str]]) -> set[str]:
+    """
+    Return the files of a ledger as its include patterns match them now:
+    the top-level file and the paths each pattern expands to.
+    """
+    files = {filename}
+    for path, patterns in includes.items():
+        for pattern in patterns:
+            files.update(expand_include(path, pattern))
+    return files
+
+
+def _share_tolerances(entries: list) -> None:
+    """
+    Make the transactions with equal __tolerances__ metadata share the same
+    dict, booking gives each transaction its own, so that it is pickled
+    once.
+    """
+    # Dict: { items of the tolerances: shared tolerances }
+    shared: dict[tuple, Any] = {}
+    for entry in entries:
+        tolerances = entry.meta.get("__tolerances__") if entry.meta else None
+        if tolerances is not None:
+            key = tuple(sorted(tolerances.items()))
+            entry.meta["__tolerances__"] = shared.setdefault(key, tolerances)
+
+
+class LoadedLedger(NamedTuple):
+    """A loaded ledger, as the command line tool uses it."""
+    entries: list
+    errors: list
+    options_map: dict
+    fava_options: Any
+
+
+class LedgerCache:
+    """
+    Pickle of a loaded ledger, valid while its files keep their stamps, see
+    rewrite.file_stamp(), and its include patterns match the same files.
+    Only the changed files of a light load are parsed again. update()
+    splices the rewritten transactions in after a run.
+    """
+
+    def __init__(self, path: str, light: bool = False):
+        self.path = path
+        self.light = light
+        # Dict: { path of a ledger file: (mtime_ns, size) when it was loaded }
+        self.files: dict[str, tuple[int, int] | None] = {}
+        # Dict: { path of a ledger file: patterns of its include directives }
+        self.includes: dict[str, list[str]] = {}
+
+    def load(self) -> LoadedLedger | None:
+        """Return the cached ledger, or None if there is no valid cache."""
+        # The cyclic garbage collector would run many times over the
+        # millions of new objects, for nothing, they are all reachable.
+        gc_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            with open(self.path, "rb") as f:
+                cached = pickle.load(f)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logger.warning(f"Ignoring unreadable ledger cache {self.path}: {e}")
+            return None
+        finally:
+            if gc_enabled:
+                gc.enable()
+        if cached.get("environment") != _environment() or cached.get("light") != self.light:
+            return None
+        stale = [
+            path for path, stamp in cached["files"].items() if file_stamp(path) != stamp
+        ]
+        ledger = cached["ledger"]
+        included = _included_files(ledger.options_map["filename"], cached["includes"])
+        if included != set(cached["files"]):
+            return None
+        self.files = cached["files"]
+        self.includes = cached["includes"]
+        if not stale:
+            return ledger
+        if not self.light or ledger.options_map["filename"] in stale:
+            return None
+        return self._reparsed(ledger, stale)
+
+    def _reparsed(self, ledger: LoadedLedger, stale: list[str]) -> LoadedLedger | None:
+        """
+        Parse the stale files of a light load again, or return None if one
+        of them is gone or has includes, which could have changed.
+        """
+        entries = ledger.entries
+        errors = ledger.errors
+        for path in stale:
+            if not os.path.exists(path):
+                return None
+            src_entries, src_errors, src_options_map = parser.parse_file(path)
+            if src_options_map["include"]:
+                return None
+            entries = [e for e in entries if e.meta.get("filename") != path]
+            entries.extend(src_entries)
+            errors = [
+                e for e in errors if (e.source or {}).get("filename") != path
+            ]
+            errors.extend(src_errors)
+            ledger.options_map["dcontext"].update_from(src_options_map["dcontext"])
+        entries.sort(key=data.entry_sortkey)
+        ledger = ledger._replace(entries=entries, errors=errors)
+        self.save(ledger, stale)
+        return ledger
+
+    def save(self, ledger: LoadedLedger, rewritten: list[str] | None = None) -> None:
+        """
+        Write the cache, atomically. With rewritten, the ledger was loaded
+        from the cache and only these files changed since.
+        """
+        if rewritten is None:
+            self.files = {path: file_stamp(path) for path in ledger.options_map["include"]}
+            paths = self.files
+            self.includes = {}
+        else:
+            self.files = {**self.files, **{path: file_stamp(path) for path in rewritten}}
+            paths = rewritten
+        for path in paths:
+            patterns = read_includes(path)
+            if patterns:
+                self.includes[path] = patterns
+            else:
+                self.includes.pop(path, None)
+        _share_tolerances(ledger.entries)
+        cached = {
+            "environment": _environment(),
+            "light": self.light,
+            "files": self.files,
+            "includes": self.includes,
+            "ledger": ledger,
+        }
+        tmp_path = f"{self.path}.tmp"
+        try:
+            with open(tmp_path, "wb") as f:
+                pickle.dump(cached, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, self.path)
+        except (OSError, pickle.PicklingError) as e:
+            logger.warning(f"Could not write the ledger cache {self.path}: {e}")
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def update(self, ledger: LoadedLedger, result: ReplayResult) -> None:
+        """
+        Update the cache after apply_replays rewrote some files, splicing the
+        transactions in like refresh_ledger() does. Otherwise a light load's
+        rewritten files are parsed again by the next load(), and the cache of a
+        full load is removed.
+        """
+        if not result.changes:
+            return
+        entries = None
+        if (
+            (self.light or not ledger.options_map.get("plugin"))
+            and not has_errors_in(ledger.errors, result.files)
+        ):
+            entries = refreshed_entries(ledger.entries, result)
+        if entries is not None:
+            self.save(ledger._replace(entries=entries), result.files)
+        elif not self.light:
+            self.clear()
+
+    def clear(self) -> None:
+        if os.path.exists(self.path):
+            os.remove(self.path)
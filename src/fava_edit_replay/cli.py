@@ -1,31 +1,251 @@
 #!/usr/bin/env python3
 import sys
 import os
+import time
 from pathlib import Path
 from beancount import loader
 from beancount.core.data import Custom
 
-from fava_edit_replay.helpers import apply_replays
-from fava_edit_replay.replay import load_replays_from_file
+from fava_edit_replay import columns
+from fava_edit_replay.cache import LedgerCache, LoadedLedger, cache_path_for
+from fava_edit_replay.helpers import apply_replays, compile_replays, preview_replays, stream_replays
+from fava_edit_replay.index import MatchIndex
+from fava_edit_replay.load import EncryptedFileError, iter_ledger_files, needs_booking, parse_ledger
+from fava_edit_replay.replay import copy_replays, open_replay_store
+from fava_edit_replay.rewrite import ChangedFileError, file_stamps, journal_path_for, recover_journal
 
 from fava.core.fava_options import parse_options
 
+def load_ledger(args, replays):
+    """
+    Load the ledger, from the cache if enabled and valid. Light loads only
+    parse the files, unless the replays need booked data.
+    Returns the LoadedLedger, the LedgerCache, or None without --cache, and
+    the stamps of the ledger files as they were loaded, see file_stamps().
+    """
+    started = time.time_ns()
+    light = args.light
+    if light:
+        booked = [replay for replay in replays if needs_booking(replay)]
+        if booked:
+            linenos = ", #".join(str(replay.lineno) for replay in booked)
+            print(f"Replays #{linenos} filter on booked data, loading the full ledger")
+            light = False
+    cache = LedgerCache(cache_path_for(args.ledger_file), light) if args.cache else None
+    ledger = cache.load() if cache else None
+    if ledger is not None:
+        print("Loaded the ledger from the cache")
+        return ledger, cache, file_stamps(ledger.options_map["include"], started)
+    loaded = None
+    if light:
+        loaded = parse_ledger(args.ledger_file, args.jobs)
+        if loaded is None:
+            print("Found encrypted ledger files, loading the full ledger")
+            light = False
+    if loaded is None:
+        loaded = loader.load_file(args.ledger_file)
+    entries, errors, options_map = loaded
+    custom_entries = [e for e in entries if type(e) == Custom]
+    fava_options, fava_options_errors = parse_options(custom_entries)
+    if fava_options_errors:
+        print(f"WARNING: Errors parsing fava options: {fava_options_errors}")
+    ledger = LoadedLedger(entries, errors, options_map, fava_options)
+    if cache:
+        cache.light = light
+        cache.save(ledger)
+    return ledger, cache, file_stamps(options_map["include"], started)
+
+def stream_ledger(args):
+    """
+    Parse the top-level ledger file for the options, the included files are
+    then parsed one at a time while the replays are applied.
+    Returns the files, see iter_ledger_files(), the options map, the Fava
+    options and the stamps of the files, filled in as they are parsed.
+    """
+    stamps = {}
+    files = iter_ledger_files(args.ledger_file)
+    started = time.time_ns()
+    top = next(files)
+    stamps.update(file_stamps([top[0]], started))
+    options_map = top[3]
+    fava_options, fava_options_errors = parse_options(
+        [e for e in top[1] if type(e) == Custom]
+    )
+    if fava_options_errors:
+        print(f"WARNING: Errors parsing fava options: {fava_options_errors}")
+
+    def checked_files(top):
+        yield top
+        del top
+        while True:
+            started = time.time_ns()
+            parsed = next(files, None)
+            if parsed is None:
+                return
+            stamps.update(file_stamps([parsed[0]], started))
+            if any(type(e) == Custom and e.type == "fava-option" for e in parsed[1]):
+                print(f"WARNING: Ignoring the Fava options of {parsed[0]}, --stream only "
+                      "reads them from the top-level file")
+            yield parsed
+            del parsed
+
+    return checked_files(top), options_map, fava_options, stamps
+
 def main():
     import argparse
     parser = argparse.ArgumentParser(description="Apply all replays from a yaml file to a Beancount ledger file.")
-    parser.add_argument('replays_file', help='Path to the replays.yaml file')
-    parser.add_argument('ledger_file', help='Path to the Beancount ledger file')
+    parser.add_argument('replays_file', help='Path to the replays file (.yaml or .jsonl)')
+    parser.add_argument('ledger_file', nargs='?', help='Path to the Beancount ledger file')
+    parser.add_argument('--export-to', metavar='PATH',
+                        help='Copy the replays to another replays file, converting between '
+                             'the YAML and JSONL formats, and exit. PATH must not exist, '
+                             'unless --append is given')
+    parser.add_argument('--append', action='store_true',
+                        help='With --export-to, append the replays to an existing file')
+    parser.add_argument('--rollback', action='store_true',
+                        help='Roll back an interrupted run instead of finishing it, and exit')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='Print the changes the replays would make, without writing them')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count() or 1,
+                        help='Number of worker processes rewriting the ledger files '
+                             '(default: number of CPUs, 1 to disable)')
+    parser.add_argument('--stats', action='store_true',
+                        help='Print the time spent in each stage of the run, and the '
+                             'counters of each replay and file')
+    parser.add_argument('--profile', metavar='PATH', nargs='?', const='',
+                        help='Profile the run with cProfile, print the most expensive '
+                             'functions and save the profile to PATH if given. The files '
+                             'are rewritten in this process.')
+    parser.add_argument('--light', action='store_true',
+                        help='Only parse the ledger files, in parallel, without booking, '
+                             'plugins and validation. The ledger is still fully loaded if '
+                             'a replay filters on amounts.')
+    parser.add_argument('--cache', action='store_true',
+                        help='Cache the loaded ledger next to the ledger file, so that the '
+                             'next runs only load the files that changed')
+    parser.add_argument('--columnar', action='store_true',
+                        help='Prefilter the transactions of each replay on all the '
+                             'transactions at once with NumPy (pip install numpy)')
+    parser.add_argument('--compose', action='store_true',
+                        help='Apply all the replays matching a transaction, in order, instead '
+                             'of only the first one, and rewrite it once. The index of the '
+                             'previous run is not used.')
+    parser.add_argument('--stream', action='store_true',
+                        help='Parse, match and rewrite the ledger one file at a time, in '
+                             'this process, to bound the memory used by the largest file. '
+                             'Files are only parsed, like with --light.')
+    parser.add_argument('--full', action='store_true',
+                        help='Match all transactions against all replays, ignoring the '
+                             'index of the previous run, and rebuild it. By default, the '
+                             'transactions whose parsed content is unchanged since the previous '
+                             'run are skipped, so edits to their formatting alone (spacing, '
+                             'alignment, comments) are not rewritten again')
     args = parser.parse_args()
     replay_yaml = Path(args.replays_file)
-    replays = load_replays_from_file(replay_yaml)
-    entries, errors, options_map = loader.load_file(args.ledger_file)
-    if errors:
-        print(f"WARNING: Errors parsing ledger: {errors}")
-    custom_entries = [e for e in entries if type(e) == Custom]
-    fava_options, fava_options_errors = parse_options(custom_entries)
-    if fava_options_errors:
-        print(f"WARNING: Errors parsing fava options: {fava_options_errors}")
-    apply_replays(replays, entries, options_map, fava_options, verbose=True)
+    if args.export_to:
+        try:
+            count = copy_replays(replay_yaml, Path(args.export_to), append=args.append)
+        except FileExistsError:
+            print(f"ERROR: {args.export_to} already exists, pass --append to add the replays to it")
+            sys.exit(1)
+        print(f"Copied {count} replays to {args.export_to}")
+        return
+    if not args.ledger_file:
+        parser.error("the following arguments are required: ledger_file")
+    if args.compose and args.dry_run:
+        parser.error("--compose can't be used with --dry-run")
+    if args.stream and (args.dry_run or args.cache or args.columnar):
+        parser.error("--stream can't be used with --dry-run, --cache or --columnar")
+    journal_path = journal_path_for(args.ledger_file)
+    if args.dry_run and os.path.exists(journal_path):
+        print(f"WARNING: Found the journal of an interrupted run: {journal_path}")
+        recovered = []
+    else:
+        recovered = recover_journal(journal_path, rollback=args.rollback)
+    if recovered:
+        action = "Rolled back" if args.rollback else "Finished"
+        print(f"{action} interrupted run on: {', '.join(recovered)}")
+    if args.rollback:
+        return
+    stored_replays = open_replay_store(replay_yaml).replays()
+    stream = args.stream
+    if stream:
+        booked = [replay for replay in stored_replays if needs_booking(replay)]
+        if booked:
+            linenos = ", #".join(str(replay.lineno) for replay in booked)
+            print(f"Replays #{linenos} filter on booked data, loading the full ledger")
+            stream = False
+    if stream:
+        try:
+            files, options_map, fava_options, stamps = stream_ledger(args)
+        except EncryptedFileError:
+            print("Found encrypted ledger files, loading the full ledger")
+            stream = False
+        cache = None
+    if not stream:
+        ledger, cache, stamps = load_ledger(args, stored_replays)
+        entries, errors, options_map, fava_options = ledger
+        if errors:
+            print(f"WARNING: Errors parsing ledger: {errors}")
+    replays = compile_replays(stored_replays, options_map, fava_options)
+    if args.dry_run:
+        count = 0
+        for preview in preview_replays(replays, entries, options_map, fava_options):
+            print(f"Replay #{preview.replay.lineno}: {preview.replay.diff_readable}")
+            print(preview.diff)
+            count += 1
+        print(f"Would modify {count} transactions.")
+        return
+    match_index = None
+    if not args.compose:
+        match_index = MatchIndex(
+            f"{replay_yaml}.index", [fava_options.currency_column, fava_options.indent]
+        )
+        if not args.full:
+            match_index.load()
+    jobs = args.jobs
+    if args.profile is not None:
+        import cProfile
+        import pstats
+        profiler = cProfile.Profile()
+        profiler.enable()
+        jobs = 1
+    columnar = args.columnar
+    if columnar and not columns.available():
+        print("WARNING: --columnar requires NumPy, matching without it")
+        columnar = False
+    result = None
+    try:
+        if stream:
+            try:
+                result = stream_replays(
+                    replays, files, options_map, fava_options,
+                    verbose=True, match_index=match_index, compose=args.compose,
+                    stamps=stamps,
+                )
+            except EncryptedFileError:
+                print("Found encrypted ledger files, loading the full ledger")
+                ledger, cache, stamps = load_ledger(args, stored_replays)
+                entries, errors, options_map, fava_options = ledger
+                replays = compile_replays(stored_replays, options_map, fava_options)
+        if result is None:
+            result = apply_replays(
+                replays, entries, options_map, fava_options,
+                verbose=True, jobs=jobs, match_index=match_index, columnar=columnar,
+                compose=args.compose, stamps=stamps,
+            )
+    except ChangedFileError as e:
+        print(f"ERROR: {e}, run again to apply the replays to the new version")
+        sys.exit(1)
+    if cache:
+        cache.update(ledger, result)
+    if args.profile is not None:
+        profiler.disable()
+        if args.profile:
+            profiler.dump_stats(args.profile)
+        pstats.Stats(profiler).sort_stats("cumulative").print_stats(25)
+    if args.stats:
+        print(result.stats.format())
 
 if __name__ == "__main__":
     main() 
\ No newline at end of file
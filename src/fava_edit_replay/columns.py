@@ -0,0 +1,123 @@
+"""Columnar snapshot of transactions, to prefilter replays with NumPy."""
+
+from __future__ import annotations
+
+from decimal import Decimal
+from typing import Any
+
+try:
+    import numpy as np
+except ImportError:  # NumPy is an optional dependency
+    np = None
+
+from fava.core.filters import Match
+
+from fava_edit_replay.dispatch import TEXT_FIELDS, required_amounts, required_terms
+
+# Relative tolerance of the amount comparisons, which are done on floats:
+# the prefilter has to keep every transaction the exact Decimal comparison
+# of the advanced filter could match.
+AMOUNT_TOLERANCE = 1e-9
+
+
+def available() -> bool:
+    """Return True if NumPy is installed."""
+    return np is not None
+
+
+class TransactionTable:
+    """
+    The fields of transactions replay filters can be reduced to, as NumPy
+    arrays, to evaluate these filters on all the transactions at once.
+    """
+
+    def __init__(self, txns: list[Any]):
+        if np is None:
+            raise RuntimeError("The columnar prefilter requires NumPy")
+        self.txns = txns
+        rows = len(txns)
+        self.dates = np.fromiter((txn.date.toordinal() for txn in txns), np.int64, rows)
+        # Dicts: { field: [distinct values] } and { field: codes of the rows }
+        self.values: dict[str, list[str]] = {}
+        self.codes: dict[str, Any] = {}
+        for field in TEXT_FIELDS:
+            codes: dict[str, int] = {}
+            self.codes[field] = np.fromiter(
+                (codes.setdefault(getattr(txn, field) or "", len(codes)) for txn in txns),
+                np.int64, rows,
+            )
+            self.values[field] = list(codes)
+        account_codes: dict[str, int] = {}
+        posting_rows = []
+        posting_accounts = []
+        posting_numbers = []
+        for row, txn in enumerate(txns):
+            for posting in txn.postings:
+                posting_rows.append(row)
+                posting_accounts.append(account_codes.setdefault(posting.account, len(account_codes)))
+                number = getattr(posting.units, "number", None)
+                posting_numbers.append(
+                    abs(float(number)) if isinstance(number, (Decimal, int, float)) else np.nan
+                )
+        self.accounts = list(account_codes)
+        self.posting_rows = np.array(posting_rows, np.int64)
+        self.posting_accounts = np.array(posting_accounts, np.int64)
+        self.posting_numbers = np.array(posting_numbers, np.float64)
+
+    def _any_posting(self, postings: Any) -> Any:
+        """Reduce a boolean mask of the postings to the rows with any of them."""
+        return np.bincount(
+            self.posting_rows, weights=postings, minlength=len(self.txns)
+        ) > 0
+
+    def _amount_postings(self, op: str, value: Decimal) -> Any:
+        numbers = self.posting_numbers
+        value = float(value)
+        tolerance = AMOUNT_TOLERANCE * max(1.0, abs(value))
+        if op == "=":
+            return np.abs(numbers - value) <= tolerance
+        if op in (">", ">="):
+            return numbers >= value - tolerance
+        return numbers <= value + tolerance
+
+    def mask(self, replay: Any) -> Any:
+        """
+        Return the boolean mask of the rows that could match the compiled
+        replay: the rows matching its time and account filters, and the
+        terms of its advanced filter every match has to satisfy, see
+        required_terms() and required_amounts(). Rows of the mask still
+        have to go through the advanced filter itself.
+        """
+        rows = len(self.txns)
+        if replay.skipped:
+            return np.zeros(rows, bool)
+        mask = np.ones(rows, bool)
+        if replay.date_range:
+            begin, end = (day.toordinal() for day in replay.date_range)
+            mask &= (self.dates >= begin) & (self.dates < end)
+        if replay.account_match:
+            matching = np.array([replay.account_match(name) for name in self.accounts], bool)
+            if len(self.posting_accounts):
+                mask &= self._any_posting(matching[self.posting_accounts])
+            else:
+                mask[:] = False
+        advanced_filter = replay.replay.advanced_filter or ""
+        for field, value in required_terms(advanced_filter):
+            match = Match(value)
+            matching = np.array([match(v) for v in self.values[field]], bool)
+            mask &= matching[self.codes[field]]
+        for op, value in required_amounts(advanced_filter):
+            mask &= self._any_posting(self._amount_postings(op, value))
+        return mask
+
+    def candidates(self, replays: list[Any]) -> dict[int, int]:
+        """
+        Return { id(txn): bitmask of the positions of the replays that could
+        match it }, like MatchIndex.plan().
+        """
+        masks = [0] * len(self.txns)
+        for i, replay in enumerate(replays):
+            bit = 1 << i
+            for row in np.flatnonzero(self.mask(replay)).tolist():
+                masks[row] |= bit
+        return {id(txn): mask for txn, mask in zip(self.txns, masks)}
@@ -0,0 +1,293 @@
+"""Compile deltas into patches applied to many transactions, and compose them."""
+
+from __future__ import annotations
+
+import datetime
+import re
+from decimal import Decimal
+from typing import Any
+
+from beancount.core.amount import Amount
+from beancount.core.data import Cost, CostSpec, Posting
+from beancount.core.number import MISSING
+
+# The actions of a delta which change a NamedTuple field, a dict item and
+# insert or remove a list item.
+FIELD_ACTIONS = ("values_changed", "set_item_added", "set_item_removed")
+DICT_ACTIONS = ("dictionary_item_added", "dictionary_item_removed")
+LIST_ACTIONS = ("iterable_item_added", "iterable_item_removed")
+
+
+def explode_path(path_str: str) -> list[str | int]:
+    """
+    Split a path string into a list of path parts.
+    explode_path('root.postings[0].units.number') -> ['postings', 0, 'units', 'number']
+    """
+    path_parts = [p for p in re.split(r'[.[\]\']+', path_str) if p]
+
+    def try_int(s):
+        try:
+            return int(s)
+        except ValueError:
+            return s
+
+    typed_path_parts = [try_int(p) for p in path_parts]
+
+    if typed_path_parts and typed_path_parts[0] == 'root':
+        typed_path_parts = typed_path_parts[1:]
+
+    return typed_path_parts
+
+
+def upgrade_delta(delta: dict) -> dict:
+    """
+    Return the delta with the type_changes of the deltas DeepDiff computed,
+    like a payee added to a transaction without one (None to a string), as
+    values_changed to their new value.
+    """
+    type_changes = delta.get("type_changes")
+    if type_changes is None:
+        return delta
+    delta = {action: changes for action, changes in delta.items() if action != "type_changes"}
+    values_changed = dict(delta.get("values_changed") or {})
+    for path_str, change in type_changes.items():
+        values_changed[path_str] = {"new_value": change["new_value"]}
+    delta["values_changed"] = values_changed
+    return delta
+
+
+def _number(value: Any) -> Any:
+    if value is None or value == "MISSING":
+        return None if value is None else MISSING
+    return Decimal(value)
+
+
+def decode_value(key: str | int, value: Any) -> Any:
+    """
+    Rebuild the Amount, Cost or CostSpec the JSON data of a delta holds for
+    the units, price and cost fields of a posting, see diff.encode(). Other
+    values are returned as is.
+    """
+    if value == "MISSING" and key in ("units", "price", "cost"):
+        return MISSING
+    if not isinstance(value, dict):
+        return value
+    if key in ("units", "price"):
+        return Amount(_number(value["number"]), value["currency"])
+    if key == "cost":
+        date = value.get("date")
+        if date is not None:
+            date = datetime.date.fromisoformat(date)
+        if "number_per" in value:
+            return CostSpec(
+                _number(value["number_per"]), _number(value["number_total"]),
+                value["currency"], date, value["label"], value["merge"],
+            )
+        return Cost(_number(value["number"]), value["currency"], date, value["label"])
+    return value
+
+
+def decode_posting(value: dict) -> Posting:
+    """Rebuild a posting from the JSON data of an iterable_item_added."""
+    return Posting(
+        value["account"],
+        decode_value("units", value.get("units")),
+        decode_value("cost", value.get("cost")),
+        decode_value("price", value.get("price")),
+        value.get("flag"),
+        dict(value.get("meta") or {}),
+    )
+
+
+class _Node:
+    """
+    The operations of a delta on one object of the transaction tree, as
+    [kind, key, argument] steps, kind being "child" or an action.
+    """
+    __slots__ = ("steps", "_last")
+
+    def __init__(self):
+        self.steps: list[list] = []
+        # Dict: { key: last step on the key }
+        self._last: dict[Any, list] = {}
+
+    def add(self, path: list[str | int], action: str, value: Any) -> None:
+        key = path[0]
+        last = self._last.get(key)
+        if len(path) > 1:
+            if last is None or last[0] != "child":
+                last = self._last[key] = ["child", key, _Node()]
+                self.steps.append(last)
+            last[2].add(path[1:], action, value)
+            return
+        if action in ("set_item_added", "set_item_removed"):
+            if last is not None and last[0] == action:
+                last[2] = last[2] | {value}
+                return
+            value = frozenset([value])
+        elif action in LIST_ACTIONS:
+            # Inserting or removing an item moves the items after it, the
+            # following steps can't be grouped with the previous ones.
+            self._last.clear()
+            if action == "iterable_item_added":
+                value = decode_posting(value)
+        elif action == "values_changed":
+            value = decode_value(key, value)
+        elif action not in DICT_ACTIONS:
+            raise TypeError(f"Unsupported action: {action}")
+        self._last[key] = step = [action, key, value]
+        self.steps.append(step)
+
+    def apply(self, obj: Any) -> Any:
+        if hasattr(obj, '_replace'):
+            updates = {}
+            for kind, key, arg in self.steps:
+                if kind == "values_changed":
+                    updates[key] = arg
+                    continue
+                current = updates[key] if key in updates else getattr(obj, key)
+                if kind == "child":
+                    updates[key] = arg.apply(current)
+                elif kind == "set_item_added":
+                    updates[key] = current.union(arg)
+                elif kind == "set_item_removed":
+                    updates[key] = current.difference(arg)
+                else:
+                    raise TypeError("Unsupported action/type")
+            return obj._replace(**updates)
+        if isinstance(obj, list):
+            new_list = obj[:]
+            for kind, key, arg in self.steps:
+                if kind == "child":
+                    new_list[key] = arg.apply(new_list[key])
+                elif kind == "iterable_item_removed":
+                    del new_list[key]
+                elif kind == "iterable_item_added":
+                    new_list.insert(key, arg)
+                else:
+                    raise TypeError("Unsupported action/type")
+            return new_list
+        if isinstance(obj, dict):
+            new_dict = obj.copy()
+            for kind, key, arg in self.steps:
+                if kind in ("dictionary_item_added", "values_changed"):
+                    new_dict[key] = arg
+                elif kind == "dictionary_item_removed":
+                    del new_dict[key]
+                else:
+                    raise TypeError("Unsupported action/type")
+            return new_dict
+        raise TypeError(f"Unsupported object of type {type(obj)}.")
+
+
+class DeltaPatch:
+    """
+    A delta compiled once into a tree of operations, to apply it to many
+    transactions, rebuilding each object on the changed paths once.
+    """
+    __slots__ = ("delta", "_root")
+
+    def __init__(self, delta: dict):
+        self.delta = delta = upgrade_delta(delta)
+        self._root = _Node()
+        for action, changes in delta.items():
+            for path_str, change in changes.items():
+                path = explode_path(path_str)
+                if action in LIST_ACTIONS:
+                    values = [change]
+                elif isinstance(change, dict):
+                    values = [change['new_value']]
+                elif isinstance(change, list):
+                    values = change
+                elif isinstance(change, str):
+                    values = [change]
+                else:
+                    raise TypeError("Invalid diff object")
+                for value in values:
+                    self._root.add(path, action, value)
+
+    def apply(self, obj: Any) -> Any:
+        """Return the object with the delta applied."""
+        if not self._root.steps:
+            return obj
+        return self._root.apply(obj)
+
+
+def compile_delta(delta: dict | DeltaPatch) -> DeltaPatch:
+    """Compile a delta, patches are returned as is."""
+    return delta if isinstance(delta, DeltaPatch) else DeltaPatch(delta)
+
+
+def _writes(delta: dict) -> list[tuple[tuple, str, Any, str]]:
+    """
+    Return a (path, action, value, path string) tuple for each write of the
+    delta, one per item for the set actions. Inserting or removing postings
+    writes the whole list of postings.
+    """
+    writes = []
+    for action, changes in delta.items():
+        for path_str, change in changes.items():
+            path = tuple(explode_path(path_str))
+            if action in LIST_ACTIONS:
+                writes.append((path[:-1], action, None, path_str))
+            elif action in ("set_item_added", "set_item_removed"):
+                items = change if isinstance(change, list) else [change]
+                writes.extend((path, action, item, path_str) for item in items)
+            else:
+                if action == "values_changed" and isinstance(change, dict):
+                    change = change.get("new_value")
+                writes.append((path, action, change, path_str))
+    return writes
+
+
+def _conflict(write: tuple, other: tuple) -> bool:
+    """Return True if two writes of different deltas can't both be applied."""
+    path, action, value, _ = write
+    other_path, other_action, other_value, _ = other
+    if path[:len(other_path)] != other_path and other_path[:len(path)] != path:
+        return False
+    if path != other_path or action in LIST_ACTIONS or other_action in LIST_ACTIONS:
+        # A field and a field inside it, or postings moved by an insertion
+        return True
+    if action.startswith("set_item") and other_action.startswith("set_item"):
+        return action != other_action and value == other_value
+    return action != other_action or value != other_value
+
+
+def compose_deltas(deltas: list[dict]) -> tuple[dict, list[tuple[int, int, str]]]:
+    """
+    Fold deltas into a single delta applying all of them, in order, leaving
+    out the ones that conflict with an earlier one.
+    Returns the composed delta, and a (position of the left out delta,
+    position of the delta it conflicts with, path) tuple for each conflict.
+    """
+    composed: dict[str, dict[str, Any]] = {}
+    conflicts: list[tuple[int, int, str]] = []
+    # List: (write, position of its delta) of the deltas kept so far
+    kept: list[tuple[tuple, int]] = []
+    for position, delta in enumerate(deltas):
+        writes = _writes(delta)
+        conflict = next(
+            (
+                (position, other_position, write[3])
+                for write in writes
+                for other, other_position in kept
+                if _conflict(write, other)
+            ),
+            None,
+        )
+        if conflict is not None:
+            conflicts.append(conflict)
+            continue
+        kept.extend((write, position) for write in writes)
+        for action, changes in delta.items():
+            composed_changes = composed.setdefault(action, {})
+            for path_str, change in changes.items():
+                if action in ("set_item_added", "set_item_removed"):
+                    items = composed_changes.setdefault(path_str, [])
+                    for item in change if isinstance(change, list) else [change]:
+                        if item not in items:
+                            items.append(item)
+                else:
+                    composed_changes.setdefault(path_str, change)
+    return composed, conflicts
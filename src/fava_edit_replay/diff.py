@@ -0,0 +1,190 @@
+"""Structural diff of Beancount transactions, as deltas txn_apply_delta applies."""
+
+from __future__ import annotations
+
+import datetime
+import difflib
+import re
+from bisect import bisect_right
+from decimal import Decimal
+from typing import Any, Iterable
+
+from beancount.core.number import MISSING
+from beancount.parser import parser
+
+# The actions of a delta, in the order they are applied. Changes inside
+# postings use the positions of the postings before the change, postings are
+# then removed (last first) and inserted at their new positions.
+ACTIONS = (
+    "values_changed",
+    "set_item_removed",
+    "set_item_added",
+    "dictionary_item_removed",
+    "dictionary_item_added",
+    "iterable_item_removed",
+    "iterable_item_added",
+)
+
+# Metadata set by the parser, which only depends on where the entry is
+SKIPPED_META = ("filename", "lineno")
+
+# Sources which change the state of the parser for the entries after them
+PARSER_STATE = re.compile(r"^(pushtag|poptag|pushmeta|popmeta|option)\b", re.MULTILINE)
+
+
+def encode(value: Any) -> Any:
+    """
+    Return the value as JSON data, like DeepDiff serializes it: dates and
+    numbers as strings, NamedTuples as objects and sets as sorted lists.
+    """
+    if value is None or isinstance(value, (bool, int, str)):
+        return value
+    if value is MISSING:
+        return "MISSING"
+    if isinstance(value, (Decimal, datetime.date)):
+        return str(value)
+    if hasattr(value, "_fields"):
+        return {field: encode(getattr(value, field)) for field in value._fields}
+    if isinstance(value, dict):
+        return {
+            key: encode(item) for key, item in value.items()
+            if key not in SKIPPED_META
+        }
+    if isinstance(value, (set, frozenset)):
+        return sorted(encode(item) for item in value)
+    if isinstance(value, (list, tuple)):
+        return [encode(item) for item in value]
+    return str(value)
+
+
+def _posting_key(posting: Any) -> Any:
+    return getattr(posting, "account", posting)
+
+
+class _Differ:
+    """Collects the changes between two transactions into a delta."""
+    __slots__ = ("delta",)
+
+    def __init__(self):
+        # Dict: { action: { path: change } }
+        self.delta: dict[str, dict[str, Any]] = {action: {} for action in ACTIONS}
+
+    def value(self, old: Any, new: Any, path: str) -> None:
+        if type(old) is not type(new):
+            # None to a string, an elided amount to an Amount...
+            if old != new:
+                self.delta["values_changed"][path] = {"new_value": encode(new)}
+        elif hasattr(old, "_fields"):
+            for field in old._fields:
+                self.value(getattr(old, field), getattr(new, field), f"{path}.{field}")
+        elif isinstance(old, dict):
+            self.dict(old, new, path)
+        elif isinstance(old, (set, frozenset)):
+            self.set(old, new, path)
+        elif isinstance(old, list):
+            self.list(old, new, path)
+        elif old != new:
+            self.delta["values_changed"][path] = {"new_value": encode(new)}
+
+    def dict(self, old: dict, new: dict, path: str) -> None:
+        for key, value in old.items():
+            if key in SKIPPED_META:
+                continue
+            item_path = f"{path}[{key!r}]"
+            if key not in new:
+                self.delta["dictionary_item_removed"][item_path] = encode(value)
+            else:
+                self.value(value, new[key], item_path)
+        for key, value in new.items():
+            if key not in old and key not in SKIPPED_META:
+                self.delta["dictionary_item_added"][f"{path}[{key!r}]"] = encode(value)
+
+    def set(self, old: frozenset, new: frozenset, path: str) -> None:
+        if old - new:
+            self.delta["set_item_removed"][path] = encode(old - new)
+        if new - old:
+            self.delta["set_item_added"][path] = encode(new - old)
+
+    def list(self, old: list, new: list, path: str) -> None:
+        if len(old) == len(new):
+            for i, (old_item, new_item) in enumerate(zip(old, new)):
+                self.value(old_item, new_item, f"{path}[{i}]")
+            return
+        # Items were inserted or removed, the others are matched by account
+        matcher = difflib.SequenceMatcher(
+            None, [_posting_key(item) for item in old],
+            [_posting_key(item) for item in new], autojunk=False,
+        )
+        removed = []
+        added = []
+        for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+            if tag == "equal" or tag == "replace" and i2 - i1 == j2 - j1:
+                for i, j in zip(range(i1, i2), range(j1, j2)):
+                    self.value(old[i], new[j], f"{path}[{i}]")
+            else:
+                removed.extend(range(i1, i2))
+                added.extend(range(j1, j2))
+        for i in reversed(removed):
+            self.delta["iterable_item_removed"][f"{path}[{i}]"] = encode(old[i])
+        for j in added:
+            self.delta["iterable_item_added"][f"{path}[{j}]"] = encode(new[j])
+
+
+def diff_transactions(before: Any, after: Any) -> dict[str, dict[str, Any]]:
+    """
+    Return the delta turning the transaction before into after, in the
+    schema txn_apply_delta() applies, like:
+        {
+          "values_changed": {"root.postings[0].units.number": {"new_value": "2.51"}},
+          "set_item_added": {"root.tags": ["coffee"]},
+          "iterable_item_added": {"root.postings[2]": {"account": ...}},
+        }
+    The filename and lineno metadata are ignored. Postings are compared by
+    position, or matched by account when some were added or removed.
+    """
+    differ = _Differ()
+    differ.value(before, after, "root")
+    return {action: changes for action, changes in differ.delta.items() if changes}
+
+
+def _parse_first_entries(sources: list[str]) -> list[Any | None]:
+    """
+    Parse the sources and return the first entry of each, or None if it
+    has errors. All the sources are parsed at once when possible.
+    """
+    if len(sources) > 1 and not any(PARSER_STATE.search(source) for source in sources):
+        # The line number of the first line of each source
+        starts = []
+        lineno = 1
+        for source in sources:
+            starts.append(lineno)
+            lineno += source.count("\n") + 2
+        entries, errors, _ = parser.parse_string("\n\n".join(sources))
+        if not errors:
+            firsts: list[Any | None] = [None] * len(sources)
+            for entry in entries:
+                i = bisect_right(starts, entry.meta["lineno"]) - 1
+                if firsts[i] is None:
+                    firsts[i] = entry
+            if all(first is not None for first in firsts):
+                return firsts
+    firsts = []
+    for source in sources:
+        entries, errors, _ = parser.parse_string(source)
+        firsts.append(entries[0] if entries and not errors else None)
+    return firsts
+
+
+def diff_sources(pairs: Iterable[tuple[str, str]]) -> list[dict | None]:
+    """
+    Return the delta between the transactions of each (before, after) pair
+    of sources, or None if one of them can't be parsed.
+    """
+    pairs = list(pairs)
+    befores = _parse_first_entries([before for before, _ in pairs])
+    afters = _parse_first_entries([after for _, after in pairs])
+    return [
+        diff_transactions(before, after)
+        if before is not None and after is not None else None
+        for before, after in zip(befores, afters)
+    ]
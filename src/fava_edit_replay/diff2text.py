@@ -1,8 +1,10 @@
 import re
 
+from fava_edit_replay.delta import upgrade_delta
+
 def format_diff(delta):
     """
-    Format a DeepDiff delta as a list of readable English text lines.
+    Format a delta as a list of readable English text lines.
     Args:
         delta: The delta object containing the changes
     Returns:
@@ -10,6 +12,7 @@ def format_diff(delta):
     """
     if not delta:
         return ["No changes"]
+    delta = upgrade_delta(delta)
 
     changes = []
 
@@ -17,7 +20,7 @@ def format_diff(delta):
     if "values_changed" in delta:
         for path, change in delta["values_changed"].items():
             field_name = _format_field_name(path)
-            new_value = change.get("new_value", "")
+            new_value = _format_value(change.get("new_value", ""))
             changes.append(f'{field_name} changed to "{new_value}"')
 
     # Handle set_item_added
@@ -58,8 +61,38 @@ def format_diff(delta):
             else:
                 changes.append(f'Removed {_format_field_name(path)}: "{value}"')
 
+    # Handle iterable_item_removed (postings)
+    if "iterable_item_removed" in delta:
+        for path in delta["iterable_item_removed"]:
+            changes.append(f'Removed {_format_field_name(path)}')
+
+    # Handle iterable_item_added (postings)
+    if "iterable_item_added" in delta:
+        for path, posting in delta["iterable_item_added"].items():
+            changes.append(f'Added {_format_field_name(path)}: "{_format_posting(posting)}"')
+
     return changes if changes else ["No changes"]
 
+def _format_value(value):
+    """
+    Format a new value, amounts are JSON objects like
+    {"number": "2.51", "currency": "EUR"}.
+    """
+    if value is None:
+        return ""
+    if isinstance(value, dict) and "number" in value and "currency" in value:
+        return f'{value["number"]} {value["currency"]}'
+    return value
+
+def _format_posting(posting):
+    """
+    Format a posting like {"account": "Assets:Cash", "units": {...}, ...}.
+    """
+    units = posting.get("units")
+    if isinstance(units, dict):
+        return f'{posting.get("account")} {_format_value(units)}'
+    return posting.get("account")
+
 def _format_field_name(path):
     """
     Convert a path like 'root.postings[0].units.number' to readable text.
@@ -0,0 +1,229 @@
+"""Route transactions to the replays that can possibly match them."""
+
+from __future__ import annotations
+
+from datetime import date
+from decimal import Decimal
+from time import perf_counter
+from typing import Any, Callable, Iterator
+
+from fava.beans.account import get_entry_accounts
+from fava.core.filters import LEXER, PARSE, FilterError, Match
+
+# Fields of an advanced filter that can be used to route transactions.
+TEXT_FIELDS = ("payee", "narration")
+
+
+def parse_advanced_filter(advanced_filter: str) -> Callable[[Any], bool]:
+    """
+    Return the predicate on a single entry of an advanced filter, parsed
+    like AdvancedFilter does. Raises FilterError if it is invalid.
+    """
+    tokens = LEXER.lex(advanced_filter)
+    return PARSE(lexer="NONE", tokenfunc=lambda toks=tokens: next(toks, None))
+
+
+def _required_tokens(advanced_filter: str) -> list[tuple[int, list[tuple[str, Any]]]]:
+    """
+    Return (i, tokens) for each token i of the advanced filter that every
+    matching entry has to satisfy: the filter has no alternatives (","),
+    and the token isn't negated or inside parentheses, any() or all().
+    """
+    try:
+        tokens = [(token.type, token.value) for token in LEXER.lex(advanced_filter)]
+    except FilterError:
+        return []
+    if any(type_ == "," for type_, _ in tokens):
+        return []
+    required = []
+    depth = 0
+    for i, (type_, _) in enumerate(tokens):
+        if type_ in ("(", "ANY", "ALL"):
+            depth += 1
+        elif type_ == ")":
+            depth -= 1
+        elif depth == 0 and not (i > 0 and tokens[i - 1][0] == "-"):
+            required.append((i, tokens))
+    return required
+
+
+def required_terms(advanced_filter: str) -> list[tuple[str, str]]:
+    """
+    Return the (field, value) terms on TEXT_FIELDS that every transaction
+    matching the advanced filter matches: the top-level terms joined by "and".
+    """
+    terms = []
+    for i, tokens in _required_tokens(advanced_filter):
+        type_, value = tokens[i]
+        if type_ == "KEY" and value in TEXT_FIELDS:
+            operand = tokens[i + 1:i + 3]
+            if [t for t, _ in operand] == ["EQ_OP", "STRING"]:
+                terms.append((value, operand[1][1]))
+    return terms
+
+
+def required_amounts(advanced_filter: str) -> list[tuple[str, Decimal]]:
+    """
+    Return the (operator, number) amount terms, like "=12" or ">100", that
+    every transaction matching the advanced filter has to match: one of its
+    postings has units whose absolute number compares to the number. Same
+    rules as required_terms().
+    """
+    amounts = []
+    for i, tokens in _required_tokens(advanced_filter):
+        type_, value = tokens[i]
+        if type_ == "CMP_OP" and not (i > 0 and tokens[i - 1][0] == "KEY"):
+            operand = tokens[i + 1:i + 2]
+            if [t for t, _ in operand] == ["NUMBER"]:
+                amounts.append((value, operand[0][1]))
+    return amounts
+
+
+class ReplayDispatch:
+    """
+    Index of compiled replays, giving for each transaction the bitmask of the
+    replays that could match it, going by their account, date range and
+    required payee and narration terms. The other replays are run in bulk,
+    see filter_bulk().
+    """
+
+    def __init__(self, replays: list[Any]):
+        self.replays = replays
+        # The advanced filter predicate of each replay, the other filters are
+        # fully decided by the bitmasks.
+        self._includes: list[Callable[[Any], bool] | None] = []
+        self._all = 0
+        # Lists: [(bit, predicate on the value of the field)]
+        self._accounts: list[tuple[int, Callable[[str], bool]]] = []
+        self._dates: list[tuple[int, date, date]] = []
+        # Dict: { field: [(bit, [Match of each required term])] }
+        self._texts: dict[str, list[tuple[int, list[Match]]]] = {
+            field: [] for field in TEXT_FIELDS
+        }
+        # Bitmasks of the replays not filtering on a field.
+        self._no_account = self._no_date = 0
+        self._no_text = dict.fromkeys(TEXT_FIELDS, 0)
+        # Positions of the replays only checked by their advanced filter
+        self.bulk: list[int] = []
+        # Dict: { position of a bulk replay: ids of the transactions it matched }
+        self._hits: dict[int, set[int]] = {}
+        self.evaluated = [0] * len(replays)
+        self.filter_seconds = [0.0] * len(replays)
+
+        for i, replay in enumerate(replays):
+            bit = 1 << i
+            self._includes.append(replay.advanced_include)
+            if replay.skipped:
+                continue
+            self._all |= bit
+            if replay.account_match:
+                self._accounts.append((bit, replay.account_match))
+            else:
+                self._no_account |= bit
+            if replay.date_range:
+                self._dates.append((bit, *replay.date_range))
+            else:
+                self._no_date |= bit
+            terms = required_terms(replay.replay.advanced_filter or "")
+            for field in TEXT_FIELDS:
+                matches = [Match(value) for name, value in terms if name == field]
+                if matches:
+                    self._texts[field].append((bit, matches))
+                else:
+                    self._no_text[field] |= bit
+            if not (replay.account_match or replay.date_range or terms):
+                self.bulk.append(i)
+
+        # Dicts: { value of the field: bitmask }
+        self._account_masks: dict[str, int] = {}
+        self._date_masks: dict[date, int] = {}
+        self._text_masks: dict[str, dict[str, int]] = {field: {} for field in TEXT_FIELDS}
+
+    def _account_mask(self, name: str) -> int:
+        mask = self._account_masks.get(name)
+        if mask is None:
+            mask = 0
+            for bit, match in self._accounts:
+                if match(name):
+                    mask |= bit
+            self._account_masks[name] = mask
+        return mask
+
+    def _date_mask(self, txn_date: date) -> int:
+        mask = self._date_masks.get(txn_date)
+        if mask is None:
+            mask = self._no_date
+            for bit, begin, end in self._dates:
+                if begin <= txn_date < end:
+                    mask |= bit
+            self._date_masks[txn_date] = mask
+        return mask
+
+    def _text_mask(self, field: str, value: str) -> int:
+        masks = self._text_masks[field]
+        mask = masks.get(value)
+        if mask is None:
+            mask = self._no_text[field]
+            for bit, matches in self._texts[field]:
+                if all(match(value) for match in matches):
+                    mask |= bit
+            masks[value] = mask
+        return mask
+
+    def candidates(self, txn: Any) -> int:
+        """Return the bitmask of the replays that could match the transaction."""
+        mask = self._all & self._date_mask(txn.date)
+        if not mask:
+            return 0
+        accounts = self._no_account
+        for name in get_entry_accounts(txn):
+            accounts |= self._account_mask(name)
+        mask &= accounts
+        for field in TEXT_FIELDS:
+            if not mask:
+                break
+            mask &= self._text_mask(field, getattr(txn, field) or "")
+        return mask
+
+    def filter_bulk(self, masks: list[tuple[Any, int]]) -> None:
+        """
+        Filter the (transaction, bitmask of its candidates) of masks with
+        each bulk replay at once, the transactions it matches are then looked
+        up by iter_matches().
+        """
+        for i in self.bulk:
+            bit = 1 << i
+            txns = [txn for txn, mask in masks if mask & bit]
+            start = perf_counter()
+            self._hits[i] = {id(txn) for txn in self.replays[i].filter(txns)}
+            self.filter_seconds[i] += perf_counter() - start
+            self.evaluated[i] += len(txns)
+
+    def iter_matches(self, txn: Any, mask: int) -> Iterator[Any]:
+        """Yield the replays of the bitmask that match the transaction, in order."""
+        while mask:
+            bit = mask & -mask
+            i = bit.bit_length() - 1
+            mask ^= bit
+            hits = self._hits.get(i)
+            if hits is not None:
+                if id(txn) in hits:
+                    yield self.replays[i]
+                continue
+            include = self._includes[i]
+            if include is None:
+                yield self.replays[i]
+                continue
+            start = perf_counter()
+            included = include(txn)
+            self.filter_seconds[i] += perf_counter() - start
+            self.evaluated[i] += 1
+            if included:
+                yield self.replays[i]
+
+    def first_match(self, txn: Any, mask: int) -> Any | None:
+        """
+        Return the first replay of the bitmask that matches the transaction,
+        or None.
+        """
+        return next(self.iter_matches(txn, mask), None)
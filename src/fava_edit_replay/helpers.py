@@ -4,27 +4,51 @@ from __future__ import annotations
 
 from beancount.parser import parser
 from beancount.core.number import MISSING
-import re
+import difflib
+import os
 import logging
 
 from pathlib import Path
 import json
-from typing import Any
-from fava.core.filters import AccountFilter, AdvancedFilter, TimeFilter
+from concurrent.futures import ProcessPoolExecutor, as_completed, wait
+from time import perf_counter
+from functools import lru_cache
+from typing import Any, Callable, Iterable, Iterator, NamedTuple
+from beancount.core import account
+from fava.core.filters import AccountFilter, AdvancedFilter, Match, TimeFilter
+from fava.beans.account import get_entry_accounts
 from fava.beans.abc import Transaction
-from fava.core.file import get_entry_slice, find_entry_lines
 from fava.beans.str import to_string
 from fava.beans.funcs import get_position
+from fava.core.file import GeneratedEntryError
 
+from fava_edit_replay.columns import TransactionTable
+from fava_edit_replay.delta import DeltaPatch, compile_delta, compose_deltas, upgrade_delta
+from fava_edit_replay.dispatch import ReplayDispatch, parse_advanced_filter
+from fava_edit_replay.index import MatchIndex, replay_key
 from fava_edit_replay.replay import Replay
+from fava_edit_replay.rewrite import (
+    JournalError,
+    Splice,
+    commit_files,
+    journal_path_for,
+    write_spliced_tmp,
+)
+from fava_edit_replay.source import SourceCache, SourceFile
+from fava_edit_replay.stats import ReplayStats, StageTimer
 
 logger = logging.getLogger("edit_replay.helpers")
 logger.setLevel(logging.INFO)
 
+# Number of parsed transaction sources kept by parse_slice(), so that the
+# dry run and repeated runs don't parse the unchanged ones again
+PARSED_SLICES = 4096
+
 
 def txn_apply_delta(obj, delta):
     """
-    Apply a DeepDiff Delta to a beancount transaction.
+    Apply a delta, as computed by diff.diff_transactions(), to a beancount
+    transaction.
 
     Args:
         obj: The transaction to which the delta will be applied.
@@ -42,7 +66,13 @@ def txn_apply_delta(obj, delta):
                  "dictionary_item_removed": {
                    "root.meta['note']": "yeah"
                  },
+                 "iterable_item_removed": { "root.postings[1]": {...} },
+                 "iterable_item_added": {
+                   "root.postings[1]": { "account": "Assets:Cash", ... }
+                 },
                }
+               or a DeltaPatch compiled from it, to apply the same delta to
+               many transactions.
  
     Returns:
         The modified transaction after applying the delta.
@@ -50,94 +80,11 @@ def txn_apply_delta(obj, delta):
     Beancount transactions are NamedTuples, which can contain List[] or 
     fronzensets, or other NamedTuples, recursively. Since NamedTuples are 
     immutable, we use ._replace() to return a new NamedTuple with the desired 
-    changes. We use a recursive algorithm:
-      - start by splitting the diff path "root.postings[0].units.number" into 
-        [ "root", "postings", 0, "number"]
-      - if len(list) > 1: Do a recursive call, obj is now the first element 
-        element in the list, accessed with getattr or [], and update the 
-        current object with the result of the recursive call.
-      - if len(list) = 1: We have arrived at the "leaf" of the tree, Update 
-        the current obj according to the different cases.
-    """
-
-    def _apply_recursive(current_obj, path_parts, value, action):
-        key = path_parts[0]
-        remaining_path = path_parts[1:]
-
-        if not remaining_path:  # Base case: last part of the path
-            is_namedtuple = hasattr(current_obj, '_replace')
-            if action == "dictionary_item_added" and isinstance(current_obj, dict):
-                return {**current_obj, key: value}
-            if action == "dictionary_item_removed" and isinstance(current_obj, dict):
-                new_dict = current_obj.copy()
-                del new_dict[key]
-                return new_dict
-            if is_namedtuple and action == "values_changed":
-                return current_obj._replace(**{key: value})
-            elif is_namedtuple and action == "set_item_added":
-                newset = getattr(current_obj, key).union({value})
-                return current_obj._replace(**{key: newset})
-            elif is_namedtuple and action == "set_item_removed":
-                newset = getattr(current_obj, key).difference({value})
-                return current_obj._replace(**{key: newset})
-            else:
-                raise TypeError(f"Unsupported action/type")
-
-        if isinstance(key, int):
-            child_obj = current_obj[key]
-        else:
-            child_obj = getattr(current_obj, key)
-
-        modified_child = _apply_recursive(child_obj, remaining_path, value, action)
-
-        if isinstance(current_obj, list):
-            new_list = current_obj[:]
-            new_list[key] = modified_child
-            return new_list
-        elif hasattr(current_obj, '_replace'):
-            return current_obj._replace(**{key: modified_child})
-        else:
-            raise TypeError(f"Unsuported object of type {type(current_obj)}.")
-
-    def explode_path(path_str):
-        """ 
-        Split a path string into a list of path parts.
-        explode_path('root.postings[0].units.number') -> ['postings', 0, 'number'] 
-        """
-        path_parts = [p for p in re.split(r'[.[\]\']+', path_str) if p]
-
-        def try_int(s):
-            try:
-                return int(s)
-            except ValueError:
-                return s
-
-        typed_path_parts = [try_int(p) for p in path_parts]
-
-        if typed_path_parts and typed_path_parts[0] == 'root':
-            typed_path_parts = typed_path_parts[1:]
-
-        return typed_path_parts 
-
-    def handle_single_delta(obj, path_str, change, action):
-        typed_path_parts = explode_path(path_str)
-
-        if isinstance(change, dict):
-            return _apply_recursive(obj, typed_path_parts, change['new_value'], action) 
-        elif isinstance(change, list):
-            for item in change:
-                 obj = _apply_recursive(obj, typed_path_parts, item, action)
-            return obj
-        elif isinstance(change, str):
-            return _apply_recursive(obj, typed_path_parts, change, action) 
-        else:
-            raise TypeError("Invalid diff object")
-
-    for action in delta.keys():
-        for path, change_obj in delta[action].items():
-            obj = handle_single_delta(obj, path, change_obj, action)
-
-    return obj 
+    changes. The paths of the delta, like "root.postings[0].units.number",
+    are split and grouped into a tree of operations by compile_delta(), see
+    DeltaPatch.
+    """
+    return compile_delta(delta).apply(obj)
 
 
 def make_filter_suggestions(slice_str: str) -> list[dict]:
@@ -188,95 +135,794 @@ def make_filter_suggestions(slice_str: str) -> list[dict]:
     return result
 
 
-def transaction_matches_replay(txn, replay, options_map=None, fava_options=None):
-    time_filter = replay.time_filter
-    account_filter = replay.account_filter
-    filter_string = replay.advanced_filter
-    if not (account_filter or filter_string or time_filter):
-        return False  # Don't allow global replays
-    filters = []
-    if time_filter and options_map and fava_options:
-        filters.append(TimeFilter(options_map, fava_options, time_filter))
-    if account_filter:
-        filters.append(AccountFilter(account_filter))
-    if filter_string:
-        filters.append(AdvancedFilter(filter_string))
-    for filter_obj in filters:
-        entries = [txn]
-        filtered_entries = filter_obj.apply(entries)
-        if txn not in filtered_entries:
+class CompiledReplay:
+    """
+    A Replay with its filters parsed and its diff decoded once, to match it
+    against many transactions.
+    """
+
+    def __init__(self, replay: Replay, options_map=None, fava_options=None):
+        self.replay = replay
+        self.delta: dict = {}
+        self.patch: DeltaPatch | None = None
+        # Why the diff can't be applied, if it can't
+        self.error: str | None = None
+        try:
+            self.delta = upgrade_delta(json.loads(replay.diff))
+            self.patch = DeltaPatch(self.delta)
+        except (ValueError, TypeError, KeyError) as e:
+            self.error = f"{type(e).__name__}: {e}"
+            logger.error(f"Skipping replay #{replay.lineno}, its diff can't be applied: {self.error}")
+        self.predicates = []
+        # Don't allow global replays
+        self.is_global = not (
+            replay.account_filter or replay.advanced_filter or replay.time_filter
+        )
+        # Global replays and replays with an invalid diff match nothing
+        self.skipped = self.is_global or self.error is not None
+        self.account_filter = None
+        self.advanced_filter = None
+        self.date_range = None
+        # Predicates on a single account name and on an entry, used by
+        # ReplayDispatch.
+        self.account_match = None
+        self.advanced_include = None
+        if replay.account_filter:
+            account_filter = replay.account_filter
+            match = Match(account_filter)
+            self.account_filter = AccountFilter(account_filter)
+            account_match = lambda name: (
+                account.has_component(name, account_filter) or match(name)
+            )
+            self.account_match = account_match
+            self.predicates.append(
+                lambda entry: any(
+                    account_match(name) for name in get_entry_accounts(entry)
+                )
+            )
+        if replay.advanced_filter:
+            self.advanced_filter = AdvancedFilter(replay.advanced_filter)
+            include = parse_advanced_filter(replay.advanced_filter)
+            self.advanced_include = include
+            self.predicates.append(include)
+        if replay.time_filter and options_map and fava_options:
+            time_filter = TimeFilter(options_map, fava_options, replay.time_filter)
+            begin, end = time_filter.date_range.begin, time_filter.date_range.end
+            self.date_range = (begin, end)
+            self.predicates.append(lambda entry: begin <= entry.date < end)
+
+    def matches(self, txn) -> bool:
+        """Return True if all the filters of the replay match the transaction."""
+        if self.skipped:
             return False
-    return True
+        return all(predicate(txn) for predicate in self.predicates)
+
+    def filter(self, txns: list) -> list:
+        """
+        Return the transactions matching all the filters of the replay, running
+        each filter once over the whole list like FavaLedger.get_filtered does.
+        The time filter only keeps the transactions in the date range, Fava's
+        TimeFilter would also summarize the entries before it, which we don't
+        need here.
+        """
+        if self.skipped:
+            return []
+        if self.account_filter:
+            txns = self.account_filter.apply(txns)
+        if self.advanced_filter:
+            txns = self.advanced_filter.apply(txns)
+        if self.date_range:
+            begin, end = self.date_range
+            txns = [txn for txn in txns if begin <= txn.date < end]
+        return txns
+
+
+def compile_replays(
+        replays: list[Replay | CompiledReplay],
+        options_map: Any = None,
+        fava_options: Any = None,
+    ) -> list[CompiledReplay]:
+    """Compile a list of replays, replays that are already compiled are kept."""
+    return [
+        replay if isinstance(replay, CompiledReplay)
+        else CompiledReplay(replay, options_map, fava_options)
+        for replay in replays
+    ]
+
+
+def match_replays(
+        replays: list[CompiledReplay],
+        txns: list,
+        candidates: dict[int, int] | None = None,
+        dispatch: ReplayDispatch | None = None,
+        compose: bool = False,
+    ) -> dict[int, Any]:
+    """
+    Match the transactions against the replays, in order, with a
+    ReplayDispatch. candidates restricts each transaction to some replays,
+    { id(txn): bitmask of their positions }, see MatchIndex.plan().
+    Returns { id(txn): first matching replay }, or all of them with compose.
+    """
+    if dispatch is None:
+        dispatch = ReplayDispatch(replays)
+    masks: list[tuple[Any, int]] = []
+    for txn in txns:
+        if candidates is None:
+            mask = dispatch.candidates(txn)
+        else:
+            mask = candidates[id(txn)]
+            if mask:
+                mask &= dispatch.candidates(txn)
+        if mask:
+            masks.append((txn, mask))
+    dispatch.filter_bulk(masks)
+    matches: dict[int, Any] = {}
+    for txn, mask in masks:
+        if compose:
+            matching = list(dispatch.iter_matches(txn, mask))
+            if matching:
+                matches[id(txn)] = matching
+            continue
+        replay = dispatch.first_match(txn, mask)
+        if replay is not None:
+            matches[id(txn)] = replay
+    return matches
+
+
+def transaction_matches_replay(txn, replay, options_map=None, fava_options=None):
+    if not isinstance(replay, CompiledReplay):
+        replay = CompiledReplay(replay, options_map, fava_options)
+    return replay.matches(txn)
+
+
+class EntryChange(NamedTuple):
+    """A transaction rewritten by apply_replays."""
+    entry: Any    # the transaction, as loaded before the run
+    start: int    # 0-based index of its first line in its file, before the run
+    end: int      # 0-based index of the line after its last line, before the run
+    text: str     # its new source, ending with a newline
+    delta: dict   # the delta of the replay that was applied to it
+
+    @property
+    def filename(self) -> str:
+        return get_position(self.entry)[0]
+
+
+class ReplayPreview(NamedTuple):
+    """A transaction that a replay would rewrite, see preview_replays."""
+    filename: str
+    lineno: int     # line of the transaction in its file
+    diff: str       # unified diff of the source of the transaction
+    replay: Replay  # the replay that matched
+
+
+class ReplayResult(NamedTuple):
+    """The result of apply_replays."""
+    changes: list[EntryChange]  # the rewritten transactions, in file order
+    stats: ReplayStats | None = None  # timers and counters of the run
+    # Dict: { rewritten file: (mtime_ns, size) once rewritten }
+    stamps: dict[str, tuple[int, int] | None] | None = None
+
+    @property
+    def modified_count(self) -> int:
+        return len(self.changes)
+
+    @property
+    def files(self) -> list[str]:
+        """The rewritten files."""
+        return list(dict.fromkeys(change.filename for change in self.changes))
+
+
+@lru_cache(maxsize=PARSED_SLICES)
+def parse_slice(original_slice: str) -> Any:
+    """
+    Parse the source of a transaction and return the transaction, or None if
+    it can't be parsed. Cached by source, the result only depends on it.
+    """
+    entries, errors, _ = parser.parse_string(original_slice)
+    return entries[0] if entries and not errors else None
+
+
+def modified_source(
+        original_slice: str,
+        delta: dict | DeltaPatch,
+        currency_column: int,
+        indent: int,
+        timings: dict[str, float] | None = None,
+    ) -> str | None:
+    """
+    Apply the delta to the source of a transaction and return the new source,
+    or None if the source can't be parsed.
+    The time spent in each stage is added to timings, see stats.STAGES.
+    """
+    if timings is None:
+        timings = {}
+    with StageTimer(timings, "parse"):
+        parsed_txn = parse_slice(original_slice)
+    if parsed_txn is None:
+        return None
+    with StageTimer(timings, "delta"):
+        modified_txn = txn_apply_delta(parsed_txn, delta)
+    with StageTimer(timings, "render"):
+        return to_string(modified_txn, currency_column, indent).rstrip()
+
+
+def rewrite_file(
+        filename: str,
+        items: list[tuple[int, int]],
+        deltas: list[dict],
+        currency_column: int,
+        indent: int,
+    ) -> tuple[str | None, list[tuple[int, int, int, str, str]], dict]:
+    """
+    Apply the deltas to the transactions of a single ledger file and write the
+    rewritten file to a temporary file. This runs in worker processes when
+    apply_replays is given jobs > 1, so it only takes and returns plain data.
+
+    Args:
+        items: (line number, index of the delta in deltas) of each matched
+               transaction of the file, in file order.
+    Returns:
+        The path of the temporary file (None if nothing changed), for each
+        change a (line number, start, end, new source, original source) tuple,
+        and the stats of the file: filename, transactions, modified,
+        parse_failures (line numbers of the transactions that couldn't be
+        parsed), bytes_written, seconds and the seconds of each stage.
+    """
+    started = perf_counter()
+    timings: dict[str, float] = {}
+    changes = []
+    parse_failures = []
+    tmp_path = None
+    source = SourceFile(filename)
+    # Dict: { index of the delta: DeltaPatch }, compiled here as they can't
+    # be sent to worker processes.
+    patches: dict[int, DeltaPatch] = {}
+    try:
+        for lineno, delta_index in items:
+            with StageTimer(timings, "slice"):
+                original_slice = "".join(source.entry_lines(lineno - 1)).rstrip("\n")
+            patch = patches.get(delta_index)
+            if patch is None:
+                with StageTimer(timings, "compile"):
+                    patch = patches[delta_index] = DeltaPatch(deltas[delta_index])
+            modified_slice = modified_source(
+                original_slice, patch, currency_column, indent, timings,
+            )
+            if modified_slice is None:
+                parse_failures.append(lineno)
+            elif original_slice != modified_slice:
+                start, end = source.entry_range(lineno - 1)
+                changes.append(
+                    (lineno, start, end, modified_slice + '\n', original_slice)
+                )
+        if changes:
+            splices = [Splice(start, end, text) for _, start, end, text, _ in changes]
+            with StageTimer(timings, "write"):
+                tmp_path = write_spliced_tmp(source, splices)
+    finally:
+        source.close()
+    stats = {
+        "filename": filename,
+        "transactions": len(items),
+        "modified": len(changes),
+        "parse_failures": parse_failures,
+        "bytes_written": os.path.getsize(tmp_path) if tmp_path else 0,
+        "seconds": perf_counter() - started,
+        "stages": timings,
+    }
+    return tmp_path, changes, stats
+
+
+def _rewrite_files(
+        tasks: list[tuple],
+        jobs: int,
+        on_file: Callable[[tuple], None] | None = None,
+    ) -> list[tuple]:
+    """
+    Run rewrite_file on all the tasks, in up to jobs worker processes, and
+    return the results in the order of the tasks. on_file is called with the
+    result of each task as it finishes. If a task or on_file fails, the
+    remaining tasks are cancelled and all the temporary files are removed.
+    """
+    def remove_tmp_files(results):
+        for tmp_path, *_ in results:
+            if tmp_path:
+                os.unlink(tmp_path)
+
+    if jobs <= 1 or len(tasks) <= 1:
+        results = []
+        try:
+            for task in tasks:
+                results.append(rewrite_file(*task))
+                if on_file:
+                    on_file(results[-1])
+        except BaseException:
+            remove_tmp_files(results)
+            raise
+        return results
+
+    with ProcessPoolExecutor(max_workers=min(jobs, len(tasks))) as executor:
+        futures = [executor.submit(rewrite_file, *task) for task in tasks]
+        try:
+            for future in as_completed(futures):
+                result = future.result()
+                if on_file:
+                    on_file(result)
+        except BaseException:
+            for future in futures:
+                future.cancel()
+            wait(futures)
+            remove_tmp_files(
+                future.result() for future in futures
+                if not future.cancelled() and not future.exception()
+            )
+            raise
+    return [future.result() for future in futures]
+
+
+def match_transactions(replays: list[CompiledReplay], entries: Any) -> list[tuple[Any, CompiledReplay]]:
+    """
+    Match the replays against the transactions in entries and return the
+    (transaction, first matching replay) pairs, in file order.
+    """
+    txns = [e for e in entries if isinstance(e, Transaction)]
+    txns.sort(key=get_position)
+    matched = match_replays(replays, txns)
+    return [(txn, matched[id(txn)]) for txn in txns if id(txn) in matched]
+
+
+def preview_match(
+        txn: Any,
+        replay: CompiledReplay,
+        fava_options: Any,
+        sources: SourceCache,
+    ) -> ReplayPreview | None:
+    """
+    Return the ReplayPreview of a transaction matched by the replay, or None
+    if the replay wouldn't change it.
+    """
+    original_slice = sources.entry_slice(txn)
+    modified_slice = modified_source(
+        original_slice, replay.patch, fava_options.currency_column, fava_options.indent,
+    )
+    if modified_slice is None or original_slice == modified_slice:
+        return None
+    filename, lineno = get_position(txn)
+    diff = difflib.unified_diff(
+        (original_slice + '\n').splitlines(keepends=True),
+        (modified_slice + '\n').splitlines(keepends=True),
+        fromfile=f"{filename}:{lineno}",
+        tofile=f"{filename}:{lineno}",
+    )
+    return ReplayPreview(filename, lineno, ''.join(diff), replay.replay)
+
+
+def preview_replays(
+        replays: list[Replay | CompiledReplay],
+        entries: Any,
+        options_map: Any,
+        fava_options: Any,
+    ) -> Iterator[ReplayPreview]:
+    """
+    Dry run of apply_replays: yield a ReplayPreview for each transaction that
+    would be rewritten, as soon as it is found, without writing anything.
+    """
+    compiled_replays = compile_replays(replays, options_map, fava_options)
+    with SourceCache() as sources:
+        for txn, replay in match_transactions(compiled_replays, entries):
+            preview = preview_match(txn, replay, fava_options, sources)
+            if preview is not None:
+                yield preview
+
+
+class DryRun:
+    """
+    A dry run shown one page at a time: the transactions are matched once,
+    then each page only renders the previews it is missing.
+    """
+
+    def __init__(
+            self,
+            replays: list[Replay | CompiledReplay],
+            entries: Any,
+            options_map: Any,
+            fava_options: Any,
+        ):
+        self.fava_options = fava_options
+        compiled_replays = compile_replays(replays, options_map, fava_options)
+        self.matches = match_transactions(compiled_replays, entries)
+        self.previews: list[ReplayPreview] = []
+        self._position = 0  # of the next match to preview
+
+    def page(self, offset: int, limit: int) -> list[ReplayPreview]:
+        """Return the previews [offset, offset + limit[, fewer on the last page."""
+        end = offset + limit
+        if len(self.previews) < end and self._position < len(self.matches):
+            with SourceCache() as sources:
+                while len(self.previews) < end and self._position < len(self.matches):
+                    txn, replay = self.matches[self._position]
+                    self._position += 1
+                    preview = preview_match(txn, replay, self.fava_options, sources)
+                    if preview is not None:
+                        self.previews.append(preview)
+        return self.previews[offset:end]
+
+
+class _DeltaTable:
+    """
+    The deltas sent to rewrite_file(): the delta of each replay, followed by
+    the deltas composed for the combinations of replays matching the same
+    transactions, see apply_replays(compose=True).
+    """
+
+    def __init__(
+            self,
+            replays: list[CompiledReplay],
+            timings: dict[str, float],
+            log: Callable[[str], None],
+        ):
+        self.replays = replays
+        self.timings = timings
+        self.log = log
+        self.deltas = [replay.delta for replay in replays]
+        self.positions = {id(replay): i for i, replay in enumerate(replays)}
+        # The positions of the replays applied by each delta
+        self.delta_replays = [[i] for i in range(len(replays))]
+        # Dict: { positions of the matching replays: (index of their composed
+        # delta, positions of the replays left out) }
+        self.composed: dict[tuple[int, ...], tuple[int, list[int]]] = {}
+        # Number of transactions each replay was left out of
+        self.conflicts = [0] * len(replays)
+
+    def index(self, match: Any) -> int:
+        """
+        Return the index of the delta of a match of match_replays(): a
+        replay, or a list of replays with compose.
+        """
+        if not isinstance(match, list):
+            return self.positions[id(match)]
+        positions = tuple(self.positions[id(replay)] for replay in match)
+        if positions not in self.composed:
+            with StageTimer(self.timings, "compose"):
+                self.composed[positions] = self._compose(positions)
+        i, left_out = self.composed[positions]
+        for position in left_out:
+            self.conflicts[position] += 1
+        return i
+
+    def _compose(self, positions: tuple[int, ...]) -> tuple[int, list[int]]:
+        """
+        Compose the deltas of the replays at positions, appending the composed
+        delta to deltas, and log the conflicts.
+        Returns the index of the delta in deltas and the positions of the
+        replays left out.
+        """
+        delta, conflicts = compose_deltas([self.deltas[position] for position in positions])
+        left_out = []
+        for i, other, path in conflicts:
+            left_out.append(positions[i])
+            # Logging: Conflict: replay #{lineno} changes {path} like replay #{lineno}
+            self.log(
+                f"Conflict: replay #{self.replays[positions[i]].replay.lineno} changes {path} "
+                f"like replay #{self.replays[positions[other]].replay.lineno}, skipping it "
+                "on the transactions both match"
+            )
+        kept = [position for position in positions if position not in left_out]
+        if len(kept) == 1:
+            return kept[0], left_out
+        self.deltas.append(delta)
+        self.delta_replays.append(kept)
+        return len(self.deltas) - 1, left_out
+
+    def replay_stats(self, dispatch: ReplayDispatch) -> list[dict[str, Any]]:
+        """Return the counters of each replay, see ReplayStats.replays."""
+        return [
+            {
+                "lineno": replay.replay.lineno,
+                "diff_readable": replay.replay.diff_readable,
+                "evaluated": dispatch.evaluated[i],
+                "filter_seconds": dispatch.filter_seconds[i],
+                "matched": 0,
+                "modified": 0,
+                "parse_failures": 0,
+                "conflicts": self.conflicts[i],
+            }
+            for i, replay in enumerate(self.replays)
+        ]
+
+    def count_matches(self, matched: dict[int, Any], replay_stats: list[dict]) -> None:
+        for match in matched.values():
+            for replay in match if isinstance(match, list) else [match]:
+                replay_stats[self.positions[id(replay)]]["matched"] += 1
+
+
+def _file_changes(
+        items: dict[int, tuple[Any, int]],
+        result: tuple,
+        table: _DeltaTable,
+        replay_stats: list[dict],
+        timings: dict[str, float],
+        log: Callable[[str], None],
+    ) -> tuple[list[EntryChange], dict[str, Any]]:
+    """
+    Count and log the result of rewrite_file() on the items of a file,
+    { lineno: (txn, index of its delta) }.
+    Returns the changes and the stats of the file, see ReplayStats.files.
+    """
+    _, file_changes, stats = result
+    for stage, seconds in stats.pop("stages").items():
+        timings[stage] = timings.get(stage, 0.0) + seconds
+    for lineno in stats["parse_failures"]:
+        for position in table.delta_replays[items[lineno][1]]:
+            replay_stats[position]["parse_failures"] += 1
+    stats["parse_failures"] = len(stats["parse_failures"])
+    changes = []
+    for lineno, start, end, text, original_slice in file_changes:
+        # Logging: Match: {lineno} [{first_line_capped}]
+        first_line_capped = original_slice.splitlines()[0][:70].ljust(70)
+        log(f"Match: #{str(lineno).ljust(6)} [{first_line_capped}]")
+        txn, i = items[lineno]
+        for position in table.delta_replays[i]:
+            replay_stats[position]["modified"] += 1
+        changes.append(EntryChange(txn, start, end, text, table.deltas[i]))
+    return changes, stats
+
+
+def _check_journal(journal_path: str | None, options_map: Any) -> str | None:
+    """
+    Return the path of the journal of a run, and raise a JournalError if the
+    journal of an interrupted run is in the way.
+    """
+    if journal_path is None and options_map and options_map.get('filename'):
+        journal_path = journal_path_for(options_map['filename'])
+    if journal_path and os.path.exists(journal_path):
+        raise JournalError(
+            f"Found the journal of an interrupted run: {journal_path}, "
+            "it has to be recovered first."
+        )
+    return journal_path
 
 
 def apply_replays(
-        replays: list[Replay], 
+        replays: list[Replay | CompiledReplay], 
         entries: Any, 
         options_map: Any, 
         fava_options: Any, 
-        verbose: bool = False
-    ) -> int:
+        verbose: bool = False,
+        journal_path: str | None = None,
+        jobs: int = 1,
+        match_index: MatchIndex | None = None,
+        progress: Callable[[dict], None] | None = None,
+        columnar: bool = False,
+        compose: bool = False,
+        stamps: dict[str, tuple[int, int] | None] | None = None,
+    ) -> ReplayResult:
     """
-    Apply a list of replays to a FavaLedger or FilteredLedger, modifying the in-memory
-    lines of all relevant ledger files, and write all changes to disk at the end.
-    Returns the number of modified transactions.
+    Apply the replays to the entries and rewrite the changed files, in up to
+    jobs worker processes, then replace them all at once, see commit_files().
+    match_index skips what didn't change since its run, progress gets the
+    counters of the run and can raise to cancel it, compose applies all the
+    replays matching a transaction, and stamps refuse files changed since
+    they were loaded. Returns a ReplayResult.
     """
     def log(msg: str):
         if verbose: print(msg)
 
-    # Dict: { filename: [lines] }
-    file_lines: dict[str, list[str]] = {}
-    # Dict: { filename: set(line numbers that were changed) }
-    file_changed: dict[str, set[int]] = {}
-    modified_count = 0
-
-    # Sort transactions in reverse line order for safe in-place editing
-    txns = [e for e in entries if isinstance(e, Transaction)]
-    txns.sort(key=lambda t: (get_position(t)[0], -get_position(t)[1]))
+    started = perf_counter()
+    timings: dict[str, float] = {}
+
+    journal_path = _check_journal(journal_path, options_map)
+    if compose and match_index is not None:
+        raise ValueError("The match index can't be used to compose replays")
+
+    with StageTimer(timings, "compile"):
+        compiled_replays = compile_replays(replays, options_map, fava_options)
+        table = _DeltaTable(compiled_replays, timings, log)
+
+    with StageTimer(timings, "match"):
+        txns = [e for e in entries if isinstance(e, Transaction)]
+        txns.sort(key=get_position)
+        dispatch = ReplayDispatch(compiled_replays)
+        candidates = None
+        if columnar:
+            candidates = TransactionTable(txns).candidates(compiled_replays)
+        if match_index is not None:
+            replay_keys = [replay_key(replay) for replay in compiled_replays]
+            txn_keys, index_candidates, settled = match_index.plan(txns, replay_keys)
+            skipped = sum(1 for mask in index_candidates.values() if not mask)
+            if skipped:
+                log(f"Skipped {skipped} transactions already matched by a previous run")
+            if candidates is None:
+                candidates = index_candidates
+            else:
+                for key, mask in index_candidates.items():
+                    candidates[key] &= mask
+        matched = match_replays(compiled_replays, txns, candidates, dispatch, compose)
 
+    # Dict: { filename: { lineno: (txn, index of its delta) } }
+    file_txns: dict[str, dict[int, tuple[Any, int]]] = {}
     for txn in txns:
+        match = matched.get(id(txn))
+        if match is None:
+            continue
         filename, lineno = get_position(txn)
-        applied = False
-        for replay in replays:
-            diff_dict = json.loads(replay.diff)
-            if transaction_matches_replay(txn, replay, options_map, fava_options):
-                original_slice, _ = get_entry_slice(txn)
-                parsed_entries, errors, _ = parser.parse_string(original_slice)
-                if errors or not parsed_entries:
-                    break
-                parsed_txn = parsed_entries[0]
-                modified_txn = txn_apply_delta(parsed_txn, diff_dict)
-                applied = True
-                break  # Only apply the first matching replay for this txn
-        if applied:
-            if filename not in file_lines:
-                with open(filename, 'r', encoding='utf-8') as f:
-                    file_lines[filename] = f.readlines()
-                file_changed[filename] = set()
-            currency_column = fava_options.currency_column
-            indent = fava_options.indent
-            modified_slice = to_string(modified_txn, currency_column, indent).rstrip()
-            lines = file_lines[filename]
-            entry_lines = find_entry_lines(lines, lineno - 1)
-            entry_len = len(entry_lines)
-            original_slice, _ = get_entry_slice(txn)
-            if original_slice != modified_slice:
-                # Logging: Match: {lineno} [{first_line_capped}]
-                first_line_capped = original_slice.splitlines()[0][:70].ljust(70)
-                log(f"Match: #{str(lineno).ljust(6)} [{first_line_capped}]")
-                file_lines[filename] = (
-                    lines[:lineno - 1]
-                    + [modified_slice + '\n']
-                    + lines[lineno - 1 + entry_len:]
+        if filename.startswith("<") or not lineno:
+            raise GeneratedEntryError
+        file_txns.setdefault(filename, {})[lineno] = (txn, table.index(match))
+
+    if progress:
+        progress({
+            "replays": len(compiled_replays),
+            "matched": len(matched),
+            "files_total": len(file_txns),
+        })
+
+    # Rewrite each file to a temporary file, in a single pass per file
+    tasks = [
+        (
+            filename,
+            [(lineno, i) for lineno, (_, i) in items.items()],
+            table.deltas,
+            fava_options.currency_column,
+            fava_options.indent,
+        )
+        for filename, items in file_txns.items()
+    ]
+    counters = {"files_rewritten": 0, "modified": 0}
+
+    def on_file(result):
+        counters["files_rewritten"] += 1
+        counters["modified"] += len(result[1])
+        progress(dict(counters))
+
+    results = _rewrite_files(tasks, jobs, on_file if progress else None)
+
+    changes: list[EntryChange] = []
+    # Dict: { filename: path of the rewritten temporary file }
+    tmp_files: dict[str, str] = {}
+    written = {}
+    replay_stats = table.replay_stats(dispatch)
+    table.count_matches(matched, replay_stats)
+    file_stats = []
+    for (filename, items), result in zip(file_txns.items(), results):
+        if result[0]:
+            tmp_files[filename] = result[0]
+        file_changes, stats = _file_changes(items, result, table, replay_stats, timings, log)
+        changes.extend(file_changes)
+        file_stats.append(stats)
+
+    # Replace the changed files
+    if tmp_files:
+        with StageTimer(timings, "commit"):
+            written = commit_files(
+                tmp_files, journal_path or journal_path_for(next(iter(tmp_files))), stamps,
+            )
+    for filename in tmp_files:
+        # Logging: Wrote file: {filename}
+        log(f"Wrote file: {filename}")
+
+    if match_index is not None:
+        with StageTimer(timings, "index"):
+            positions = dict(settled)
+            positions.update(
+                (txn_id, table.positions[id(replay)]) for txn_id, replay in matched.items()
+            )
+            match_index.update(
+                txns, replay_keys, txn_keys, positions,
+                {id(change.entry) for change in changes},
+            )
+    stats = ReplayStats(perf_counter() - started, timings, replay_stats, file_stats)
+    return ReplayResult(changes, stats, written)
+
+
+def stream_replays(
+        replays: list[Replay | CompiledReplay],
+        files: Iterable[tuple[str, list, list, dict]],
+        options_map: Any,
+        fava_options: Any,
+        verbose: bool = False,
+        journal_path: str | None = None,
+        match_index: MatchIndex | None = None,
+        compose: bool = False,
+        stamps: dict[str, tuple[int, int] | None] | None = None,
+    ) -> ReplayResult:
+    """
+    Apply the replays like apply_replays, one file of files at a time, see
+    load.iter_ledger_files(), to bound the memory used. The entries aren't
+    booked, see load.needs_booking(). The ReplayResult only has the stats.
+    """
+    def log(msg: str):
+        if verbose: print(msg)
+
+    started = perf_counter()
+    timings: dict[str, float] = {}
+
+    journal_path = _check_journal(journal_path, options_map)
+    if compose and match_index is not None:
+        raise ValueError("The match index can't be used to compose replays")
+
+    with StageTimer(timings, "compile"):
+        compiled_replays = compile_replays(replays, options_map, fava_options)
+        table = _DeltaTable(compiled_replays, timings, log)
+        dispatch = ReplayDispatch(compiled_replays)
+        replay_keys = [replay_key(replay) for replay in compiled_replays]
+
+    replay_stats = table.replay_stats(dispatch)
+    file_stats = []
+    # Dict: { filename: path of the rewritten temporary file }
+    tmp_files: dict[str, str] = {}
+    # Dict: { key of a transaction: position of the replay matching it }, the
+    # records of the updated match index
+    records: dict[bytes, int] = {}
+    skipped = 0
+    try:
+        for filename, entries, errors, _ in files:
+            if errors:
+                log(f"WARNING: Errors parsing {filename}: {errors}")
+            with StageTimer(timings, "match"):
+                txns = [e for e in entries if isinstance(e, Transaction)]
+                txns.sort(key=get_position)
+                candidates = None
+                if match_index is not None:
+                    txn_keys, candidates, settled = match_index.plan(txns, replay_keys)
+                    skipped += sum(1 for mask in candidates.values() if not mask)
+                matched = match_replays(compiled_replays, txns, candidates, dispatch, compose)
+            table.count_matches(matched, replay_stats)
+            # Dict: { lineno: (txn, index of its delta) }
+            items = {
+                get_position(txn)[1]: (txn, table.index(matched[id(txn)]))
+                for txn in txns if id(txn) in matched
+            }
+            changes: list[EntryChange] = []
+            if items:
+                result = rewrite_file(
+                    filename,
+                    [(lineno, i) for lineno, (_, i) in items.items()],
+                    table.deltas,
+                    fava_options.currency_column,
+                    fava_options.indent,
                 )
-                file_changed[filename].add(lineno)
-                modified_count += 1
-
-    # Write all changed files
-    for filename, changed_lines in file_changed.items():
-        if changed_lines:
-            with open(filename, 'w', encoding='utf-8') as f:
-                f.writelines(file_lines[filename])
-            # Logging: Wrote file: {filename}
-            log(f"Wrote file: {filename}")
-    return modified_count
\ No newline at end of file
+                if result[0]:
+                    tmp_files[filename] = result[0]
+                changes, stats = _file_changes(items, result, table, replay_stats, timings, log)
+                file_stats.append(stats)
+            if match_index is not None:
+                with StageTimer(timings, "index"):
+                    positions = dict(settled)
+                    positions.update(
+                        (txn_id, table.positions[id(replay)])
+                        for txn_id, replay in matched.items()
+                    )
+                    records.update(match_index.record(
+                        txns, txn_keys, positions, {id(change.entry) for change in changes},
+                    ))
+            # Drop the entries of the file before the next one is parsed
+            del entries, errors, txns, matched, items, changes
+    except BaseException:
+        for tmp_path in tmp_files.values():
+            os.unlink(tmp_path)
+        raise
+    if skipped:
+        log(f"Skipped {skipped} transactions already matched by a previous run")
+
+    # Replace the changed files
+    if tmp_files:
+        with StageTimer(timings, "commit"):
+            commit_files(
+                tmp_files, journal_path or journal_path_for(next(iter(tmp_files))), stamps,
+            )
+    for filename in tmp_files:
+        # Logging: Wrote file: {filename}
+        log(f"Wrote file: {filename}")
+
+    if match_index is not None:
+        with StageTimer(timings, "index"):
+            match_index.replace(replay_keys, records)
+    # The counters of the dispatch and of the conflicts are only final now
+    for i, stats in enumerate(replay_stats):
+        stats["evaluated"] = dispatch.evaluated[i]
+        stats["filter_seconds"] = dispatch.filter_seconds[i]
+        stats["conflicts"] = table.conflicts[i]
+    stats = ReplayStats(perf_counter() - started, timings, replay_stats, file_stats)
+    return ReplayResult([], stats)
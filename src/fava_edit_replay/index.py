@@ -0,0 +1,187 @@
+"""On-disk index of the transactions already evaluated against the replays."""
+
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import struct
+from pathlib import Path
+from typing import Any
+
+import logging
+logger = logging.getLogger("edit_replay.index")
+
+# Each record: the key of a transaction and the position, in the replays of
+# the run that wrote the index, of the replay that matched it without
+# changing it, or -1 if no replay matched it.
+RECORD = struct.Struct("<16si")
+
+
+def _meta_items(meta: dict | None) -> list[tuple[str, str]]:
+    return sorted(
+        (key, str(value)) for key, value in (meta or {}).items()
+        if key != "lineno" and not key.startswith("__")
+    )
+
+
+def transaction_key(txn: Any) -> bytes:
+    """
+    Hash of the content of a loaded transaction, without its position, so
+    that moved or reformatted transactions keep their key.
+    """
+    content = (
+        str(txn.date), txn.flag, txn.payee, txn.narration,
+        sorted(txn.tags), sorted(txn.links), _meta_items(txn.meta),
+        [
+            (p.account, str(p.units), str(p.cost), str(p.price), p.flag,
+             _meta_items(p.meta))
+            for p in txn.postings
+        ],
+    )
+    return hashlib.blake2b(repr(content).encode(), digest_size=16).digest()
+
+
+def replay_key(replay: Any) -> str:
+    """
+    Hash of a compiled replay: its filters, with the time filter resolved to
+    dates since relative ones like "year" change over time, and its delta.
+    """
+    source = replay.replay
+    if replay.date_range:
+        time = [date.isoformat() for date in replay.date_range]
+    else:
+        time = source.time_filter
+    content = [source.account_filter, source.advanced_filter, time, replay.delta]
+    return hashlib.blake2b(
+        json.dumps(content, sort_keys=True).encode(), digest_size=16
+    ).hexdigest()
+
+
+class MatchIndex:
+    """
+    The outcome of the last run on each transaction, so that the next run
+    only evaluates new or edited transactions against new or edited replays.
+    Stored as a JSON header line followed by fixed size RECORDs.
+    """
+    VERSION = 1
+
+    def __init__(self, path: Path | str, context: Any = None):
+        self.path = Path(path)
+        self.context = context  # the index is discarded when it changes
+        self.replay_keys: list[str] = []
+        self.positions: dict[bytes, int] = {}
+
+    def load(self) -> None:
+        """Load the index, it stays empty if it is missing or outdated."""
+        try:
+            with self.path.open("rb") as f:
+                header = json.loads(f.readline())
+                data = f.read()
+        except (OSError, ValueError):
+            return
+        if header.get("version") != self.VERSION or header.get("context") != self.context:
+            logger.info(f"Ignoring outdated index: {self.path}")
+            return
+        self.replay_keys = header["replays"]
+        self.positions = dict(RECORD.iter_unpack(data))
+
+    def save(self) -> None:
+        header = {
+            "version": self.VERSION,
+            "context": self.context,
+            "replays": self.replay_keys,
+        }
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(json.dumps(header).encode() + b"\n")
+            f.write(b"".join(RECORD.pack(*item) for item in self.positions.items()))
+        os.replace(tmp_path, self.path)
+
+    def plan(
+            self, txns: list, replay_keys: list[str]
+        ) -> tuple[dict[int, bytes], dict[int, int], dict[int, int]]:
+        """
+        Work out what has to be evaluated for the transactions, with the
+        replays identified by replay_keys.
+        Returns, keyed by id(txn): the key of each transaction, the bitmask of
+        the replays it has to be evaluated against, and the position of the
+        replay known to match it if none of these do.
+        """
+        previous = self.replay_keys
+        every_replay = (1 << len(replay_keys)) - 1
+        # Dict: { previous position: (candidates, settled position) }
+        outcomes: dict[int, tuple[int, int | None]] = {}
+
+        def outcome(position: int) -> tuple[int, int | None]:
+            if position not in outcomes:
+                if position >= 0:
+                    not_matching = set(previous[:position])
+                    matching = previous[position]
+                else:
+                    not_matching = set(previous)
+                    matching = None
+                candidates = 0
+                settled = None
+                for i, key in enumerate(replay_keys):
+                    if key == matching:
+                        settled = i
+                        break
+                    if key not in not_matching:
+                        candidates |= 1 << i
+                outcomes[position] = (candidates, settled)
+            return outcomes[position]
+
+        keys: dict[int, bytes] = {}
+        candidates: dict[int, int] = {}
+        settled: dict[int, int] = {}
+        for txn in txns:
+            key = transaction_key(txn)
+            keys[id(txn)] = key
+            position = self.positions.get(key)
+            if position is None:
+                candidates[id(txn)] = every_replay
+                continue
+            txn_candidates, txn_settled = outcome(position)
+            candidates[id(txn)] = txn_candidates
+            if txn_settled is not None:
+                settled[id(txn)] = txn_settled
+        return keys, candidates, settled
+
+    def record(
+            self,
+            txns: list,
+            keys: dict[int, bytes],
+            positions: dict[int, int],
+            changed: set[int],
+        ) -> dict[bytes, int]:
+        """
+        Return the records of the outcome of a run on the transactions:
+        positions maps id(txn) to the position of the replay that matched it,
+        changed holds the ids of the transactions that were rewritten.
+        """
+        return {
+            keys[id(txn)]: positions.get(id(txn), -1)
+            for txn in txns
+            if id(txn) not in changed
+        }
+
+    def replace(self, replay_keys: list[str], positions: dict[bytes, int]) -> None:
+        """Save the records of a run with the replays identified by replay_keys."""
+        self.replay_keys = replay_keys
+        self.positions = positions
+        self.save()
+
+    def update(
+            self,
+            txns: list,
+            replay_keys: list[str],
+            keys: dict[int, bytes],
+            positions: dict[int, int],
+            changed: set[int],
+        ) -> None:
+        """
+        Record the outcome of a run on all the transactions, see record().
+        Transactions that are gone are forgotten.
+        """
+        self.replace(replay_keys, self.record(txns, keys, positions, changed))
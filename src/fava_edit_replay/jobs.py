@@ -0,0 +1,100 @@
+"""Background jobs applying replays, with progress reports."""
+
+from __future__ import annotations
+
+import json
+import threading
+import time
+import uuid
+from typing import Any, Callable, Iterator
+
+import logging
+logger = logging.getLogger("edit_replay.jobs")
+
+
+class JobCancelled(Exception):
+    """Raised in a job by its progress callback once it was cancelled."""
+
+
+class ReplayJob:
+    """
+    Runs a function in a background thread and records its progress.
+    The function is given a progress callback, to call with a dict of
+    counters, which raises JobCancelled after cancel().
+    """
+
+    def __init__(self, run: Callable[[Callable[[dict], None]], dict]):
+        self.id = uuid.uuid4().hex
+        self._run = run
+        self._started = time.monotonic()
+        self._cancelled = threading.Event()
+        self._condition = threading.Condition()
+        self.state: dict[str, Any] = {"status": "running"}
+        self.events: list[dict] = []
+        self._thread = threading.Thread(target=self._main, name=f"replay-job-{self.id}", daemon=True)
+
+    @property
+    def done(self) -> bool:
+        return self.state["status"] != "running"
+
+    def start(self) -> ReplayJob:
+        self._publish({})
+        self._thread.start()
+        return self
+
+    def cancel(self) -> None:
+        self._cancelled.set()
+
+    def progress(self, counters: dict) -> None:
+        """The callback given to the function of the job."""
+        if self._cancelled.is_set():
+            raise JobCancelled
+        self._publish(counters)
+
+    def _publish(self, update: dict) -> None:
+        with self._condition:
+            self.state.update(update)
+            self.state["elapsed"] = round(time.monotonic() - self._started, 3)
+            self.events.append(dict(self.state))
+            self._condition.notify_all()
+
+    def _main(self) -> None:
+        try:
+            counters = self._run(self.progress)
+            self._publish({**counters, "status": "done"})
+        except JobCancelled:
+            self._publish({"status": "cancelled", "message": "Cancelled, no file was changed."})
+        except Exception as e:
+            logger.exception(f"Job {self.id} failed")
+            self._publish({"status": "error", "message": str(e)})
+
+    def iter_events(self, start: int = 0, timeout: float = 15.0) -> Iterator[dict | None]:
+        """
+        Yield the progress events from the start-th one until the job is done,
+        waiting for new ones. None is yielded after timeout seconds without
+        events, to let streams send keep-alives.
+        """
+        index = start
+        while True:
+            with self._condition:
+                if index >= len(self.events):
+                    self._condition.wait(timeout)
+                events = self.events[index:]
+            if not events:
+                yield None
+                continue
+            for event in events:
+                yield event
+            index += len(events)
+            if events[-1]["status"] != "running":
+                return
+
+    def sse(self, start: int = 0) -> Iterator[str]:
+        """The progress events as a text/event-stream."""
+        index = start
+        for event in self.iter_events(start):
+            if event is None:
+                yield ": keep-alive\n\n"
+                continue
+            yield f"id: {index}\ndata: {json.dumps(event)}\n\n"
+            index += 1
@@ -0,0 +1,175 @@
+"""Load ledgers for the command line tool, with or without booking and plugins."""
+
+from __future__ import annotations
+
+import glob
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Iterator
+
+from beancount import loader
+from beancount.core import data
+from beancount.parser import parser
+from beancount.utils import encryption
+from fava.core.filters import LEXER, FilterError
+
+# Keys of advanced filters whose values are only complete after booking:
+# elided amounts are MISSING in the source, costs are unresolved CostSpecs.
+BOOKED_KEYS = ("units", "cost", "price", "weight", "position")
+
+
+class EncryptedFileError(ValueError):
+    """An encrypted ledger file, which only the loader can read."""
+
+
+def needs_booking(replay: Any) -> bool:
+    """
+    Return True if the filters of the replay can depend on booked data:
+    amount comparisons, like "> 100" or "any(units > 100)", and keys of
+    BOOKED_KEYS. Account and time filters only look at account names and
+    dates, which booking doesn't change.
+    """
+    advanced_filter = replay.advanced_filter
+    if not advanced_filter:
+        return False
+    try:
+        tokens = list(LEXER.lex(advanced_filter))
+    except FilterError:
+        return False
+    return any(
+        token.type == "CMP_OP"
+        or token.type == "KEY" and token.value in BOOKED_KEYS
+        for token in tokens
+    )
+
+
+# An include directive in the source of a ledger file
+INCLUDE = re.compile(r'^include[ \t]+"([^"]*)"', re.MULTILINE)
+
+
+def read_includes(filename: str) -> list[str]:
+    """
+    Return the patterns of the include directives of a ledger file, read
+    from its source without parsing it. Encrypted or unreadable files have
+    none.
+    """
+    if encryption.is_encrypted_file(filename):
+        return []
+    try:
+        with open(filename, encoding="utf-8") as f:
+            return INCLUDE.findall(f.read())
+    except (OSError, UnicodeDecodeError):
+        return []
+
+
+def expand_include(filename: str, include: str) -> list[str]:
+    """Return the paths an include pattern of a file matches, like the loader."""
+    cwd = os.path.dirname(filename)
+    return [
+        os.path.normpath(os.path.join(cwd, path))
+        for path in glob.glob(os.path.join(cwd, include), recursive=True)
+    ]
+
+
+def _include_paths(filename: str, options_map: dict, errors: list) -> list[str]:
+    """Resolve the include options of a parsed file, like the loader does."""
+    paths = []
+    for include in options_map["include"]:
+        matched = expand_include(filename, include)
+        if not matched:
+            errors.append(loader.LoadError(
+                data.new_metadata("<load>", 0),
+                f'File glob "{include}" does not match any files',
+            ))
+        paths.extend(matched)
+    return paths
+
+
+def parse_ledger(filename: str, jobs: int = 1) -> tuple[list, list, dict] | None:
+    """
+    Parse a ledger file and its includes, in up to jobs worker processes,
+    without booking, plugins and validation, see needs_booking().
+    Returns (entries, errors, options_map), or None if the ledger has
+    encrypted files.
+    """
+    filename = os.path.normpath(os.path.abspath(filename))
+    if encryption.is_encrypted_file(filename):
+        return None
+    entries, errors, options_map = parser.parse_file(filename)
+    other_options_maps = []
+    seen = {filename}
+    pending = _include_paths(filename, options_map, errors)
+    executor = None
+    try:
+        while pending:
+            wave = []
+            for path in pending:
+                if path in seen:
+                    errors.append(loader.LoadError(
+                        data.new_metadata("<load>", 0),
+                        f'Duplicate filename parsed: "{path}"',
+                    ))
+                elif not os.path.exists(path):
+                    errors.append(loader.LoadError(
+                        data.new_metadata("<load>", 0),
+                        f'File "{path}" does not exist',
+                    ))
+                else:
+                    if encryption.is_encrypted_file(path):
+                        return None
+                    seen.add(path)
+                    wave.append(path)
+            if jobs > 1 and len(wave) > 1 and executor is None:
+                executor = ProcessPoolExecutor(max_workers=jobs)
+            if executor is not None:
+                results = list(executor.map(parser.parse_file, wave))
+            else:
+                results = [parser.parse_file(path) for path in wave]
+            pending = []
+            for path, (src_entries, src_errors, src_options_map) in zip(wave, results):
+                entries.extend(src_entries)
+                errors.extend(src_errors)
+                other_options_maps.append(src_options_map)
+                pending.extend(_include_paths(path, src_options_map, errors))
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    options_map["include"] = sorted(seen)
+    options_map = loader.aggregate_options_map(options_map, other_options_maps)
+    entries.sort(key=data.entry_sortkey)
+    return entries, errors, options_map
+
+
+def iter_ledger_files(filename: str) -> Iterator[tuple[str, list, list, dict]]:
+    """
+    Parse a ledger file and the files it includes one at a time, without
+    booking, plugins and validation like parse_ledger(), and yield (path,
+    entries, errors, options_map) for each file, the top-level file first.
+    Only the entries of one file are held at a time.
+    Raises EncryptedFileError on encrypted files.
+    """
+    filename = os.path.normpath(os.path.abspath(filename))
+    seen = {filename}
+    pending = [filename]
+    while pending:
+        path = pending.pop(0)
+        if encryption.is_encrypted_file(path):
+            raise EncryptedFileError(f"Encrypted ledger file: {path}")
+        entries, errors, options_map = parser.parse_file(path)
+        for include in _include_paths(path, options_map, errors):
+            if include in seen:
+                errors.append(loader.LoadError(
+                    data.new_metadata("<load>", 0),
+                    f'Duplicate filename parsed: "{include}"',
+                ))
+            elif not os.path.exists(include):
+                errors.append(loader.LoadError(
+                    data.new_metadata("<load>", 0),
+                    f'File "{include}" does not exist',
+                ))
+            else:
+                seen.add(include)
+                pending.append(include)
+        yield path, entries, errors, options_map
+        del entries, errors
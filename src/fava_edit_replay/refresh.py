@@ -0,0 +1,208 @@
+"""Refresh a Fava ledger after replays rewrote some of its transactions."""
+
+from __future__ import annotations
+
+import os
+import re
+from bisect import bisect_left
+from typing import Any
+
+from beancount.core.data import entry_sortkey
+from beancount.parser import parser
+from fava.beans.prices import FavaPriceMap
+from fava.core.fava_options import parse_options
+from fava.core.group_entries import group_entries_by_type
+
+from fava_edit_replay.helpers import EntryChange, ReplayResult, txn_apply_delta
+from fava_edit_replay.rewrite import file_stamp
+
+import logging
+logger = logging.getLogger("edit_replay.refresh")
+
+# Deltas only touching these fields of a transaction can't change balances,
+# booking or the order of the entries.
+SAFE_PATH = re.compile(r"^root\.(payee|narration|flag|tags|links|meta\b)")
+
+# The FavaLedger modules that derive data from the entries, in the order
+# FavaLedger.load_file() loads them.
+LEDGER_MODULES = (
+    "accounts",
+    "attributes",
+    "budgets",
+    "charts",
+    "commodities",
+    "extensions",
+    "file",
+    "format_decimal",
+    "misc",
+    "query_shell",
+    "ingest",
+)
+
+
+def is_safe_delta(delta: dict) -> bool:
+    """Return True if the delta only touches fields listed in SAFE_PATH."""
+    return all(
+        SAFE_PATH.match(path)
+        for changes in delta.values()
+        for path in changes
+    )
+
+
+def has_errors_in(errors: list, filenames: list[str]) -> bool:
+    """
+    Return True if one of the errors is in one of the files, its line number
+    is stale once the file is rewritten.
+    """
+    filenames = set(filenames)
+    return any((error.source or {}).get("filename") in filenames for error in errors)
+
+
+def _only_rewritten(ledger: Any, result: ReplayResult, stamps: dict) -> bool:
+    """
+    Return True if the files of the ledger are as they were loaded, going by
+    their stamps, but the ones the run rewrote, which are as it wrote them.
+    """
+    expected = {**stamps, **(result.stamps or {})}
+    for path in ledger.options["include"]:
+        stamp = expected.get(path)
+        if stamp is None or file_stamp(path) != stamp:
+            return False
+    return True
+
+
+def refresh_ledger(ledger: Any, result: ReplayResult, stamps: dict | None = None) -> str:
+    """
+    Bring the FavaLedger up to date after apply_replays rewrote its files:
+    splice the rewritten transactions into the loaded entries if the ledger
+    has no plugins, no other file changed since stamps and the deltas allow
+    it, see refreshed_entries(), or reload it.
+    Returns how the ledger was refreshed: "none", "incremental" or "full".
+    """
+    if not result.changes:
+        return "none"
+    entries = None
+    if (
+        stamps is not None
+        and not ledger.options.get("plugin")
+        and _only_rewritten(ledger, result, stamps)
+        and not has_errors_in(ledger.load_errors, result.files)
+    ):
+        entries = refreshed_entries(ledger.all_entries, result)
+    if entries is None:
+        ledger.load_file()
+        return "full"
+
+    # What FavaLedger.load_file() does after loading the entries
+    ledger.all_entries = entries
+    ledger.get_filtered.cache_clear()
+    ledger.get_entry.cache_clear()
+    ledger.all_entries_by_type = group_entries_by_type(entries)
+    ledger.prices = FavaPriceMap(ledger.all_entries_by_type.Price)
+    ledger.fava_options, ledger.fava_options_errors = parse_options(
+        ledger.all_entries_by_type.Custom,
+    )
+    # Acknowledge our own writes, and only them, so that they don't trigger
+    # a full reload: later changes have a later mtime. The watcher also goes
+    # by the mtime of the directory of a replaced file.
+    written = max(
+        max(stamp[0], os.stat(os.path.dirname(path)).st_mtime_ns)
+        for path, stamp in result.stamps.items()
+    )
+    ledger.watcher.last_checked = max(ledger.watcher.last_checked, written)
+    for module in LEDGER_MODULES:
+        getattr(ledger, module).load_file()
+    ledger.extensions.after_load_file()
+    logger.info(f"Refreshed {len(result.changes)} transactions in {result.files}")
+    return "incremental"
+
+
+def refreshed_entries(entries: list, result: ReplayResult) -> list | None:
+    """
+    Return the entries as they would be loaded again after the replays
+    rewrote some of them, or None if the deltas aren't all safe, see
+    is_safe_delta(), or a transaction can't be replaced. Plugins aren't run
+    again, the caller has to check that the ledger has none.
+    """
+    if not all(is_safe_delta(change.delta) for change in result.changes):
+        return None
+    return _spliced_entries(entries, result.changes)
+
+
+def _shift(entry: Any, shift: int) -> Any:
+    """Return the entry with its line number and its postings' shifted."""
+    if not shift:
+        return entry
+    entry = entry._replace(meta={**entry.meta, "lineno": entry.meta["lineno"] + shift})
+    postings = getattr(entry, "postings", None)
+    if postings:
+        entry = entry._replace(postings=[
+            posting._replace(
+                meta={**posting.meta, "lineno": posting.meta["lineno"] + shift}
+            ) if posting.meta and "lineno" in posting.meta else posting
+            for posting in postings
+        ])
+    return entry
+
+
+def _rewritten(change: EntryChange, lineno: int) -> Any | None:
+    """
+    Return the transaction of the change as it would be loaded from its new
+    position, or None if that can't be done without reloading.
+    """
+    parsed_entries, errors, _ = parser.parse_string(change.text)
+    if errors or not parsed_entries:
+        return None
+    parsed = parsed_entries[0]
+    entry = change.entry
+    if len(parsed.postings) != len(entry.postings):
+        return None
+    filename = change.filename
+    entry = txn_apply_delta(entry, change.delta)
+    postings = [
+        posting._replace(meta={
+            **(posting.meta or {}),
+            "filename": filename,
+            "lineno": lineno + parsed_posting.meta["lineno"] - 1,
+        })
+        for posting, parsed_posting in zip(entry.postings, parsed.postings)
+    ]
+    return entry._replace(
+        meta={**entry.meta, "filename": filename, "lineno": lineno},
+        postings=postings,
+    )
+
+
+def _spliced_entries(entries: list, changes: list[EntryChange]) -> list | None:
+    """
+    Return the entries with the rewritten transactions replaced and the
+    entries after them shifted, or None if a transaction can't be replaced.
+    """
+    # Dict: { filename: ([first line of each change], [shift after each change]) }
+    shifts: dict[str, tuple[list[int], list[int]]] = {}
+    # Dict: { id(entry): rewritten entry }
+    rewritten: dict[int, Any] = {}
+    for change in changes:
+        starts, file_shifts = shifts.setdefault(change.filename, ([], []))
+        shift = file_shifts[-1] if file_shifts else 0
+        new_entry = _rewritten(change, change.start + 1 + shift)
+        if new_entry is None:
+            return None
+        rewritten[id(change.entry)] = new_entry
+        starts.append(change.start + 1)
+        file_shifts.append(shift + change.text.count("\n") - (change.end - change.start))
+
+    new_entries = []
+    for entry in entries:
+        new_entry = rewritten.get(id(entry))
+        if new_entry is None:
+            filename = entry.meta.get("filename")
+            lineno = entry.meta.get("lineno")
+            if filename in shifts and isinstance(lineno, int):
+                starts, file_shifts = shifts[filename]
+                index = bisect_left(starts, lineno) - 1
+                if index >= 0:
+                    new_entry = _shift(entry, file_shifts[index])
+        new_entries.append(new_entry or entry)
+    new_entries.sort(key=entry_sortkey)
+    return new_entries
@@ -1,8 +1,14 @@
 import json
+import os
+import threading
 from pathlib import Path
 from typing import NamedTuple, Any
 import yaml
-from yaml.loader import SafeLoader
+try:
+    # Use the libyaml bindings when PyYAML was built with them
+    from yaml import CSafeDumper as SafeDumper, CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeDumper, SafeLoader
 from fava_edit_replay.diff2text import format_diff
 
 import logging
@@ -16,7 +22,7 @@ class LineNumberLoader(SafeLoader):
         return mapping
 
 class Replay(NamedTuple):
-    lineno: int           # line number in the db file
+    lineno: int           # line number in the db file, id of the replay in JSONL files
     time_filter: str      # time filter
     account_filter: str   # account filter
     advanced_filter: str  # advanced filter
@@ -32,55 +38,242 @@ def load_replays_with_lineno(replays_path: Path) -> list[dict]:
         raw_replays = yaml.load(f, Loader=LineNumberLoader) or []
     return raw_replays
 
-def save_replay_to_file(replay: Replay, replays_path: Path) -> str:
-    """Save a Replay NamedTuple to the YAML file at replays_path."""
-    replays = []
-    if replays_path.exists():
-        with replays_path.open("r", encoding="utf-8") as f:
-            replays = yaml.safe_load(f) or []
-
-    replay_data = {
+def _replay_data(replay: Replay) -> dict:
+    """Return the fields of a replay stored in the YAML file."""
+    return {
         'time_filter': replay.time_filter,
         'account_filter': replay.account_filter,
         'advanced_filter': replay.advanced_filter,
         'diff': replay.diff,
     }
-    replays.append(replay_data)
-    with replays_path.open("w", encoding="utf-8") as f:
-        yaml.safe_dump(replays, f, allow_unicode=True, sort_keys=True)
+
+def _replay_from_data(data: dict) -> Replay:
+    """Build a Replay from a mapping loaded from the YAML file."""
+    diff = data.get('diff', '')
+    return Replay(
+        lineno=data.get('lineno', -1),
+        time_filter=data.get('time_filter', ''),
+        account_filter=data.get('account_filter', ''),
+        advanced_filter=data.get('advanced_filter', ''),
+        diff=diff,
+        diff_readable=', '.join(format_diff(json.loads(diff))),
+    )
+
+class ReplayStore:
+    """
+    The replays of a YAML file, kept in memory between requests and parsed
+    again only when the file changed. Saves and deletes rewrite the file.
+    """
+
+    def __init__(self, replays_path: Path):
+        self.path = Path(replays_path)
+        self._lock = threading.Lock()
+        self._signature: tuple[int, int] | None = None
+        self._replays: list[Replay] = []
+        # The mappings of the file, without line numbers, so that fields
+        # unknown to Replay survive rewrites.
+        self._data: list[dict] = []
+
+    def _stat(self) -> tuple[int, int] | None:
+        try:
+            stat = self.path.stat()
+        except FileNotFoundError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def _refresh(self) -> None:
+        signature = self._stat()
+        if self._signature is not None and signature == self._signature:
+            return
+        raw_replays = load_replays_with_lineno(self.path)
+        self._replays = [_replay_from_data(data) for data in raw_replays]
+        self._data = [
+            {key: value for key, value in data.items() if key != 'lineno'}
+            for data in raw_replays
+        ]
+        self._signature = signature
+
+    def _write(self, data: list[dict], replays: list[Replay]) -> None:
+        """Write the replays to the file, and cache them with their new line numbers."""
+        text = yaml.dump(data, Dumper=SafeDumper, allow_unicode=True, sort_keys=True)
+        with self.path.open("w", encoding="utf-8") as f:
+            f.write(text)
+        # Each replay is a mapping in a top-level list, starting with "- "
+        linenos = [
+            i for i, line in enumerate(text.splitlines(), 1) if line.startswith('- ')
+        ]
+        if len(linenos) == len(replays):
+            self._replays = [
+                replay._replace(lineno=lineno)
+                for replay, lineno in zip(replays, linenos)
+            ]
+            self._data = data
+            self._signature = self._stat()
+        else:
+            self._signature = None  # Parse the file on next access
+
+    def replays(self) -> list[Replay]:
+        """Return the replays, parsing the file again only if it changed."""
+        with self._lock:
+            self._refresh()
+            return list(self._replays)
+
+    def save(self, replay: Replay) -> None:
+        """Append a replay to the file."""
+        with self._lock:
+            self._refresh()
+            data = _replay_data(replay)
+            self._write(self._data + [data], self._replays + [_replay_from_data(data)])
+
+    def delete(self, lineno: int) -> None:
+        """Delete the replay at the line number from the file."""
+        with self._lock:
+            self._refresh()
+            kept = [
+                (data, replay) for data, replay in zip(self._data, self._replays)
+                if replay.lineno != lineno
+            ]
+            self._write([data for data, _ in kept], [replay for _, replay in kept])
+
+class JsonlReplayStore:
+    """
+    The replays of a JSON Lines file, an append-only log of replays and
+    tombstones {"id": ..., "deleted": true}, with the interface of
+    ReplayStore. The id of a replay is its Replay.lineno. The file is
+    compacted once it is mostly tombstones.
+    """
+    # Compact when there are more dead lines than this, and than live ones
+    COMPACT_MIN_DEAD = 64
+
+    def __init__(self, replays_path: Path):
+        self.path = Path(replays_path)
+        self._lock = threading.Lock()
+        self._signature: tuple[int, int] | None = None
+        # Dict: { id: Replay }, in the order the replays were saved
+        self._replays: dict[int, Replay] = {}
+        self._lines = 0
+        self._next_id = 1
+
+    def _stat(self) -> tuple[int, int] | None:
+        try:
+            stat = self.path.stat()
+        except FileNotFoundError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def _refresh(self) -> None:
+        signature = self._stat()
+        if self._signature is not None and signature == self._signature:
+            return
+        self._replays = {}
+        self._lines = 0
+        self._next_id = 1
+        if signature is not None:
+            with self.path.open("r", encoding="utf-8") as f:
+                for line in f:
+                    if not line.strip():
+                        continue
+                    record = json.loads(line)
+                    self._lines += 1
+                    replay_id = record['id']
+                    self._next_id = max(self._next_id, replay_id + 1)
+                    if record.get('deleted'):
+                        self._replays.pop(replay_id, None)
+                    else:
+                        self._replays[replay_id] = _replay_from_data(
+                            {**record, 'lineno': replay_id}
+                        )
+        self._signature = signature
+
+    def _append(self, record: dict) -> None:
+        with self.path.open("a", encoding="utf-8") as f:
+            f.write(json.dumps(record, ensure_ascii=False, sort_keys=True) + "\n")
+        self._lines += 1
+        self._signature = self._stat()
+
+    def replays(self) -> list[Replay]:
+        """Return the replays, reading the file again only if it changed."""
+        with self._lock:
+            self._refresh()
+            return list(self._replays.values())
+
+    def save(self, replay: Replay) -> None:
+        """Append a replay to the file, with a new id."""
+        with self._lock:
+            self._refresh()
+            replay_id = self._next_id
+            self._next_id += 1
+            data = _replay_data(replay)
+            self._append({'id': replay_id, **data})
+            self._replays[replay_id] = _replay_from_data({**data, 'lineno': replay_id})
+
+    def delete(self, replay_id: int) -> None:
+        """Delete the replay with the id."""
+        with self._lock:
+            self._refresh()
+            if self._replays.pop(replay_id, None) is None:
+                return
+            self._append({'id': replay_id, 'deleted': True})
+            dead = self._lines - len(self._replays)
+            if dead > self.COMPACT_MIN_DEAD and dead > len(self._replays):
+                self._compact()
+
+    def _compact(self) -> None:
+        """Rewrite the file with only the live replays, keeping their ids."""
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            for replay_id, replay in self._replays.items():
+                record = {'id': replay_id, **_replay_data(replay)}
+                f.write(json.dumps(record, ensure_ascii=False, sort_keys=True) + "\n")
+        os.replace(tmp_path, self.path)
+        self._lines = len(self._replays)
+        self._signature = self._stat()
+        logger.info(f"Compacted {self.path}")
+
+def open_replay_store(replays_path: Path) -> ReplayStore | JsonlReplayStore:
+    """Return the store for the database file, JSONL for .jsonl files, YAML otherwise."""
+    if Path(replays_path).suffix == '.jsonl':
+        return JsonlReplayStore(replays_path)
+    return ReplayStore(replays_path)
+
+def copy_replays(source_path: Path, target_path: Path, append: bool = False) -> int:
+    """
+    Copy the replays of a database file to a new one, or append them to an
+    existing one with append, to convert between the YAML and JSONL formats.
+    Raises FileExistsError if the target exists without append.
+    Returns the number of copied replays.
+    """
+    target_path = Path(target_path)
+    if not append and target_path.exists():
+        raise FileExistsError(f"{target_path} already exists")
+    replays = open_replay_store(source_path).replays()
+    if append:
+        store_path = target_path
+    else:
+        # The target only appears once complete
+        store_path = target_path.with_name(f".{target_path.stem}.tmp{target_path.suffix}")
+        store_path.unlink(missing_ok=True)
+    target = open_replay_store(store_path)
+    try:
+        for replay in replays:
+            target.save(replay)
+        if not append:
+            store_path.touch()
+            os.replace(store_path, target_path)
+    except BaseException:
+        if not append:
+            store_path.unlink(missing_ok=True)
+        raise
+    return len(replays)
+
+def save_replay_to_file(replay: Replay, replays_path: Path) -> None:
+    """Save a Replay NamedTuple to the YAML file at replays_path."""
+    ReplayStore(replays_path).save(replay)
 
 def load_replays_from_file(replays_path: Path) -> list[Replay]:
     """Load all saved replays from a YAML file as a list of Replay objects, with line numbers."""
-    raw_replays = load_replays_with_lineno(replays_path)
-    replays = []
-    for replay in raw_replays:
-        diff = replay.get('diff', '')
-        diff_readable = ', '.join(format_diff(json.loads(diff)))
-        replays.append(
-            Replay(
-                lineno=replay.get('lineno', -1),
-                time_filter=replay.get('time_filter', ''),
-                account_filter=replay.get('account_filter', ''),
-                advanced_filter=replay.get('advanced_filter', ''),
-                diff=diff,
-                diff_readable=diff_readable
-            )
-        )
-    return replays 
+    return [_replay_from_data(data) for data in load_replays_with_lineno(replays_path)]
 
 def delete_replay_by_lineno(lineno: int, replays_path: Path) -> None:
     """Delete a replay by line number from the YAML file."""
-    raw_replays = load_replays_with_lineno(replays_path)
-    
-    # Find the replay with the matching line number and remove it
-    filtered_replays = []
-    for replay in raw_replays:
-        if replay.get('lineno') != lineno:
-            # Remove the lineno field before saving back
-            replay_copy = replay.copy()
-            replay_copy.pop('lineno', None)
-            filtered_replays.append(replay_copy)
-    
-    # Write back the updated replays
-    with replays_path.open("w", encoding="utf-8") as f:
-        yaml.safe_dump(filtered_replays, f, allow_unicode=True, sort_keys=True) 
\ No newline at end of file
+    ReplayStore(replays_path).delete(lineno)
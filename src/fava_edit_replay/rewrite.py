@@ -0,0 +1,231 @@
+"""Rewrite ledger source files by splicing modified entries into them."""
+
+from __future__ import annotations
+
+import json
+import os
+import shutil
+import tempfile
+from typing import Iterable, NamedTuple
+
+from fava_edit_replay.source import SourceFile
+
+import logging
+logger = logging.getLogger("edit_replay.rewrite")
+
+# Buffer size used to write the rewritten files, they are fsynced anyway.
+WRITE_BUFFER_SIZE = 1 << 20
+
+
+class JournalError(Exception):
+    """A previous run was interrupted and has to be recovered first."""
+
+
+class ChangedFileError(Exception):
+    """A ledger file changed on disk since it was read, it can't be replaced."""
+
+
+class Splice(NamedTuple):
+    start: int  # 0-based index of the first replaced line
+    end: int    # 0-based index of the line after the last replaced line
+    text: str   # replacement text, ending with a newline
+
+
+def write_spliced(source: SourceFile, splices: list[Splice], out) -> None:
+    """
+    Write the source file with the splices applied to the file object out.
+    The splices are applied in a single forward pass over the file, the
+    unchanged lines in between are copied over in chunks.
+    """
+    pos = 0
+    for splice in sorted(splices):
+        if splice.start < pos:
+            raise ValueError(
+                f"Overlapping edits in {source.filename} at line {splice.start + 1}"
+            )
+        for chunk in source.iter_text(pos, splice.start):
+            out.write(chunk)
+        out.write(splice.text)
+        pos = splice.end
+    for chunk in source.iter_text(pos, len(source)):
+        out.write(chunk)
+
+
+def write_spliced_tmp(source: SourceFile, splices: list[Splice]) -> str:
+    """
+    Write the spliced source file to a temporary file in the same directory,
+    with the same permissions, and return its path. The temporary file is
+    synced to disk, it is meant to replace the source file with
+    commit_files() once the source file is closed.
+    """
+    tmp_path = _make_tmp(source.filename, ".tmp")
+    try:
+        with open(tmp_path, 'w', encoding='utf-8', buffering=WRITE_BUFFER_SIZE) as out:
+            write_spliced(source, splices, out)
+            out.flush()
+            os.fsync(out.fileno())
+        shutil.copymode(source.filename, tmp_path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+    return tmp_path
+
+
+def file_stamp(path: str) -> tuple[int, int] | None:
+    """Return the (mtime_ns, size) of a file, or None if it is missing."""
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+
+def file_stamps(
+        filenames: Iterable[str], after_ns: int | None = None
+    ) -> dict[str, tuple[int, int] | None]:
+    """
+    Return { filename: file_stamp() } for the files, to check with
+    commit_files() that they didn't change since they were read. The files
+    modified after after_ns get None, which never matches.
+    """
+    stamps = {}
+    for filename in filenames:
+        stamp = file_stamp(filename)
+        if stamp is not None and after_ns is not None and stamp[0] > after_ns:
+            stamp = None
+        stamps[filename] = stamp
+    return stamps
+
+
+def _make_tmp(filename: str, suffix: str) -> str:
+    """Create an empty file next to filename and return its path."""
+    dirname, basename = os.path.split(os.path.abspath(filename))
+    fd, tmp_path = tempfile.mkstemp(prefix=f".{basename}.", suffix=suffix, dir=dirname)
+    os.close(fd)
+    return tmp_path
+
+
+def _fsync_dir(path: str) -> None:
+    """Sync a directory, so that renames in it are on disk. No-op on Windows."""
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def _write_journal(journal_path: str, files: list[dict]) -> None:
+    tmp_path = journal_path + ".tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump({'files': files}, f, indent=2)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, journal_path)
+    _fsync_dir(os.path.dirname(os.path.abspath(journal_path)))
+
+
+def journal_path_for(ledger_filename: str) -> str:
+    """Path of the journal of the runs on the ledger ledger_filename."""
+    dirname, basename = os.path.split(os.path.abspath(ledger_filename))
+    return os.path.join(dirname, f".{basename}.replay-journal")
+
+
+def commit_files(
+        tmp_files: dict[str, str],
+        journal_path: str,
+        stamps: dict[str, tuple[int, int] | None] | None = None,
+    ) -> dict[str, tuple[int, int] | None]:
+    """
+    Replace each file of tmp_files { filename: tmp_path } with its temporary
+    file, all or nothing, and return the stamps of the replaced files.
+    Raises ChangedFileError, replacing nothing, if a file no longer has its
+    stamp in stamps. An interrupted commit is finished or rolled back by
+    recover_journal() from the journal at journal_path.
+    """
+    if os.path.exists(journal_path):
+        raise JournalError(
+            f"Found the journal of an interrupted run: {journal_path}, "
+            "it has to be recovered first."
+        )
+    files = []
+    try:
+        for filename, tmp_path in tmp_files.items():
+            if stamps is not None and filename in stamps:
+                stamp = stamps[filename]
+                if stamp is None or file_stamp(filename) != stamp:
+                    raise ChangedFileError(
+                        f"{filename} changed since it was read, no file was replaced"
+                    )
+            backup_path = _make_tmp(filename, ".bak")
+            os.unlink(backup_path)
+            try:
+                os.link(filename, backup_path)
+            except OSError:
+                shutil.copy2(filename, backup_path)
+            files.append(
+                {'filename': filename, 'tmp': tmp_path, 'backup': backup_path}
+            )
+        _write_journal(journal_path, files)
+    except BaseException:
+        for file in files:
+            os.unlink(file['backup'])
+        for tmp_path in tmp_files.values():
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+        raise
+    _roll_forward(files)
+    _finish(journal_path, files)
+    return file_stamps(tmp_files)
+
+
+def _roll_forward(files: list[dict]) -> None:
+    for file in files:
+        if os.path.exists(file['tmp']):
+            os.replace(file['tmp'], file['filename'])
+    for dirname in {os.path.dirname(os.path.abspath(f['filename'])) for f in files}:
+        _fsync_dir(dirname)
+
+
+def _roll_back(files: list[dict]) -> None:
+    missing = [f['filename'] for f in files if not os.path.exists(f['backup'])]
+    if missing:
+        raise JournalError(f"Can't roll back, missing backups for: {missing}")
+    for file in files:
+        os.replace(file['backup'], file['filename'])
+        if os.path.exists(file['tmp']):
+            os.unlink(file['tmp'])
+    for dirname in {os.path.dirname(os.path.abspath(f['filename'])) for f in files}:
+        _fsync_dir(dirname)
+
+
+def _finish(journal_path: str, files: list[dict]) -> None:
+    for file in files:
+        if os.path.exists(file['backup']):
+            os.unlink(file['backup'])
+    os.unlink(journal_path)
+
+
+def recover_journal(journal_path: str, rollback: bool = False) -> list[str]:
+    """
+    Recover an interrupted run from its journal, if there is one: either
+    finish replacing the files with their rewritten versions (the default),
+    or restore all the files from their backups.
+    Returns the list of recovered files, empty if there was nothing to do.
+    """
+    if not os.path.exists(journal_path):
+        return []
+    with open(journal_path, 'r', encoding='utf-8') as f:
+        files = json.load(f)['files']
+    if rollback:
+        _roll_back(files)
+    else:
+        _roll_forward(files)
+    _finish(journal_path, files)
+    filenames = [file['filename'] for file in files]
+    logger.info(f"Recovered interrupted run ({'rollback' if rollback else 'roll forward'}): {filenames}")
+    return filenames
@@ -0,0 +1,124 @@
+"""Per-run cache of the ledger source files."""
+
+from __future__ import annotations
+
+import mmap
+import re
+from array import array
+
+from fava.beans.funcs import get_position
+from fava.core.file import GeneratedEntryError
+
+
+def _split_lines(text: str) -> list[str]:
+    """Split text after each newline, like readlines()."""
+    lines = [line + '\n' for line in text.split('\n')]
+    lines[-1] = lines[-1][:-1]
+    if not lines[-1]:
+        lines.pop()
+    return lines
+
+
+class SourceFile:
+    """
+    A ledger source file, memory-mapped and indexed by line, so that an entry
+    is decoded without splitting the whole file.
+    """
+
+    def __init__(self, filename: str):
+        self.filename = filename
+        with open(filename, 'rb') as f:
+            try:
+                self._data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:  # Empty files can't be mapped
+                self._data = b''
+        offsets = array('q', [0])
+        offsets.extend(m.end() for m in re.finditer(rb'\n', self._data))
+        if offsets[-1] == len(self._data):
+            offsets.pop()  # No line after the last newline
+        offsets.append(len(self._data))
+        # offsets[i] is the start of line i, offsets[-1] the end of the file
+        self._offsets = offsets
+
+    def __len__(self) -> int:
+        return len(self._offsets) - 1
+
+    def _decode(self, start: int, end: int) -> str:
+        """Decode the lines [start, end[ of the file."""
+        raw = self._data[self._offsets[start]:self._offsets[end]]
+        return raw.decode('utf-8').replace('\r\n', '\n')
+
+    def iter_text(self, start: int, end: int, chunk_lines: int = 4096):
+        """
+        Yield the text of the lines [start, end[ in chunks of at most
+        chunk_lines lines, to copy large parts of the file in bounded memory.
+        """
+        for chunk_start in range(start, end, chunk_lines):
+            yield self._decode(chunk_start, min(chunk_start + chunk_lines, end))
+
+    def line(self, index: int) -> str:
+        """Return the line at the 0-based index, with its newline."""
+        return self._decode(index, index + 1)
+
+    def lines(self) -> list[str]:
+        """Return all the lines of the file, like readlines()."""
+        return _split_lines(self._decode(0, len(self)))
+
+    def entry_range(self, index: int) -> tuple[int, int]:
+        """
+        Return the 0-based [start, end[ line range of the entry starting at
+        the 0-based line index. Same rules as fava.core.file.find_entry_lines:
+        the entry ends at the first blank line or unindented line.
+        """
+        data, offsets = self._data, self._offsets
+        end = index + 1
+        while end < len(self):
+            line = data[offsets[end]:offsets[end + 1]]
+            if not line.strip() or not line[:1].isspace():
+                break
+            end += 1
+        return index, end
+
+    def entry_lines(self, index: int) -> list[str]:
+        """Return the lines of the entry starting at the 0-based line index."""
+        start, end = self.entry_range(index)
+        return _split_lines(self._decode(start, end))
+
+    def close(self) -> None:
+        if isinstance(self._data, mmap.mmap):
+            self._data.close()
+
+
+class SourceCache:
+    """
+    Source files read during a run, so that each file is read at most once
+    no matter how many of its entries are looked at.
+    """
+
+    def __init__(self):
+        self._files: dict[str, SourceFile] = {}
+
+    def __enter__(self) -> SourceCache:
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def get(self, filename: str) -> SourceFile:
+        source = self._files.get(filename)
+        if source is None:
+            source = self._files[filename] = SourceFile(filename)
+        return source
+
+    def entry_slice(self, entry) -> str:
+        """Cached equivalent of fava.core.file.get_entry_slice, without hash."""
+        filename, lineno = get_position(entry)
+        if filename.startswith("<") or not lineno:
+            raise GeneratedEntryError
+        source = self.get(filename)
+        return "".join(source.entry_lines(lineno - 1)).rstrip("\n")
+
+    def close(self) -> None:
+        for source in self._files.values():
+            source.close()
+        self._files.clear()
@@ -0,0 +1,96 @@
+"""Timers and counters of replay runs."""
+
+from __future__ import annotations
+
+from time import perf_counter
+from typing import Any, NamedTuple
+
+# The stages of apply_replays, in order. The stages between "slice" and
+# "write" run for each file, possibly in worker processes, their times are
+# summed over all the files.
+STAGES = (
+    "compile",  # parsing the filters and diffs of the replays
+    "match",    # matching the transactions against the replays
+    "compose",  # composing the deltas of the replays matching a transaction
+    "slice",    # extracting the source of the matched transactions
+    "parse",    # parsing the source of the matched transactions
+    "delta",    # applying the deltas
+    "render",   # rendering the modified transactions with to_string
+    "write",    # writing the temporary files
+    "commit",   # replacing the ledger files
+    "index",    # saving the match index
+)
+
+
+class StageTimer:
+    """
+    Context manager adding the time spent in its block to seconds[stage].
+
+        with StageTimer(timings, "parse"):
+            ...
+    """
+    __slots__ = ("seconds", "stage", "start")
+
+    def __init__(self, seconds: dict[str, float], stage: str):
+        self.seconds = seconds
+        self.stage = stage
+
+    def __enter__(self) -> None:
+        self.start = perf_counter()
+
+    def __exit__(self, *exc) -> None:
+        self.seconds[self.stage] = self.seconds.get(self.stage, 0.0) + perf_counter() - self.start
+
+
+class ReplayStats(NamedTuple):
+    """Timers and counters of an apply_replays run."""
+    seconds: float         # wall time of the run
+    stages: dict[str, float]  # seconds spent in each of STAGES
+    # Dict per replay: lineno, diff_readable, evaluated (transactions whose
+    # advanced filter was run), filter_seconds, matched, modified,
+    # parse_failures and conflicts (transactions it was left out of, see
+    # apply_replays(compose=True)).
+    replays: list[dict[str, Any]]
+    # Dict per file: filename, transactions, modified, parse_failures,
+    # bytes_written and seconds.
+    files: list[dict[str, Any]]
+
+    def totals(self) -> dict[str, int]:
+        return {
+            "transactions_matched": sum(r["matched"] for r in self.replays),
+            "transactions_modified": sum(f["modified"] for f in self.files),
+            "parse_failures": sum(f["parse_failures"] for f in self.files),
+            "conflicts": sum(r["conflicts"] for r in self.replays),
+            "files_written": sum(1 for f in self.files if f["bytes_written"]),
+            "bytes_written": sum(f["bytes_written"] for f in self.files),
+        }
+
+    def as_dict(self) -> dict[str, Any]:
+        """Return the stats as plain data, ready to be serialized to JSON."""
+        return {**self._asdict(), "totals": self.totals()}
+
+    def format(self, top: int = 10) -> str:
+        """Return a text report, listing the top most expensive replays and files."""
+        lines = [f"Total: {self.seconds:.3f}s"]
+        lines += [
+            f"  {stage:<8} {self.stages[stage]:9.3f}s"
+            for stage in STAGES if stage in self.stages
+        ]
+        lines += [f"{key.replace('_', ' ').capitalize()}: {value}" for key, value in self.totals().items()]
+        replays = sorted(self.replays, key=lambda r: r["filter_seconds"], reverse=True)[:top]
+        if replays:
+            lines.append("Most expensive replays (filter time, evaluated, matched, modified, failures):")
+            lines += [
+                f"  #{str(r['lineno']).ljust(6)} {r['filter_seconds']:8.4f}s {r['evaluated']:>8} "
+                f"{r['matched']:>8} {r['modified']:>8} {r['parse_failures']:>4}  {r['diff_readable'] or ''}"
+                for r in replays
+            ]
+        files = sorted(self.files, key=lambda f: f["seconds"], reverse=True)[:top]
+        if files:
+            lines.append("Slowest files (time, transactions, modified, bytes written):")
+            lines += [
+                f"  {f['seconds']:8.3f}s {f['transactions']:>8} {f['modified']:>8} "
+                f"{f['bytes_written']:>12}  {f['filename']}"
+                for f in files
+            ]
+        return "\n".join(lines)
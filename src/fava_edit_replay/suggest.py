@@ -0,0 +1,267 @@
+"""Inverted index of the transactions of a ledger, counting the matches of filters."""
+
+from __future__ import annotations
+
+import re
+from datetime import date
+from decimal import Decimal
+from typing import Any
+
+from beancount.core import account
+from fava.beans.abc import Transaction
+from fava.beans.account import get_entry_accounts
+from fava.core.filters import LEXER, FilterError, Match, MatchAmount, TimeFilter
+
+from fava_edit_replay.dispatch import TEXT_FIELDS
+from fava_edit_replay.rewrite import file_stamp
+
+# The tokens of narrations in the index
+WORD = re.compile(r"\w+")
+
+
+def parse_terms(advanced_filter: str) -> list[tuple[str, Any]] | None:
+    """
+    Split an advanced filter into the terms the index counts, all of which
+    have to match: payee:'...' and narration:'...' as (field, value), and
+    amount comparisons like "=12" as ("amount", (operator, number)), which
+    are all the filter suggestions add. Returns None if the filter has
+    anything else.
+    """
+    try:
+        tokens = [(token.type, token.value) for token in LEXER.lex(advanced_filter)]
+    except FilterError:
+        return None
+    terms: list[tuple[str, Any]] = []
+    i = 0
+    while i < len(tokens):
+        types = [type_ for type_, _ in tokens[i:i + 3]]
+        if types == ["KEY", "EQ_OP", "STRING"] and tokens[i][1] in TEXT_FIELDS:
+            terms.append((tokens[i][1], tokens[i + 2][1]))
+            i += 3
+        elif types[:2] == ["CMP_OP", "NUMBER"]:
+            terms.append(("amount", (tokens[i][1], tokens[i + 1][1])))
+            i += 2
+        else:
+            return None
+    return terms
+
+
+def apply_suggestion(filters: dict[str, str], suggestion: dict) -> dict[str, str]:
+    """
+    Return the filters (account, filter and time) after clicking on a
+    suggestion of make_filter_suggestions(), like applyFilterSuggestion()
+    in EditReplay.js: dates and accounts replace the time and account
+    filters, advanced filters are added to the advanced filter.
+    """
+    filters = dict(filters)
+    if suggestion.get("date"):
+        filters["time"] = str(suggestion["date"])
+    if suggestion.get("account"):
+        filters["account"] = suggestion["account"]
+    term = suggestion.get("filter")
+    if term and term not in filters.get("filter", ""):
+        filters["filter"] = f"{filters['filter']} {term}" if filters.get("filter") else term
+    return filters
+
+
+def _add(postings: dict[Any, set], key: Any, value: Any) -> None:
+    rows = postings.get(key)
+    if rows is None:
+        postings[key] = {value}
+    else:
+        rows.add(value)
+
+
+class _FileIndex:
+    """
+    The inverted index of the transactions of one ledger file, which are
+    identified by their position in the file.
+    """
+    __slots__ = (
+        "stamp", "rows", "dates", "payees", "narrations", "tokens",
+        "unicode_narrations", "accounts", "amounts",
+    )
+
+    def __init__(self, txns: list[Any], stamp: tuple[int, int] | None):
+        self.stamp = stamp
+        self.rows = len(txns)
+        # Dicts: { date, payee, narration, account or absolute number of the
+        # units of a posting: rows of the transactions having it }
+        self.dates: dict[date, set[int]] = {}
+        self.payees: dict[str, set[int]] = {}
+        self.narrations: dict[str, set[int]] = {}
+        self.accounts: dict[str, set[int]] = {}
+        self.amounts: dict[Decimal, set[int]] = {}
+        # Dict: { lowercase word: narrations having it }. Narrations with
+        # non-ASCII characters are kept apart, lowercasing them doesn't
+        # always match what a case-insensitive regex does.
+        self.tokens: dict[str, set[str]] = {}
+        self.unicode_narrations: set[str] = set()
+        for row, txn in enumerate(txns):
+            _add(self.dates, txn.date, row)
+            _add(self.payees, txn.payee or "", row)
+            narration = txn.narration or ""
+            if narration not in self.narrations:
+                if narration.isascii():
+                    for token in WORD.findall(narration.lower()):
+                        _add(self.tokens, token, narration)
+                else:
+                    self.unicode_narrations.add(narration)
+            _add(self.narrations, narration, row)
+            for name in get_entry_accounts(txn):
+                _add(self.accounts, name, row)
+            for posting in txn.postings:
+                number = getattr(posting.units, "number", None)
+                if isinstance(number, Decimal):
+                    _add(self.amounts, abs(number), row)
+
+    def _narrations(self, value: str) -> Any:
+        """
+        Return the narrations a narration:'value' term could match: those
+        with all the words of the value, except the first and last ones,
+        which can be part of longer words. None if any narration could.
+        """
+        if not value.isascii() or re.escape(value) != value:
+            return None
+        words = WORD.findall(value.lower())[1:-1]
+        if not words:
+            return None
+        narrations = None
+        for word in sorted(words, key=lambda word: len(self.tokens.get(word, ()))):
+            with_word = self.tokens.get(word, set())
+            narrations = with_word if narrations is None else narrations & with_word
+            if not narrations:
+                break
+        return narrations | self.unicode_narrations
+
+    def _matching(
+            self,
+            postings: dict[Any, set[int]],
+            keys: Any,
+            predicate: Any,
+            matched: dict[Any, bool],
+        ) -> set[int]:
+        """
+        Return the rows of the keys of postings matching the predicate,
+        which is evaluated once per distinct key, matched is shared by the
+        files.
+        """
+        rows: set[int] = set()
+        for key in keys:
+            is_match = matched.get(key)
+            if is_match is None:
+                is_match = matched[key] = predicate(key)
+            if is_match:
+                rows |= postings[key]
+        return rows
+
+    def count(self, constraints: list[tuple[str, Any]], cache: dict) -> int:
+        """Return the number of transactions matching all the constraints."""
+        rows: set[int] | None = None
+        for kind, value in constraints:
+            matched = cache.setdefault((kind, value), {})
+            if kind == "account":
+                match = Match(value)
+                found = self._matching(
+                    self.accounts, self.accounts,
+                    lambda name: account.has_component(name, value) or match(name),
+                    matched,
+                )
+            elif kind == "payee":
+                found = self._matching(self.payees, self.payees, Match(value), matched)
+            elif kind == "narration":
+                narrations = self._narrations(value)
+                found = self._matching(
+                    self.narrations,
+                    self.narrations if narrations is None else narrations,
+                    Match(value), matched,
+                )
+            elif kind == "amount":
+                op, number = value
+                if op == "=":
+                    found = self.amounts.get(number, set())
+                else:
+                    found = self._matching(
+                        self.amounts, self.amounts, MatchAmount(op, number).match, matched,
+                    )
+            else:  # kind == "time"
+                begin, end = value
+                found = self._matching(
+                    self.dates, self.dates, lambda day: begin <= day < end, matched,
+                )
+            rows = found if rows is None else rows & found
+            if not rows:
+                return 0
+        return self.rows if rows is None else len(rows)
+
+
+class SuggestionIndex:
+    """
+    Inverted index of the transactions of a ledger, to count the ones the
+    filters of the extension match without filtering the ledger. update()
+    only rebuilds the index of the files that changed.
+    """
+
+    def __init__(self):
+        # The mtime of the ledger when it was indexed
+        self.mtime: Any = None
+        # Dict: { filename: _FileIndex }
+        self.files: dict[str, _FileIndex] = {}
+
+    def update(self, entries: list[Any], mtime: Any) -> None:
+        """
+        Index the transactions of the entries, but those flagged 'S', unless
+        mtime didn't change.
+        """
+        if mtime is not None and mtime == self.mtime:
+            return
+        # Dict: { filename: transactions of the file }
+        file_txns: dict[str, list[Any]] = {}
+        for entry in entries:
+            if isinstance(entry, Transaction) and entry.flag != 'S':
+                file_txns.setdefault(entry.meta.get("filename", ""), []).append(entry)
+        files = {}
+        for filename, txns in file_txns.items():
+            stamp = file_stamp(filename)
+            index = self.files.get(filename)
+            if index is None or stamp is None or index.stamp != stamp or index.rows != len(txns):
+                index = _FileIndex(txns, stamp)
+            files[filename] = index
+        self.files = files
+        self.mtime = mtime
+
+    def count(self, constraints: list[tuple[str, Any]]) -> int:
+        """
+        Return the number of transactions matching all the constraints, as
+        (kind, value) with kind "account" (an account filter), "time" (a
+        (begin, end) date range), or a term of parse_terms().
+        """
+        # Dict: { constraint: { distinct value: whether it matches } }
+        cache: dict[tuple[str, Any], dict[Any, bool]] = {}
+        return sum(index.count(constraints, cache) for index in self.files.values())
+
+    def count_filters(
+            self,
+            filters: dict[str, str],
+            options_map: Any,
+            fava_options: Any,
+        ) -> int | None:
+        """
+        Return the number of transactions matching the account, filter and
+        time filters, like a replay with these filters, see
+        CompiledReplay.filter(). None if the advanced filter isn't made of
+        terms the index counts, see parse_terms().
+        """
+        constraints = parse_terms(filters.get("filter", ""))
+        if constraints is None:
+            return None
+        if filters.get("account"):
+            constraints.append(("account", filters["account"]))
+        if filters.get("time"):
+            try:
+                time_filter = TimeFilter(options_map, fava_options, filters["time"])
+            except FilterError:
+                return None
+            date_range = time_filter.date_range
+            constraints.append(("time", (date_range.begin, date_range.end)))
+        return self.count(constraints)
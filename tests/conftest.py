@@ -0,0 +1,49 @@
+"""Shared fixtures: a small ledger written to a temporary directory."""
+
+from __future__ import annotations
+
+import json
+from pathlib import Path
+
+import pytest
+from beancount import loader
+from fava.core.fava_options import FavaOptions
+
+from fava_edit_replay.replay import Replay
+
+LEDGER = """\
+option "operating_currency" "EUR"
+
+2020-01-01 open Assets:Bank EUR
+2020-01-01 open Expenses:Food EUR
+2020-01-01 open Expenses:Rent EUR
+
+2020-02-01 * "Grocer" "apples"
+  Expenses:Food  12.00 EUR
+  Assets:Bank
+
+2020-02-03 * "Landlord" "rent"
+  Expenses:Rent  800.00 EUR
+  Assets:Bank
+
+2020-03-01 * "Grocer" "pears"
+  Expenses:Food  100.00 EUR
+  Assets:Bank
+"""
+
+
+def make_replay(diff: dict, account: str = "", filter: str = "", time: str = "", lineno: int = 1) -> Replay:
+    return Replay(lineno, time, account, filter, json.dumps(diff), None)
+
+
+def load(path: Path) -> tuple[list, list, dict, FavaOptions]:
+    entries, errors, options_map = loader.load_file(str(path))
+    return entries, errors, options_map, FavaOptions()
+
+
+@pytest.fixture
+def ledger_file(tmp_path: Path) -> Path:
+    """The path of a small ledger, in its own directory."""
+    path = tmp_path / "main.beancount"
+    path.write_text(LEDGER)
+    return path
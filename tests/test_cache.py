@@ -0,0 +1,41 @@
+from __future__ import annotations
+
+import os
+
+import pytest
+from conftest import LEDGER, load, make_replay
+
+from fava_edit_replay.cache import LedgerCache, LoadedLedger, cache_path_for
+from fava_edit_replay.helpers import apply_replays
+
+NARRATION = {"values_changed": {"root.narration": {"new_value": "food"}}}
+
+
+def run(ledger_file, diff):
+    """Load and cache the ledger, apply the diff and update the cache."""
+    cache = LedgerCache(cache_path_for(str(ledger_file)))
+    ledger = LoadedLedger(*load(ledger_file))
+    cache.save(ledger)
+    result = apply_replays(
+        [make_replay(diff, account="Expenses:Food")],
+        ledger.entries, ledger.options_map, ledger.fava_options,
+    )
+    cache.update(ledger, result)
+    return cache
+
+
+def test_update_splices_safe_changes(ledger_file):
+    cache = run(ledger_file, NARRATION)
+    cached = cache.load()
+    assert [e.narration for e in cached.entries if hasattr(e, "narration")] == ["food", "rent", "food"]
+
+
+@pytest.mark.parametrize("diff", [
+    {"values_changed": {"root.postings[0].units.number": {"new_value": "13.00"}}},
+    NARRATION,
+])
+def test_update_clears_full_load_with_stale_errors(ledger_file, diff):
+    ledger_file.write_text(LEDGER + "\n2020-04-01 balance Assets:Bank  -900.00 EUR\n")
+    assert load(ledger_file)[1]
+    cache = run(ledger_file, diff)
+    assert not os.path.exists(cache.path)
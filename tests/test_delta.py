@@ -0,0 +1,71 @@
+from __future__ import annotations
+
+import json
+
+import pytest
+from beancount.parser import parser
+from beancount.parser.printer import format_entry
+
+from fava_edit_replay.delta import DeltaPatch, compose_deltas
+from fava_edit_replay.diff import diff_transactions
+from fava_edit_replay.diff2text import format_diff
+
+
+def parse_txn(source: str):
+    entries, errors, _ = parser.parse_string(source)
+    assert not errors
+    return entries[0]
+
+
+def test_legacy_type_changes():
+    # As DeepDiff stored adding a payee to a transaction without one
+    delta = {
+        "type_changes": {
+            "root.payee": {"old_type": "NoneType", "new_type": "str", "old_value": None, "new_value": "Grocer"},
+        },
+        "values_changed": {"root.narration": {"new_value": "apples"}},
+    }
+    txn = parse_txn('2020-02-01 * "fruit"\n  Expenses:Food  12.00 EUR\n  Assets:Bank\n')
+
+    patched = DeltaPatch(delta).apply(txn)
+    assert (patched.payee, patched.narration) == ("Grocer", "apples")
+    assert 'Payee changed to "Grocer"' in format_diff(delta)
+
+
+BEFORE = """\
+2020-02-01 * "Grocer" "apples" #food
+  Expenses:Food  12.00 EUR
+  Assets:Bank
+"""
+
+
+@pytest.mark.parametrize("after", [
+    # Payee, narration, flag, tags and links
+    '2020-02-01 ! "Market" "pears" #fruit ^receipt\n  Expenses:Food  12.00 EUR\n  Assets:Bank\n',
+    # Amount, account and metadata of a posting
+    '2020-02-01 * "Grocer" "apples" #food\n  note: "weekly"\n  Expenses:Groceries  13.50 EUR\n    shop: "corner"\n  Assets:Bank\n',
+    # An added posting
+    '2020-02-01 * "Grocer" "apples" #food\n  Expenses:Food  10.00 EUR\n  Expenses:Drinks  2.00 EUR\n  Assets:Bank\n',
+    # A removed posting
+    '2020-02-01 * "Grocer" "apples" #food\n  Expenses:Food  12.00 EUR\n',
+])
+def test_diff_patch_round_trip(after):
+    before, after = parse_txn(BEFORE), parse_txn(after)
+    delta = diff_transactions(before, after)
+    assert delta
+    assert format_entry(DeltaPatch(delta).apply(before)) == format_entry(after)
+    # As stored in the replays file
+    assert format_entry(DeltaPatch(json.loads(json.dumps(delta))).apply(before)) == format_entry(after)
+
+
+def test_compose_deltas():
+    txn = parse_txn(BEFORE)
+    narration = {"values_changed": {"root.narration": {"new_value": "pears"}}}
+    tag = {"set_item_added": {"root.tags": ["fruit"]}}
+    other_narration = {"values_changed": {"root.narration": {"new_value": "plums"}}}
+
+    composed, conflicts = compose_deltas([narration, tag, other_narration])
+    assert conflicts == [(2, 0, "root.narration")]
+    patched = DeltaPatch(composed).apply(txn)
+    assert format_entry(patched) == format_entry(DeltaPatch(tag).apply(DeltaPatch(narration).apply(txn)))
+    assert (patched.narration, patched.tags) == ("pears", {"food", "fruit"})
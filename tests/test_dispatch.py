@@ -0,0 +1,71 @@
+from __future__ import annotations
+
+import pytest
+from conftest import load, make_replay
+from fava.beans.abc import Transaction
+from fava.core.filters import AdvancedFilter, FilterError
+
+from fava_edit_replay.dispatch import ReplayDispatch, parse_advanced_filter
+from fava_edit_replay.helpers import compile_replays, match_replays
+
+FILTERS = [
+    "payee:'Grocer'",
+    "narration:'app' =12",
+    "-payee:'Grocer'",
+    "payee:'Grocer', payee:'Landlord'",
+    "any(account:'Rent')",
+    ">50",
+]
+
+
+@pytest.mark.parametrize("advanced_filter", FILTERS)
+def test_parse_advanced_filter(ledger_file, advanced_filter):
+    entries = load(ledger_file)[0]
+    txns = [entry for entry in entries if isinstance(entry, Transaction)]
+    include = parse_advanced_filter(advanced_filter)
+    assert [txn for txn in txns if include(txn)] == AdvancedFilter(advanced_filter).apply(txns)
+
+
+def test_parse_invalid_advanced_filter():
+    with pytest.raises(FilterError):
+        parse_advanced_filter("payee:(")
+
+
+def test_match_replays_first_match(ledger_file):
+    entries, _, options_map, fava_options = load(ledger_file)
+    txns = [entry for entry in entries if isinstance(entry, Transaction)]
+    diff = {"values_changed": {"root.flag": {"new_value": "!"}}}
+    replays = compile_replays([
+        make_replay(diff, filter=">500", lineno=1),
+        make_replay(diff, filter="payee:'Grocer'", time="2020-03", lineno=2),
+        make_replay(diff, filter="#food, =12", lineno=3),
+        make_replay(diff, account="Expenses:Food", lineno=4),
+    ], options_map, fava_options)
+    dispatch = ReplayDispatch(replays)
+    assert dispatch.bulk == [0, 2]
+
+    matched = match_replays(replays, txns, dispatch=dispatch)
+    for txn in txns:
+        # The first replay whose filters match, like filtering with Fava
+        expected = next((replay for replay in replays if txn in replay.filter(txns)), None)
+        assert matched.get(id(txn)) is expected
+    assert [replay.replay.lineno for replay in matched.values()] == [3, 1, 2]
+
+
+def test_match_replays_compose(ledger_file):
+    entries, _, options_map, fava_options = load(ledger_file)
+    txns = [entry for entry in entries if isinstance(entry, Transaction)]
+    diff = {"values_changed": {"root.flag": {"new_value": "!"}}}
+    replays = compile_replays([
+        make_replay(diff, filter="payee:'Grocer'", lineno=1),
+        make_replay(diff, account="Expenses", filter="-payee:'Landlord'", lineno=2),
+        make_replay(diff, account="Expenses:Rent", lineno=3),
+        make_replay(diff, filter="narration:'pe'", time="2020", lineno=4),
+    ], options_map, fava_options)
+
+    matched = match_replays(replays, txns, compose=True)
+    for txn in txns:
+        # All the replays whose filters match, in order
+        expected = [replay for replay in replays if txn in replay.filter(txns)]
+        assert matched.get(id(txn), []) == expected
+    assert [[replay.replay.lineno for replay in txn_replays] for txn_replays in matched.values()] == [[1, 2], [3], [1, 2, 4]]
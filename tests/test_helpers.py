@@ -0,0 +1,84 @@
+from __future__ import annotations
+
+from conftest import LEDGER, load, make_replay
+
+from fava_edit_replay.delta import DeltaPatch
+from fava_edit_replay.helpers import (
+    CompiledReplay, DryRun, apply_replays, modified_source, parse_slice, preview_replays,
+)
+from fava_edit_replay.rewrite import file_stamps
+
+
+def test_invalid_diff_skips_only_its_replay(ledger_file, caplog):
+    entries, _, options_map, fava_options = load(ledger_file)
+    invalid = make_replay(
+        {"attribute_added": {"root.postings[0].note": "x"}},
+        account="Expenses", lineno=1,
+    )
+    valid = make_replay(
+        {"values_changed": {"root.narration": {"new_value": "food"}}},
+        account="Expenses:Food", lineno=2,
+    )
+
+    compiled = CompiledReplay(invalid, options_map, fava_options)
+    assert compiled.skipped and "attribute_added" in compiled.error
+    assert "Skipping replay #1" in caplog.text
+
+    result = apply_replays([invalid, valid], entries, options_map, fava_options)
+    assert result.modified_count == 2
+    assert ledger_file.read_text().count('"Grocer" "food"') == 2
+
+
+def test_apply_replays_included_files(ledger_file):
+    included = ledger_file.parent / "2021.beancount"
+    included.write_text('2021-01-05 * "Grocer" "plums"\n  Expenses:Food  7.00 EUR\n  Assets:Bank\n')
+    with open(ledger_file, "a") as f:
+        f.write('\ninclude "2021.beancount"\n')
+    entries, _, options_map, fava_options = load(ledger_file)
+    replay = make_replay(
+        {"values_changed": {"root.narration": {"new_value": "fruit"}}},
+        filter="payee:'Grocer'",
+    )
+
+    result = apply_replays([replay], entries, options_map, fava_options, stamps=file_stamps(options_map["include"]))
+    assert sorted(result.files) == sorted([str(ledger_file), str(included)])
+    assert set(result.stamps) == set(result.files)
+    assert ledger_file.read_text().count('"Grocer" "fruit"') == 2
+    assert included.read_text().startswith('2021-01-05 * "Grocer" "fruit"\n')
+    assert not load(ledger_file)[1]
+
+
+def test_modified_source_keeps_elided_amounts():
+    original_slice = (
+        '2020-02-01 * "Broker" "buy"\n'
+        '  Assets:Stocks  10 ACME {5.00 EUR}\n'
+        '  Assets:Bank'
+    )
+    delta = DeltaPatch({"values_changed": {"root.narration": {"new_value": "buy more"}}})
+    parse_slice.cache_clear()
+
+    for _ in range(2):
+        assert modified_source(original_slice, delta, 40, 2) == (
+            '2020-02-01 * "Broker" "buy more"\n'
+            '  Assets:Stocks                     10 ACME {5.00 EUR}\n'
+            '  Assets:Bank'
+        )
+    assert parse_slice.cache_info().hits == 1
+
+
+def test_dry_run_pages(ledger_file):
+    # The rent aligned like Fava renders it
+    ledger_file.write_text(LEDGER.replace("  Expenses:Rent  800.00 EUR", f"  {'Expenses:Rent':<51}800.00 EUR"))
+    entries, _, options_map, fava_options = load(ledger_file)
+    replays = [
+        make_replay({"values_changed": {"root.flag": {"new_value": "*"}}}, filter="payee:'Landlord'", lineno=1),
+        make_replay({"values_changed": {"root.flag": {"new_value": "!"}}}, account="Expenses", lineno=2),
+    ]
+    dry_run = DryRun(replays, entries, options_map, fava_options)
+    assert len(dry_run.matches) == 3
+
+    pages = [dry_run.page(offset, 1) for offset in range(3)]
+    # The rent is matched by the first replay, which doesn't change it
+    assert [len(page) for page in pages] == [1, 1, 0]
+    assert [page[0] for page in pages[:2]] == list(preview_replays(replays, entries, options_map, fava_options))
+    assert dry_run.page(0, 10) == dry_run.previews
@@ -0,0 +1,54 @@
+from __future__ import annotations
+
+from conftest import LEDGER, load
+from fava.beans.abc import Transaction
+
+from fava_edit_replay.index import MatchIndex, transaction_key
+
+
+def transactions(path):
+    return [entry for entry in load(path)[0] if isinstance(entry, Transaction)]
+
+
+def test_reformatted_transactions_keep_their_outcome(ledger_file, tmp_path):
+    apples, rent, pears = txns = transactions(ledger_file)
+    index = MatchIndex(tmp_path / "replays.yaml.index", ["context"])
+    keys, candidates, _ = index.plan(txns, ["a", "b"])
+    assert set(candidates.values()) == {0b11}
+    # b matched apples without changing it, nothing matched rent, pears was rewritten
+    index.update(txns, ["a", "b"], keys, {id(apples): 1, id(pears): 0}, {id(pears)})
+    _, candidates, _ = index.plan(txns, ["a", "b"])
+    assert candidates[id(rent)] == 0
+
+    # Moved down, reindented and realigned, and one edited
+    ledger_file.write_text(
+        LEDGER.replace("2020-02-01", "\n\n2020-02-01")
+        .replace("  Expenses:Food  12.00 EUR", "    Expenses:Food        12.00 EUR")
+        .replace('"rent"', '"rent, february"')
+    )
+    apples2, rent2, pears2 = txns2 = transactions(ledger_file)
+    assert apples2.meta["lineno"] != apples.meta["lineno"]
+    assert transaction_key(apples2) == transaction_key(apples)
+
+    index = MatchIndex(tmp_path / "replays.yaml.index", ["context"])
+    index.load()
+    _, candidates, settled = index.plan(txns2, ["a", "b"])
+    assert (candidates[id(apples2)], settled[id(apples2)]) == (0, 1)
+    assert candidates[id(rent2)] == candidates[id(pears2)] == 0b11
+    assert id(rent2) not in settled and id(pears2) not in settled
+
+    # A new replay is only evaluated against the settled transactions it comes before
+    _, candidates, settled = index.plan(txns2, ["c", "a", "b"])
+    assert (candidates[id(apples2)], settled[id(apples2)]) == (0b1, 2)
+
+
+def test_index_context(ledger_file, tmp_path):
+    txns = transactions(ledger_file)
+    index = MatchIndex(tmp_path / "replays.yaml.index", ["context"])
+    keys, _, _ = index.plan(txns, ["a"])
+    index.update(txns, ["a"], keys, {}, set())
+
+    index = MatchIndex(tmp_path / "replays.yaml.index", ["other context"])
+    index.load()
+    assert index.positions == {}
+    assert set(index.plan(txns, ["a"])[1].values()) == {0b1}
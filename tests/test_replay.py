@@ -0,0 +1,31 @@
+from __future__ import annotations
+
+import pytest
+from conftest import make_replay
+
+from fava_edit_replay.replay import copy_replays, open_replay_store
+
+
+@pytest.mark.parametrize("source_name, target_name", [
+    ("replays.yaml", "replays.jsonl"),
+    ("replays.jsonl", "replays.yaml"),
+])
+def test_copy_replays(tmp_path, source_name, target_name):
+    source = open_replay_store(tmp_path / source_name)
+    for filter in ("payee:'Grocer'", "#food"):
+        source.save(make_replay({"values_changed": {"root.flag": {"new_value": "!"}}}, filter=filter))
+    target_path = tmp_path / target_name
+
+    assert copy_replays(source.path, target_path) == 2
+    with pytest.raises(FileExistsError):
+        copy_replays(source.path, target_path)
+    assert [replay.advanced_filter for replay in open_replay_store(target_path).replays()] == ["payee:'Grocer'", "#food"]
+
+    assert copy_replays(source.path, target_path, append=True) == 2
+    assert len(open_replay_store(target_path).replays()) == 4
+    assert sorted(path.name for path in tmp_path.iterdir()) == sorted([source_name, target_name])
+
+
+def test_copy_no_replays(tmp_path):
+    assert copy_replays(tmp_path / "replays.yaml", tmp_path / "replays.jsonl") == 0
+    assert open_replay_store(tmp_path / "replays.jsonl").replays() == []
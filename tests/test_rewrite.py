@@ -0,0 +1,84 @@
+from __future__ import annotations
+
+import os
+
+import pytest
+
+from fava_edit_replay import rewrite
+from fava_edit_replay.rewrite import (
+    ChangedFileError, JournalError, commit_files, file_stamps, journal_path_for, recover_journal,
+)
+
+
+@pytest.fixture
+def files(tmp_path):
+    """Two ledger files and their rewritten versions, as { filename: tmp_path }."""
+    tmp_files = {}
+    for name in ("a", "b"):
+        path = tmp_path / f"{name}.beancount"
+        path.write_text(f"; {name} before\n")
+        tmp = tmp_path / f".{name}.tmp"
+        tmp.write_text(f"; {name} after\n")
+        tmp_files[str(path)] = str(tmp)
+    return tmp_files
+
+
+def contents(tmp_files):
+    return [open(filename).read() for filename in tmp_files]
+
+
+def test_commit_files(tmp_path, files):
+    journal_path = journal_path_for(str(tmp_path / "a.beancount"))
+    stamps = commit_files(files, journal_path, file_stamps(files))
+    assert contents(files) == ["; a after\n", "; b after\n"]
+    assert stamps == file_stamps(files)
+    assert sorted(os.listdir(tmp_path)) == ["a.beancount", "b.beancount"]
+
+
+@pytest.mark.parametrize("rollback", [False, True])
+def test_recover_journal_after_crash(tmp_path, files, monkeypatch, rollback):
+    journal_path = journal_path_for(str(tmp_path / "a.beancount"))
+
+    def crash(journal_files):
+        # Killed after replacing the first file
+        os.replace(journal_files[0]["tmp"], journal_files[0]["filename"])
+        raise KeyboardInterrupt
+
+    with monkeypatch.context() as m:
+        m.setattr(rewrite, "_roll_forward", crash)
+        with pytest.raises(KeyboardInterrupt):
+            commit_files(files, journal_path)
+    assert contents(files) == ["; a after\n", "; b before\n"]
+    with pytest.raises(JournalError):
+        commit_files(files, journal_path)
+
+    assert recover_journal(journal_path, rollback=rollback) == list(files)
+    if rollback:
+        assert contents(files) == ["; a before\n", "; b before\n"]
+    else:
+        assert contents(files) == ["; a after\n", "; b after\n"]
+    assert sorted(os.listdir(tmp_path)) == ["a.beancount", "b.beancount"]
+    assert recover_journal(journal_path) == []
+
+
+def test_changed_file(tmp_path, files):
+    journal_path = journal_path_for(str(tmp_path / "a.beancount"))
+    stamps = file_stamps(files)
+    with open(tmp_path / "b.beancount", "a") as f:
+        f.write("; edited meanwhile\n")
+
+    with pytest.raises(ChangedFileError, match="b.beancount changed since it was read"):
+        commit_files(files, journal_path, stamps)
+    assert contents(files) == ["; a before\n", "; b before\n; edited meanwhile\n"]
+    assert sorted(os.listdir(tmp_path)) == ["a.beancount", "b.beancount"]
+
+
+def test_file_stamps_modified_after(files):
+    a, b = files
+    os.utime(b, ns=(2_000_000_000, 2_000_000_000))
+    os.utime(a, ns=(1_000_000_000, 1_000_000_000))
+    stamps = file_stamps(files, after_ns=1_500_000_000)
+    assert stamps[a] == (1_000_000_000, os.stat(a).st_size)
+    assert stamps[b] is None
+    with pytest.raises(ChangedFileError):
+        commit_files(files, journal_path_for(a), stamps)